@@ -0,0 +1,332 @@
+"""End-to-end agent benchmark.
+
+Run the loops of the agent as the agent host does, on Linux: the Windows
+modules are stubbed, Zookeeper is gcp_wc.fake_zookeeper and Docker is the
+FakeRuntime of gcp_wc.runtime with a latency per request. The services run
+their real code: the event daemon synchronizes the cache, the app config
+manager configures and starts the containers, the state monitor and the
+app event service report their exits, the cleanup service frees them.
+
+A scheduler places the manifests of deploy/*.yml, then plays their
+lifecycle in three stages:
+
+- place: every instance placed, until its service_running event is in
+  Zookeeper,
+- exit: the containers of the short-lived manifests exit (short finishes,
+  abort and error fail), until their finished or aborted event is in
+  Zookeeper,
+- revoke: the placement of the long-running manifests is deleted, until
+  their container and their running manifest are removed.
+
+It reports the latencies of each stage, the Zookeeper and Docker requests
+the agent made during each, and the /running nodes left behind: a revoked
+instance is handed to the cleanup without its manifests, which only
+removes its containers. With --json the report is a JSON
+object; the exit status is 1 when the median latency of a stage is over its
+budget, for CI.
+
+Usage:
+    python benchmarks/bench_agent.py [--rounds N] [--create-ms N]
+        [--start-ms N] [--stop-ms N] [--json]
+"""
+import os
+import sys
+import json
+import glob
+import time
+import types
+import shutil
+import socket
+import logging
+import argparse
+import functools
+import tempfile
+import threading
+import collections
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# The services import the Windows modules at the top.
+for name in ('win32serviceutil', 'win32service', 'win32event', 'win32api', 'win32con',
+             'win32gui', 'win32ts', 'docker', 'docker.errors', 'events'):
+    sys.modules.setdefault(name, types.ModuleType(name))
+
+
+class ServiceFramework(object):
+    pass
+
+
+sys.modules['win32serviceutil'].ServiceFramework = ServiceFramework
+
+import yaml
+
+# The agent pins PyYAML 3.12, where load takes no Loader.
+if not yaml.__version__.startswith('3.'):
+    yaml.load = functools.partial(lambda load, stream, Loader=yaml.Loader: load(stream, Loader),
+                                  yaml.load)
+
+from gcp_wc import agent_host
+from gcp_wc import app_config_manager_service
+from gcp_wc import app_event_service
+from gcp_wc import cleanup_service
+from gcp_wc import config
+from gcp_wc import event_daemon_service
+from gcp_wc import instance_index
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import runtime
+from gcp_wc import state_monitor_service
+from gcp_wc.fake_zookeeper import FakeZooKeeper
+
+HOSTNAME = socket.gethostname()
+# Required by the configuration, unused: the agent runs on the fakes.
+ZOOKEEPER = '127.0.0.1:2181'
+
+WORKERS = [
+    ('AppCfgMgrService', app_config_manager_service.run),
+    ('AppeventService', app_event_service.run),
+    ('CleanupService', cleanup_service.run),
+    ('EventDaemonService', event_daemon_service.run),
+    ('StateMonitorService', state_monitor_service.run),
+]
+
+# Exit code of the container of each manifest, None to run until revoked.
+EXIT_CODES = {
+    'short': 0,
+    'abort': 2,
+    'error': 1,
+    'long1': None,
+    'long2': None,
+}
+
+# Median seconds allowed per stage. The app config manager waits
+# configureDelay (3 s) before each configuration and the event daemon
+# unplaceDelay (2 s) before each kill.
+BUDGETS = {
+    'place': 30.0,
+    'exit': 15.0,
+    'revoke': 30.0,
+}
+
+STAGE_TIMEOUT = 300
+
+DIRECTORIES = ('appevents', 'cache', 'cleanup', 'running')
+
+
+class LatencyRuntime(object):
+    """Delay and count the requests made to a runtime."""
+
+    def __init__(self, client, latencies):
+        """
+        client: FakeRuntime
+        latencies: seconds of delay, by request
+        """
+        self.client = client
+        self.latencies = latencies
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        request = getattr(self.client, name)
+        latency = self.latencies.get(name, 0)
+
+        def delayed(*args, **kwargs):
+            with self._lock:
+                self.requests[name] += 1
+            if latency:
+                time.sleep(latency)
+            return request(*args, **kwargs)
+        return delayed
+
+
+class Instance(object):
+    """An instance placed by the scheduler, and its lifecycle."""
+
+    def __init__(self, name, manifest, exit_code):
+        self.name = name
+        self.manifest = manifest
+        self.exit_code = exit_code
+        self.app, self.task = name.split('#')
+        self.container_id = None
+        self.times = {}
+
+    def events(self, zk):
+        """Returns {event type: data} of its events in Zookeeper."""
+        events = {}
+        for node in zk.get_children('%s/%s/%s' % (app_event_service.TASKS, self.app, self.task)):
+            _time, _host, event_type, data = node.split(',', 3)
+            events[event_type] = data
+        return events
+
+
+def zookeeper_requests():
+    """Returns the Zookeeper requests of the agent, by operation."""
+    requests = collections.Counter()
+    for values, child in metrics.ZOOKEEPER_SECONDS.children():
+        requests[values[0]] = sum(child.counts)
+    return requests
+
+
+class Scheduler(object):
+    """Place the manifests and follow their instances."""
+
+    def __init__(self, zk, client, root, rounds):
+        self.zk = zk
+        self.client = client
+        self.root = root
+        self.instances = []
+        for round_ in range(rounds):
+            for filename in sorted(glob.glob(os.path.join(ROOT, 'deploy', '*.yml'))):
+                stem = os.path.splitext(os.path.basename(filename))[0]
+                with open(filename) as f:
+                    manifest = yaml.safe_load(f)
+                name = 'proid.%s#%010d' % (stem, round_)
+                self.instances.append(Instance(name, manifest, EXIT_CODES.get(stem)))
+        zk.ensure_path(app_event_service.TASKS)
+        zk.ensure_path(event_daemon_service.PLACEMENT + '/' + HOSTNAME)
+        zk.ensure_path('/running')
+        zk.create(event_daemon_service.SERVER_PRESENCE + '/' + HOSTNAME, makepath=True)
+
+    def place(self):
+        for instance in self.instances:
+            self.zk.create('%s/%s' % (event_daemon_service.SCHEDULED, instance.name),
+                           yaml.safe_dump(instance.manifest).encode('utf-8'), makepath=True)
+            self.zk.create('%s/%s/%s' % (app_event_service.TASKS, instance.app, instance.task),
+                           makepath=True)
+            instance.times['placed'] = time.time()
+            self.zk.create('%s/%s/%s' % (event_daemon_service.PLACEMENT, HOSTNAME, instance.name))
+
+    def running(self, instance):
+        data = instance.events(self.zk).get('service_running')
+        if data is None:
+            return False
+        instance.container_id = data.split('.')[0]
+        return True
+
+    def exit(self, instance):
+        instance.times['exited'] = time.time()
+        self.client.exit(instance.container_id, instance.exit_code)
+
+    def exit_reported(self, instance):
+        return bool(set(instance.events(self.zk)) & {'finished', 'aborted', 'killed'})
+
+    def revoke(self, instance):
+        instance.times['revoked'] = time.time()
+        self.zk.delete('%s/%s/%s' % (event_daemon_service.PLACEMENT, HOSTNAME, instance.name))
+
+    def freed(self, instance):
+        if os.path.exists(os.path.join(self.root, 'running', instance.name)):
+            return False
+        return not self.client.containers(all=True, filters={
+            'label': [instance_index.LABEL_INSTANCE + '=' + instance.name]})
+
+    def left(self, instances):
+        """Returns the number of instances whose /running node is left."""
+        return sum(1 for instance in instances if self.zk.exists('/running/' + instance.name))
+
+
+def wait(instances, done, stage, start):
+    """Wait until done(instance) for all instances, returns their latencies."""
+    latencies = {}
+    deadline = time.time() + STAGE_TIMEOUT
+    while len(latencies) < len(instances):
+        if time.time() > deadline:
+            raise RuntimeError('%s timed out: %s' % (stage, sorted(
+                instance.name for instance in instances if instance.name not in latencies)))
+        for instance in instances:
+            if instance.name not in latencies and done(instance):
+                latencies[instance.name] = time.time() - instance.times[start]
+        time.sleep(0.01)
+    return sorted(latencies.values())
+
+
+def run(args):
+    root = tempfile.mkdtemp()
+    for directory in DIRECTORIES:
+        os.makedirs(os.path.join(root, directory))
+    filename = os.path.join(root, 'configure.json')
+    with open(filename, 'w') as f:
+        json.dump({'workDirectory': root, 'zookeeper': ZOOKEEPER, 'metricsPort': '0',
+                   'loopReportInterval': str(10 ** 9)}, f)
+    config.reload(filename)
+
+    fake_zk = FakeZooKeeper()
+    fake_zk.start()
+    fake_client = runtime.FakeRuntime()
+    client = LatencyRuntime(fake_client, {
+        'create': args.create_ms / 1000.0,
+        'start': args.start_ms / 1000.0,
+        'kill': args.stop_ms / 1000.0,
+        'remove': args.stop_ms / 1000.0,
+    })
+    scheduler = Scheduler(fake_zk, fake_client, root, args.rounds)
+    loop.install(loop.ThreadActivity())
+    host = agent_host.AgentHost(root, metrics.zookeeper(fake_zk), client, WORKERS)
+    host.start()
+
+    stages = collections.OrderedDict()
+
+    def stage(name, instances, act, done, start):
+        zk_before, docker_before = zookeeper_requests(), collections.Counter(client.requests)
+        for instance in instances:
+            act(instance)
+        latencies = wait(instances, done, name, start)
+        stages[name] = {
+            'instances': len(instances),
+            'median': latencies[len(latencies) // 2],
+            'max': latencies[-1],
+            'zookeeper': dict(zookeeper_requests() - zk_before),
+            'docker': dict(collections.Counter(client.requests) - docker_before),
+        }
+
+    exiting = [instance for instance in scheduler.instances if instance.exit_code is not None]
+    revoked = [instance for instance in scheduler.instances if instance.exit_code is None]
+    try:
+        scheduler.place()
+        stage('place', scheduler.instances, lambda instance: None, scheduler.running, 'placed')
+        stage('exit', exiting, scheduler.exit, scheduler.exit_reported, 'exited')
+        stage('revoke', revoked, scheduler.revoke, scheduler.freed, 'revoked')
+        stages['revoke']['running nodes left'] = scheduler.left(revoked)
+    finally:
+        host.stop()
+        shutil.rmtree(root, ignore_errors=True)
+    return stages
+
+
+def report(stages):
+    for name, result in stages.items():
+        print('%-8s %3d instances  median %6.2f s  max %6.2f s  budget %5.1f s' % (
+            name, result['instances'], result['median'], result['max'], BUDGETS[name]))
+        if 'running nodes left' in result:
+            print('         running nodes left %d' % result['running nodes left'])
+        for kind in ('zookeeper', 'docker'):
+            print('         %-10s %s' % (kind, ', '.join(
+                '%s %d' % item for item in sorted(result[kind].items())) or '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end agent benchmark')
+    parser.add_argument('--rounds', type=int, default=1,
+                        help='instances placed per manifest')
+    parser.add_argument('--create-ms', type=int, default=50)
+    parser.add_argument('--start-ms', type=int, default=200)
+    parser.add_argument('--stop-ms', type=int, default=100)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stages = run(args)
+    if args.json:
+        print(json.dumps(stages, indent=4, sort_keys=True))
+    else:
+        report(stages)
+    over = [name for name, result in stages.items() if result['median'] > BUDGETS[name]]
+    if over:
+        print('over budget: %s' % ', '.join(over), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
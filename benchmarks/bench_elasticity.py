@@ -0,0 +1,118 @@
+"""Elasticity benchmark.
+
+Replay a synthetic desktop day (working sessions, breaks, nights) against a
+cpu-bound container, and compare the work it gets done and the contention it
+causes under its static manifest limit and under the elasticity controller.
+
+Then check that the limit of a container using less than its limit shrinks
+when the user's load returns on an idle desktop, the user's load being what
+the containers do not use. Exits with 1 when it does not.
+
+Usage:
+    python benchmarks/bench_elasticity.py [days] [seed]
+"""
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import elasticity
+from gcp_wc import runtime
+
+# Seconds between two StateMonitor iterations.
+TICK = 2
+FLOOR = 10
+CEILING = 80
+# Cpu percent the light container uses, under its raised limit.
+DEMAND = 15
+
+
+def desktop(days, rng):
+    """Yields (user cpu percent, seconds since the last input) every TICK."""
+    for _day in range(days):
+        # Night and morning away, then sessions of work separated by breaks.
+        periods = [(False, rng.uniform(8, 10) * 3600)]
+        while sum(length for _active, length in periods) < 20 * 3600:
+            periods.append((True, rng.uniform(20, 120) * 60))
+            periods.append((False, rng.expovariate(1 / 900.0)))
+        periods.append((False, 24 * 3600 - sum(length for _active, length in periods)))
+        for active, length in periods:
+            idle = 0
+            for _ in range(int(max(length, 0) // TICK)):
+                if active:
+                    idle = 0 if rng.random() < 0.5 else idle + TICK
+                    yield rng.uniform(15, 70), idle
+                else:
+                    idle += TICK
+                    yield rng.uniform(0, 5), idle
+
+
+def run(days, seed, elastic):
+    client = runtime.FakeRuntime()
+    container_id = client.create('python')
+    client.start(container_id)
+    controller = elasticity.ElasticityController(client, cpu_count=8)
+    instances = {container_id: (FLOOR, CEILING)}
+    work = contention = 0
+    now = 0
+    for user_load, idle in desktop(days, random.Random(seed)):
+        now += TICK
+        limit = FLOOR
+        if elastic:
+            limit = controller.limits.get(container_id, (FLOOR, None))[0]
+            controller.tick(instances, user_load + limit, idle, now,
+                            usage={container_id: limit})
+            limit = controller.limits.get(container_id, (FLOOR, None))[0]
+        work += limit * TICK / 100.0
+        if user_load + limit > 100 or (idle < 60 and limit > 50):
+            contention += TICK
+    return {
+        'work (cpu hours)': work * 8 / 3600,
+        'contention (min)': contention / 60.0,
+        'updates': len([call for call in client.calls if call[0] == 'update']),
+    }
+
+
+def light():
+    """Returns the limits of a container using DEMAND on a deeply idle
+    desktop, once grown with the user away and once the user's load is back.
+    """
+    client = runtime.FakeRuntime()
+    container_id = client.create('python')
+    client.start(container_id)
+    controller = elasticity.ElasticityController(client, cpu_count=8, min_interval=0)
+    instances = {container_id: (FLOOR, CEILING)}
+    idle = controller.deep_idle
+    limits = []
+    now = 0
+    for user_load in (2, 70):
+        for _ in range(100):
+            now += TICK
+            limit = controller.limits.get(container_id, (FLOOR, None))[0]
+            used = min(DEMAND, limit)
+            controller.tick(instances, user_load + used, idle, now, usage={container_id: used})
+        limits.append(controller.limits[container_id][0])
+    return limits
+
+
+def main():
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    static = run(days, seed, elastic=False)
+    elastic = run(days, seed, elastic=True)
+    print('{name:<18} {static:>12} {elastic:>12}'.format(
+        name='', static='static', elastic='elastic'))
+    for name in sorted(static):
+        print('{name:<18} {static:>12.1f} {elastic:>12.1f}'.format(
+            name=name, static=static[name], elastic=elastic[name]))
+    grown, shrunk = light()
+    print('light container    limit %d%% user away, %d%% user load back' % (grown, shrunk))
+    if shrunk > FLOOR:
+        print('the limit of the light container did not shrink', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,571 @@
+"""Fleet simulator.
+
+Run hundreds of virtual desktops in one process, against one Zookeeper,
+to see how the ensemble behaves as the fleet grows. Zookeeper is
+gcp_wc.fake_zookeeper, which counts the requests by operation and keeps
+the watches; each desktop has its own hostname, work directory, screen
+lock schedule and FakeRuntime, whose requests take --create-ms, --start-ms
+and --stop-ms of simulated time, and runs on asyncio the loops of the agent
+that talk to Zookeeper:
+
+- register: the registerZookeeper loop, advertising the desktop (the
+  /servers node and the ephemeral /server.presence node) once the lock
+  settled and is worth it,
+- watchdog: every watchdogInterval, evacuates the desktop while unlocked,
+  through the mirror of its placement,
+- resources: every updateResourcesInterval, writes the node data of the
+  desktop, with random free resources,
+- reconciler: the reconciler of gcp_wc.reconciler, which runs the
+  placed instances and records their app events,
+- app events: the appEvents loop, posting the app events to /tasks.
+
+Each loop paces itself on the virtual clock and calls, at each iteration,
+the function of its service that makes the Zookeeper requests, for the
+hostname of the desktop: register_zookeeper_service.register,
+evacuation.evacuate, update_resource_service.publish, the Reconciler and
+app_event_service.post.
+
+A scheduler places instances on the present desktops, Poisson arrivals at
+--rate per desktop and hour, follows their events until service_running and
+exits their containers after an exponential lifetime. The instances of a
+desktop whose presence goes away are placed again elsewhere.
+
+Time is virtual: the event loop jumps to its next timer instead of
+sleeping, so an hour of the fleet takes seconds to minutes. For each fleet
+size it reports the requests per simulated second by operation (watch is a
+watch firing), the watches held, the growth of /tasks, the presence churn,
+the scheduling latency (placement to the service_running event in
+Zookeeper) and the CPU the simulation took.
+
+Usage:
+    python benchmarks/bench_fleet.py [--desktops 50,100,200,500]
+        [--minutes N] [--rate N] [--lifetime-minutes N] [--lock-minutes N]
+        [--unlock-minutes N] [--create-ms N] [--start-ms N] [--stop-ms N]
+        [--seed N] [--json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import selectors
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Stubs the Windows modules the services import.
+import bench_agent
+
+from gcp_wc import app_event_service
+from gcp_wc import config
+from gcp_wc import evacuation
+from gcp_wc import loop
+from gcp_wc import node_data
+from gcp_wc import reconciler
+from gcp_wc import register_zookeeper_service
+from gcp_wc import runtime
+from gcp_wc import screen_state
+from gcp_wc import update_resource_service
+from gcp_wc import zk_cache
+from gcp_wc.fake_zookeeper import FakeZooKeeper
+
+SERVERS = '/servers'
+SERVER_PRESENCE = '/server.presence'
+BLACKEDOUT_SERVERS = '/blackedout.servers'
+PLACEMENT = '/placement'
+SCHEDULED = '/scheduled'
+RUNNING = '/running'
+TASKS = '/tasks'
+
+TEMPLATE = b'cpu: 400%\nmemory: 16G\ndisk: 100G\nlabel: desktop\n'
+
+MANIFEST = {
+    'image': 'python',
+    'cpu': '10%',
+    'memory': '100M',
+    'services': [{'name': 'app', 'command': 'run'}],
+}
+
+DIRECTORIES = ('appevents', 'cache', 'cleanup', 'log', 'running')
+
+# Seconds of simulated time between two samples of the tree.
+SAMPLE_INTERVAL = 60
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """Selector advancing the clock of its loop instead of blocking."""
+
+    def __init__(self):
+        super(VirtualSelector, self).__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        ready = super(VirtualSelector, self).select(0)
+        if not ready and timeout:
+            self.now += timeout
+        return ready
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    """Event loop on a virtual clock, jumping from a timer to the next."""
+
+    def __init__(self):
+        self._virtual = VirtualSelector()
+        super(VirtualLoop, self).__init__(self._virtual)
+
+    def time(self):
+        return self._virtual.now
+
+
+class SlowRuntime(object):
+    """A runtime whose requests take simulated time.
+
+    The requests return at once; the time they would have taken adds up,
+    for the loop that made them to sleep it before its next iteration.
+    """
+
+    def __init__(self, client, latencies):
+        """
+        client: FakeRuntime
+        latencies: seconds taken, by request
+        """
+        self.client = client
+        self.latencies = latencies
+        self.owed = 0.0
+
+    def __getattr__(self, name):
+        request = getattr(self.client, name)
+        latency = self.latencies.get(name, 0)
+
+        def slow(*args, **kwargs):
+            self.owed += latency
+            return request(*args, **kwargs)
+        return slow
+
+    def take(self):
+        """Returns the seconds owed, and forgets them."""
+        owed, self.owed = self.owed, 0.0
+        return owed
+
+
+class Pace(object):
+    """A gcp_wc.loop.Loop sleeping on the virtual loop."""
+
+    def __init__(self, name, desktop):
+        self.desktop = desktop
+        self.wake = asyncio.Event()
+        self.timeout = 0
+        self.loop = loop.Loop(name, self._should_stop, desktop.fleet.loop.time)
+
+    def _should_stop(self, timeout):
+        self.timeout = timeout
+        return False
+
+    def notify(self):
+        self.loop.notify()
+        self.wake.set()
+
+    async def sleep(self, worked):
+        self.loop.sleep(worked)
+        if worked:
+            self.desktop.signal(self)
+        try:
+            await asyncio.wait_for(self.wake.wait(), self.timeout / 1000.0)
+        except asyncio.TimeoutError:
+            pass
+        self.wake.clear()
+
+
+class Desktop(object):
+    """A virtual desktop and its agent."""
+
+    def __init__(self, fleet, hostname, root):
+        self.fleet = fleet
+        self.hostname = hostname
+        self.root = root
+        self.rng = random.Random(hostname)
+        for directory in DIRECTORIES:
+            os.makedirs(os.path.join(root, directory))
+        settings = config.current()
+        args = fleet.args
+        self.client = SlowRuntime(runtime.FakeRuntime(), {
+            'create': args.create_ms / 1000.0,
+            'start': args.start_ms / 1000.0,
+            'kill': args.stop_ms / 1000.0,
+            'remove': args.stop_ms / 1000.0,
+        })
+        self.debouncer = screen_state.Debouncer(
+            settings.screenLockSettle / 1000.0, settings.screenUnlockSettle / 1000.0)
+        self.stats = screen_state.LockStatistics()
+        self.min_lock = settings.minLockDuration / 1000.0
+        self.paces = []
+        self.reconciler = None
+
+    def pace(self, name):
+        pace = Pace(name, self)
+        self.paces.append(pace)
+        return pace
+
+    def signal(self, sender):
+        """Wake the other loops of the desktop, as loop.ThreadActivity."""
+        for pace in self.paces:
+            if pace is not sender:
+                pace.wake.set()
+
+    def start(self, locked):
+        zk = self.fleet.zk
+        events = self.pace('appEvents')
+        pace = self.pace('reconciler')
+        self.reconciler = reconciler.Reconciler(
+            zk, self.client, self.hostname,
+            reconciler.Actuator(zk, self.client, self.root, self.hostname),
+            on_change=pace.notify,
+        ).start()
+        now = self.fleet.loop.time()
+        self.raw = screen_state.LOCK if locked else screen_state.UNLOCK
+        self.changed_at = self.locked_at = now
+        return [
+            self.screen(),
+            self.register(),
+            self.watchdog(),
+            self.resources(),
+            self.reconcile(pace),
+            self.app_events(events),
+        ]
+
+    def state(self):
+        return self.debouncer.update(self.raw, self.changed_at, self.fleet.loop.time())
+
+    def advertise(self):
+        if self.state() != screen_state.LOCK:
+            return False
+        return screen_state.worth_advertising(
+            self.stats, self.fleet.loop.time() - self.debouncer.since, self.min_lock)
+
+    async def screen(self):
+        """Lock and unlock the screen, exponential durations."""
+        args = self.fleet.args
+        while True:
+            if self.raw == screen_state.LOCK:
+                mean = args.lock_minutes
+            else:
+                mean = args.unlock_minutes
+            await asyncio.sleep(self.rng.expovariate(1.0 / (mean * 60)))
+            now = self.fleet.loop.time()
+            if self.raw == screen_state.LOCK:
+                self.stats.record(now - self.locked_at)
+                self.raw = screen_state.UNLOCK
+            else:
+                self.locked_at = now
+                self.raw = screen_state.LOCK
+            self.changed_at = now
+
+    async def register(self):
+        """The loop of register_zookeeper_service.run."""
+        pace = self.pace('registerZookeeper')
+        while True:
+            worked = self.advertise() and register_zookeeper_service.register(
+                self.fleet.zk, self.hostname)
+            await pace.sleep(worked)
+
+    async def watchdog(self):
+        """Evacuate the desktop while unlocked, as the watchdog service."""
+        mirror = zk_cache.mirror(self.fleet.zk, self.hostname, self.hostname)
+        while True:
+            if self.state() != screen_state.LOCK:
+                settings = config.current()
+                evacuation.evacuate(
+                    mirror, self.client, self.root, self.hostname,
+                    deadline=settings.evacuationDeadline / 1000.0,
+                    workers=settings.evacuationWorkers,
+                )
+            await asyncio.sleep(self.client.take() + config.current().watchdogInterval / 1000.0)
+
+    async def resources(self):
+        """The loop of update_resource_service.run."""
+        zk = self.fleet.zk
+        template = node_data.from_template(zk.get(SERVERS + '/node')[0])
+        writer = node_data.NodeDataWriter(zk)
+        while True:
+            update_resource_service.publish(writer, template, self.hostname, {
+                'agent_cpu': 0,
+                'agent_memory': 0,
+                'cpu': self.rng.randrange(0, 100),
+                'disk': self.rng.randrange(50000, 51000),
+                'memory': self.rng.randrange(4000, 8000),
+            })
+            await asyncio.sleep(config.current().updateResourcesInterval / 1000.0)
+
+    async def reconcile(self, pace):
+        while True:
+            worked = self.reconciler.tick()
+            await asyncio.sleep(self.client.take())
+            await pace.sleep(worked)
+
+    async def app_events(self, pace):
+        """The loop of app_event_service.run."""
+        while True:
+            await pace.sleep(app_event_service.post(self.fleet.zk, self.root, self.hostname))
+
+
+class Scheduler(object):
+    """Place instances on the present desktops and follow them."""
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.zk = fleet.zk
+        self.rng = random.Random(fleet.args.seed)
+        self.present = set()
+        self.number = 0
+        # name -> host, and the (placed time, timer of the exit) of the
+        # instances of each host
+        self.hosts = {}
+        self.instances = collections.defaultdict(dict)
+        # Instances whose events are watched, until running.
+        self.watching = set()
+        self.latencies = []
+        self.counts = collections.Counter()
+
+    def start(self):
+        self.zk.ChildrenWatch(SERVER_PRESENCE)(self._presence_watcher)
+        return self.arrivals()
+
+    async def arrivals(self):
+        rate = len(self.fleet.desktops) * self.fleet.args.rate / 3600.0
+        while True:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            name = 'proid.sim#%010d' % self.number
+            self.number += 1
+            self.zk.create(SCHEDULED + '/' + name, json.dumps(MANIFEST).encode('utf-8'))
+            self.zk.create(TASKS + '/' + name.replace('#', '/'), makepath=True)
+            self.counts['requested'] += 1
+            self.place(name)
+
+    def place(self, name):
+        if not self.present:
+            self.counts['no desktop'] += 1
+            self.zk.delete(SCHEDULED + '/' + name)
+            return False
+        host = self.rng.choice(sorted(self.present))
+        self.hosts[name] = host
+        self.instances[host][name] = (self.fleet.loop.time(), None)
+        self.zk.create(PLACEMENT + '/' + host + '/' + name, makepath=True)
+        self.counts['placed'] += 1
+        if name not in self.watching:
+            self.watching.add(name)
+            self.zk.ChildrenWatch(TASKS + '/' + name.replace('#', '/'))(self._task_watcher(name))
+        return True
+
+    def _presence_watcher(self, children):
+        children = set(children)
+        self.counts['presence created'] += len(children - self.present)
+        gone = self.present - children
+        self.counts['presence deleted'] += len(gone)
+        self.present = children
+        for host in gone:
+            for name, (_placed, timer) in sorted(self.instances.pop(host, {}).items()):
+                if timer is not None:
+                    timer.cancel()
+                self.counts['placed again'] += 1
+                self.place(name)
+
+    def _task_watcher(self, name):
+        def watcher(children):
+            host = self.hosts.get(name)
+            placed, timer = self.instances.get(host, {}).get(name, (None, None))
+            if placed is None or timer is not None:
+                self.watching.discard(name)
+                return False
+            for child in children:
+                _time, event_host, event_type, data = child.split(',', 3)
+                if event_type != 'service_running' or event_host != host:
+                    continue
+                self.latencies.append(self.fleet.loop.time() - placed)
+                self.counts['running'] += 1
+                lifetime = self.rng.expovariate(1.0 / (self.fleet.args.lifetime_minutes * 60))
+                self.instances[host][name] = (placed, self.fleet.loop.call_later(
+                    lifetime, self.exit, name, host, data.split('.')[0]))
+                self.watching.discard(name)
+                return False
+            return None
+        return watcher
+
+    def exit(self, name, host, container_id):
+        self.instances[host].pop(name, None)
+        self.hosts.pop(name, None)
+        try:
+            self.fleet.desktops[host].client.exit(container_id, 0)
+            self.counts['exited'] += 1
+        except runtime.ContainerError:
+            pass
+
+
+class Fleet(object):
+    """Desktops and a scheduler on one Zookeeper and one virtual loop."""
+
+    def __init__(self, args, size, root):
+        self.args = args
+        self.root = root
+        self.loop = VirtualLoop()
+        asyncio.set_event_loop(self.loop)
+        self.zk = FakeZooKeeper()
+        self.zk.start()
+        for path in (SERVER_PRESENCE, BLACKEDOUT_SERVERS, PLACEMENT, SCHEDULED, RUNNING, TASKS):
+            self.zk.ensure_path(path)
+        self.zk.create(SERVERS + '/node', TEMPLATE, makepath=True)
+        self.desktops = collections.OrderedDict()
+        for number in range(size):
+            hostname = 'desktop-%04d' % number
+            self.desktops[hostname] = Desktop(self, hostname, os.path.join(root, hostname))
+        self.scheduler = Scheduler(self)
+        self.samples = []
+
+    def watches(self):
+        """Returns the number of watches, by kind and top node."""
+        watches = collections.Counter()
+        for kind, by_path in (('data', self.zk._data_watches),
+                              ('children', self.zk._children_watches)):
+            for path, funcs in by_path.items():
+                watches['%s /%s' % (kind, path.split('/')[1])] += len(funcs)
+        return watches
+
+    def sample(self):
+        self.samples.append({
+            'time': self.loop.time(),
+            'requests': sum(self.zk.requests.values()),
+            'watches': sum(self.watches().values()),
+            'tasks': sum(1 for path in self.zk._nodes if path.startswith(TASKS + '/')),
+            'present': len(self.scheduler.present),
+        })
+
+    async def sampler(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def run(self, seconds):
+        rng = random.Random(self.args.seed)
+        locked = self.args.lock_minutes / float(self.args.lock_minutes + self.args.unlock_minutes)
+        coroutines = [self.sampler(), self.scheduler.start()]
+        for desktop in self.desktops.values():
+            coroutines.extend(desktop.start(rng.random() < locked))
+        tasks = [self.loop.create_task(coroutine) for coroutine in coroutines]
+        started = time.process_time()
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+        cpu = time.process_time() - started
+        self.sample()
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        return cpu
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def simulate(args, size):
+    root = tempfile.mkdtemp()
+    try:
+        fleet = Fleet(args, size, root)
+        seconds = args.minutes * 60.0
+        cpu = fleet.run(seconds)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    first, last = fleet.samples[0], fleet.samples[-1]
+    hours = seconds / 3600.0
+    counts = fleet.scheduler.counts
+    churn = counts['presence created'] + counts['presence deleted']
+    return collections.OrderedDict([
+        ('desktops', size),
+        ('requests per s', sum(fleet.zk.requests.values()) / seconds),
+        ('requests per s by operation', dict(
+            (operation, count / seconds) for operation, count in fleet.zk.requests.items())),
+        ('watches', last['watches']),
+        ('watches max', max(sample['watches'] for sample in fleet.samples)),
+        ('watches by node', dict(fleet.watches())),
+        ('tasks znodes', last['tasks']),
+        ('tasks znodes per hour', (last['tasks'] - first['tasks']) / hours),
+        ('present mean', sum(sample['present'] for sample in fleet.samples) / float(
+            len(fleet.samples))),
+        ('presence changes per hour', churn / hours),
+        ('instances', dict(counts - collections.Counter({
+            'presence created': counts['presence created'],
+            'presence deleted': counts['presence deleted']}))),
+        ('latency p50', percentile(fleet.scheduler.latencies, 0.5)),
+        ('latency p95', percentile(fleet.scheduler.latencies, 0.95)),
+        ('cpu seconds', cpu),
+    ])
+
+
+def report(results):
+    print('{:>8} {:>9} {:>8} {:>8} {:>10} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+        'desktops', 'req/s', 'watches', 'tasks', 'tasks/h', 'present', 'churn/h',
+        'p50 s', 'p95 s', 'cpu s'))
+    for result in results:
+        print('{:>8} {:>9.1f} {:>8} {:>8} {:>10.0f} {:>9.1f} {:>9.0f} {:>8} {:>8} {:>8.1f}'.format(
+            result['desktops'], result['requests per s'], result['watches'],
+            result['tasks znodes'], result['tasks znodes per hour'], result['present mean'],
+            result['presence changes per hour'],
+            _seconds(result['latency p50']), _seconds(result['latency p95']),
+            result['cpu seconds']))
+    for result in results:
+        print('%d desktops' % result['desktops'])
+        print('    requests/s  %s' % ', '.join('%s %.1f' % item for item in sorted(
+            result['requests per s by operation'].items(), key=lambda item: -item[1])))
+        print('    watches     %s' % ', '.join('%s %d' % item for item in sorted(
+            result['watches by node'].items())))
+        print('    instances   %s' % ', '.join(
+            '%s %d' % item for item in sorted(result['instances'].items())))
+
+
+def _seconds(value):
+    return '-' if value is None else '%.1f' % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fleet simulator')
+    parser.add_argument('--desktops', default='50,100,200,500',
+                        help='fleet sizes, comma separated')
+    parser.add_argument('--minutes', type=float, default=30,
+                        help='simulated minutes per fleet size')
+    parser.add_argument('--rate', type=float, default=6,
+                        help='instances placed per desktop and hour')
+    parser.add_argument('--lifetime-minutes', type=float, default=10)
+    parser.add_argument('--lock-minutes', type=float, default=20)
+    parser.add_argument('--unlock-minutes', type=float, default=10)
+    parser.add_argument('--create-ms', type=int, default=50)
+    parser.add_argument('--start-ms', type=int, default=200)
+    parser.add_argument('--stop-ms', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    root = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(root, 'configure.json')
+        with open(filename, 'w') as f:
+            json.dump({'workDirectory': root, 'zookeeper': bench_agent.ZOOKEEPER,
+                       'metricsPort': '0', 'loopReportInterval': str(10 ** 9)}, f)
+        config.reload(filename)
+        results = [simulate(args, int(size)) for size in args.desktops.split(',')]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
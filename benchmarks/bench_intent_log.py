@@ -0,0 +1,107 @@
+"""Intent log benchmark.
+
+Restart cost: recover a desktop with a few configurations in flight, from
+the labelled listing of all its containers and from the intent log, at an
+increasing number of instances. Group commit: append durable intents from
+concurrent threads and count the fsyncs.
+
+Usage:
+    python benchmarks/bench_intent_log.py [in flight] [latency ms]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import intent_log
+
+import bench_recovery
+
+
+def crashed(root, instances, in_flight):
+    """Returns the runtime and the intent log of a desktop whose agent died."""
+    client = bench_recovery.crashed_desktop(root, instances)
+    log = intent_log.IntentLog(os.path.join(root, intent_log.INTENTS_DIR, 'appCfgMgr.log'))
+    log.open()
+    for index in range(instances):
+        intent = log.begin('configure', 'proid.app#%010d' % index)
+        if index < in_flight:
+            continue
+        log.done(intent)
+    log.close()
+    return client, log.path
+
+
+def recover_from_log(client, path):
+    log = intent_log.IntentLog(path)
+    for intent in log.open():
+        for summary in client.containers(all=True, filters={
+                'label': ['gcp_wc.instance=' + intent.instance]}):
+            client.remove(summary.id, force=True)
+        log.done(intent)
+    log.close()
+
+
+def restart(instances, in_flight, latency):
+    results = {}
+    for name in ('index', 'intent log'):
+        root = tempfile.mkdtemp()
+        try:
+            client, path = crashed(root, instances, in_flight)
+            client = bench_recovery.LatencyRuntime(client, latency)
+            started = time.time()
+            if name == 'index':
+                bench_recovery.from_index(client, root)
+            else:
+                recover_from_log(client, path)
+            results[name] = ((time.time() - started) * 1000, client.requests)
+        finally:
+            shutil.rmtree(root)
+    return results
+
+
+def group_commit(threads, appends):
+    root = tempfile.mkdtemp()
+    try:
+        log = intent_log.IntentLog(os.path.join(root, 'bench.log'))
+        log.open()
+
+        def append():
+            for _ in range(appends):
+                log.done(log.begin('configure', 'proid.app'))
+        workers = [threading.Thread(target=append) for _ in range(threads)]
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+        log.close()
+        return threads * appends / elapsed, log.syncs
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    in_flight = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001
+    print('{name:<10} {index:>18} {log:>18}'.format(
+        name='instances', index='index ms (req)', log='intent log ms (req)'))
+    for instances in (100, 1000, 5000):
+        results = restart(instances, in_flight, latency)
+        print('{name:<10} {index:>18} {log:>18}'.format(
+            name=instances,
+            index='%.1f (%d)' % results['index'],
+            log='%.1f (%d)' % results['intent log']))
+    for threads in (1, 8):
+        rate, syncs = group_commit(threads, 200)
+        print('%d threads: %d durable appends/s, %d fsyncs for %d appends' % (
+            threads, rate, syncs, threads * 200))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Logging benchmark.
+
+Replay an hour of the log lines of the agent loops: the app event and
+cleanup loops logging the content of their directory every 2 seconds, the
+event daemon synchronizing the placement every minute (changed every 5
+minutes) and the resources written every 10 seconds. Compare the synchronous
+file handler of logging.basicConfig with the queued, throttled pipeline of
+gcp_wc.logs: latency of the log calls in the loops, and bytes logged.
+
+Usage:
+    python benchmarks/bench_logs.py [hours]
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import logging.handlers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import logs
+
+TICK = 2
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def loop_lines(logger, tick, root):
+    """The lines logged by the agent loops during a tick."""
+    events = ['%s/appevents/%d,proid.app#%d,service_running,x' % (root, tick, tick)] \
+        if tick % 150 == 0 else []
+    logger.info('content of %r : %r', root + '/appevents', events)
+    logger.info('content of %r : %r', root + '/cleanup', [])
+    if tick % 30 == 0:
+        apps = ['proid.app#%010d' % index for index in range(tick // 150, tick // 150 + 20)]
+        expected_set = set(apps)
+        current_set = set(apps) if tick % 150 else set(apps[1:])
+        extra = current_set - expected_set
+        missing = expected_set - current_set
+        if logger.name.endswith('before') or extra or missing:
+            logger.info('expected : %s', ','.join(expected_set))
+            logger.info('actual   : %s', ','.join(current_set))
+            logger.info('extra    : %s', ','.join(extra))
+            logger.info('missing  : %s', ','.join(missing))
+    if tick % 5 == 0:
+        logger.info('Update resources infomation %s', 'desktop')
+
+
+def run(hours, mode):
+    root = tempfile.mkdtemp()
+    clock = Clock()
+    devnull = open(os.devnull, 'w')
+    logger = logging.getLogger('bench.' + mode)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter(logs.FORMAT)
+    path = os.path.join(root, 'svc.txt')
+    if mode == 'before':
+        handlers = [logging.FileHandler(path, mode='w'), logging.StreamHandler(devnull)]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+        listener = None
+    else:
+        handlers = [logging.handlers.RotatingFileHandler(path, maxBytes=1 << 30),
+                    logging.StreamHandler(devnull)]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        handler, listener = logs.pipeline(handlers, clock=clock)
+        logger.addHandler(handler)
+    latencies = []
+    try:
+        for tick in range(int(hours * 3600 / TICK)):
+            clock.now = tick * TICK
+            started = time.perf_counter()
+            loop_lines(logger, tick, root)
+            latencies.append(time.perf_counter() - started)
+        if listener is not None:
+            listener.stop()
+        for handler in handlers:
+            handler.close()
+        size = os.path.getsize(path)
+    finally:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        devnull.close()
+        shutil.rmtree(root)
+    latencies.sort()
+    return {
+        'tick latency mean (us)': sum(latencies) / len(latencies) * 1e6,
+        'tick latency p99 (us)': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'log KB/hour': size / 1024.0 / hours,
+    }
+
+
+def main():
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    before = run(hours, 'before')
+    after = run(hours, 'after')
+    print('{name:<24} {before:>10} {after:>10}'.format(name='', before='before', after='after'))
+    for name in sorted(before):
+        print('{name:<24} {before:>10.1f} {after:>10.1f}'.format(
+            name=name, before=before[name], after=after[name]))
+
+
+if __name__ == '__main__':
+    main()
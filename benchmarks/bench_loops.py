@@ -0,0 +1,165 @@
+"""Loop pacing benchmark.
+
+Run the loops of the agent on a scaled clock (1 s stands for 100 s) with
+work arriving now and then: a placement is cached by the event daemon (a
+watch), configured by the app config manager, and its event posted by the
+app event loop; a container exits, found by the state monitor, then cleaned
+up and its event posted. Compare the fixed intervals with the adaptive ones
+of gcp_wc.loop: iterations (wakeups) of the loops, and time from the
+placement to its event posted, and from the exit to its cleanup.
+
+Usage:
+    python benchmarks/bench_loops.py [seconds]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import config
+from gcp_wc import loop
+
+SCALE = 100.0
+
+
+class Desktop(object):
+    """Queues of work between the loops."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = []
+        self.events = []
+        self.cleanup = []
+        self.exited = []
+        self.posted = []
+        self.cleaned = []
+
+    def take(self, name):
+        with self.lock:
+            items, queue = list(getattr(self, name)), getattr(self, name)
+            del queue[:]
+            return items
+
+
+def loops(desktop, stop):
+
+    def sleeper(name):
+        return loop.Loop(name, lambda timeout: stop.wait(timeout / 1000.0))
+
+    def app_cfg_mgr():
+        pace = sleeper('appCfgMgr')
+        while True:
+            items = desktop.take('cache')
+            with desktop.lock:
+                desktop.events.extend(items)
+            if pace.sleep(bool(items)):
+                break
+
+    def app_events():
+        pace = sleeper('appEvents')
+        while True:
+            items = desktop.take('events')
+            now = time.time()
+            with desktop.lock:
+                desktop.posted.extend(now - placed for placed in items)
+            if pace.sleep(bool(items)):
+                break
+
+    def cleanup():
+        pace = sleeper('cleanup')
+        while True:
+            items = desktop.take('cleanup')
+            now = time.time()
+            with desktop.lock:
+                desktop.cleaned.extend(now - exited for exited in items)
+            if pace.sleep(bool(items)):
+                break
+
+    def state_monitor():
+        pace = sleeper('stateMonitor')
+        while True:
+            items = desktop.take('exited')
+            with desktop.lock:
+                desktop.cleanup.extend(items)
+            if pace.sleep(bool(items)):
+                break
+
+    # Its work is done by a watch, see run.
+    desktop.event_daemon = sleeper('eventDaemon')
+
+    def event_daemon():
+        while not desktop.event_daemon.sleep(False):
+            pass
+
+    return [app_cfg_mgr, app_events, cleanup, state_monitor, event_daemon]
+
+
+def run(seconds, adaptive):
+    directory = tempfile.mkdtemp()
+    defaults = dict((setting.name, setting.default) for setting in config.SETTINGS)
+    # Required, unused by the loops.
+    settings = {'workDirectory': directory, 'zookeeper': '127.0.0.1:2181'}
+    for name in ('appCfgMgr', 'appEvents', 'cleanup', 'eventDaemon', 'stateMonitor'):
+        settings[name + 'Interval'] = str(int(2000 / SCALE))
+        maximum = defaults[name + 'MaxInterval'] if adaptive else 2000
+        settings[name + 'MaxInterval'] = str(int(maximum / SCALE))
+    settings['loopReportInterval'] = str(10 ** 9)
+    filename = os.path.join(directory, 'configure.json')
+    with open(filename, 'w') as f:
+        json.dump(settings, f)
+    config.reload(filename)
+    loop.install(loop.ThreadActivity() if adaptive else None)
+
+    desktop = Desktop()
+    stop = threading.Event()
+    threads = [threading.Thread(target=target) for target in loops(desktop, stop)]
+    for thread in threads:
+        thread.start()
+    rng = random.Random(0)
+    deadline = time.time() + seconds
+    try:
+        while time.time() < deadline:
+            time.sleep(rng.expovariate(1 / 1.5))
+            now = time.time()
+            if rng.random() < 0.5:
+                # A placement: the watch of the event daemon caches it.
+                with desktop.lock:
+                    desktop.cache.append(now)
+                desktop.event_daemon.notify()
+            else:
+                with desktop.lock:
+                    desktop.exited.append(now)
+    finally:
+        stop.set()
+        loop.signal()
+        for thread in threads:
+            thread.join()
+        shutil.rmtree(directory)
+    iterations = sum(pace.iterations for pace in loop.loops())
+    return {
+        'wakeups / simulated hour': iterations / (seconds * SCALE / 3600.0),
+        'placement -> event (s)': SCALE * sum(desktop.posted) / max(len(desktop.posted), 1),
+        'exit -> cleanup (s)': SCALE * sum(desktop.cleaned) / max(len(desktop.cleaned), 1),
+        'duty cycle (%)': 100 * sum(pace.busy for pace in loop.loops()) /
+                          sum(pace.busy + pace.idle for pace in loop.loops()),
+    }
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 36
+    before = run(seconds, adaptive=False)
+    after = run(seconds, adaptive=True)
+    print('{name:<28} {before:>10} {after:>10}'.format(name='', before='fixed', after='adaptive'))
+    for name in sorted(before):
+        print('{name:<28} {before:>10.2f} {after:>10.2f}'.format(
+            name=name, before=before[name], after=after[name]))
+
+
+if __name__ == '__main__':
+    main()
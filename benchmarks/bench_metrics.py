@@ -0,0 +1,94 @@
+"""Metrics overhead benchmark.
+
+Time the recording of the metrics on their own (counter, labelled child,
+histogram), then the overhead they add to a Zookeeper read against the in
+memory Zookeeper and to a Docker call against an API answering at once:
+the worst case, the real requests taking a round trip. Check the
+exposition of the registry is served.
+
+Usage:
+    python benchmarks/bench_metrics.py [calls]
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import metrics
+from gcp_wc import runtime
+from gcp_wc.fake_zookeeper import FakeZooKeeper
+
+
+class Api(object):
+    """Docker API client answering at once."""
+
+    def inspect_container(self, container_id):
+        return {'State': {'Status': runtime.RUNNING}}
+
+
+def docker_runtime():
+    """Returns a DockerRuntime of Api, without the docker package."""
+    client = runtime.DockerRuntime.__new__(runtime.DockerRuntime)
+    client.api = Api()
+    client._not_found = KeyError
+    client._errors = (IOError,)
+    return client
+
+
+def per_call(function, calls):
+    """Returns the microseconds of a call of function, best of 5."""
+    return min(timeit.repeat(function, number=calls, repeat=5)) / calls * 1e6
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    counter = metrics.counter('bench_total', 'Benchmark.')
+    labelled = metrics.counter('bench_labelled_total', 'Benchmark.', ('name',))
+    child = labelled.labels('a')
+    histogram = metrics.histogram('bench_seconds', 'Benchmark.')
+    results = [
+        ('counter inc', per_call(counter.inc, calls)),
+        ('labels(...).inc', per_call(lambda: labelled.labels('a').inc(), calls)),
+        ('child inc', per_call(child.inc, calls)),
+        ('histogram observe', per_call(lambda: histogram.observe(0.003), calls)),
+    ]
+
+    zk = FakeZooKeeper()
+    zk.start()
+    zk.create('/node', b'data')
+    instrumented = metrics.zookeeper(zk)
+    bare = per_call(lambda: zk.get('/node'), calls)
+    timed = per_call(lambda: instrumented.get('/node'), calls)
+    results += [
+        ('zookeeper get', bare),
+        ('zookeeper get, recorded', timed),
+    ]
+
+    client = docker_runtime()
+    api = client.api
+    bare = per_call(lambda: api.inspect_container('id')['State']['Status'], calls)
+    timed = per_call(lambda: client.state('id'), calls)
+    results += [
+        ('docker state', bare),
+        ('docker state, recorded', timed),
+    ]
+
+    for name, micros in results:
+        print('{name:<28} {micros:>8.2f} us'.format(name=name, micros=micros))
+
+    server = metrics.MetricsServer(0).start()
+    try:
+        from urllib.request import urlopen
+        started = time.time()
+        body = urlopen('http://%s:%d/metrics' % server.address).read().decode('utf-8')
+        print('{name:<28} {ms:>8.2f} ms, {lines} lines'.format(
+            name='scrape', ms=(time.time() - started) * 1000, lines=len(body.splitlines())))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
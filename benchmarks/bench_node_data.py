@@ -0,0 +1,66 @@
+"""Node data benchmark.
+
+Measure the parse and serialize round trip of the /servers/<hostname> node
+data, against the former string slicing.
+
+Usage:
+    python benchmarks/bench_node_data.py [number]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import node_data
+
+TEMPLATE = (
+    b'cpu: 0%\n'
+    b'disk: 0M\n'
+    b'label: ~\n'
+    b'memory: 0M\n'
+    b'parent: rack:unknown\n'
+    b'partition: _default\n'
+    b'traits: []\n'
+    b'up_since: 0\n'
+)
+
+RESOURCES = {
+    'agent_cpu': 12,
+    'agent_memory': 300,
+    'cpu': 75,
+    'disk': 102400,
+    'memory': 4096,
+}
+
+
+def string_slicing():
+    desktop_data = TEMPLATE.decode().replace('~', 'windows', 1)
+    update_info = 'cpu: {cpuinfo}%\ndisk: {diskinfo}M\nlabel: windows\nmemory: {meminfo}M\n'.format(
+        cpuinfo=RESOURCES['cpu'], diskinfo=RESOURCES['disk'], meminfo=RESOURCES['memory'])
+    return (update_info + desktop_data[desktop_data.find('parent'):]).encode('utf-8')
+
+
+def parse():
+    return node_data.NodeData.parse(TEMPLATE)
+
+
+def round_trip():
+    return node_data.NodeData.parse(TEMPLATE).merge(resources=RESOURCES, label=node_data.DESKTOP_LABEL).serialize()
+
+
+def cached_round_trip():
+    return node_data.from_template(TEMPLATE).merge(resources=RESOURCES, label=node_data.DESKTOP_LABEL).serialize()
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for bench in (string_slicing, parse, round_trip, cached_round_trip):
+        elapsed = min(timeit.repeat(bench, number=number, repeat=3))
+        print('{name:<20} {usec:10.1f} us/op'.format(
+            name=bench.__name__, usec=elapsed / number * 1e6))
+    assert node_data.NodeData.parse(round_trip()) == node_data.NodeData.parse(round_trip())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Crash recovery benchmark.
+
+Leave the work directory and the containers of a desktop as an agent that
+died would: most instances running with their manifest, some containers
+created but without a running manifest, some whose instance was unscheduled
+meanwhile, and some duplicated. Then compare recovering from the running
+manifests (parse each of them, inspect each container) with recovering from
+the labelled listing of gcp_wc.instance_index, against an engine with a
+simulated request latency.
+
+Usage:
+    python benchmarks/bench_recovery.py [instances] [latency ms]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import instance_index
+from gcp_wc import runtime
+
+HOSTNAME = 'desktop'
+# Per thousand instances.
+UNRECORDED = 10
+UNSCHEDULED = 5
+DUPLICATED = 5
+
+
+class LatencyRuntime(object):
+    """Delay and count the requests made to a runtime."""
+
+    def __init__(self, client, latency):
+        self.client = client
+        self.latency = latency
+        self.requests = 0
+
+    def __getattr__(self, name):
+        request = getattr(self.client, name)
+
+        def delayed(*args, **kwargs):
+            self.requests += 1
+            time.sleep(self.latency)
+            return request(*args, **kwargs)
+        return delayed
+
+
+def manifest(index):
+    return {
+        'image': 'python',
+        'cpu': '10%',
+        'memory': '100M',
+        'services': [{'name': 'app', 'command': 'python app.py %d' % index}],
+        'endpoints': [{'port': 8000 + index % 1000}],
+    }
+
+
+def crashed_desktop(root, instances):
+    """Returns the runtime of a desktop whose agent died."""
+    for directory in (instance_index.CACHE_DIR, instance_index.RUNNING_DIR):
+        os.makedirs(os.path.join(root, directory))
+    client = runtime.FakeRuntime()
+    unrecorded = instances * UNRECORDED // 1000
+    unscheduled = unrecorded + instances * UNSCHEDULED // 1000
+    duplicated = unscheduled + instances * DUPLICATED // 1000
+    for index in range(instances):
+        instance_name = 'proid.app#%010d' % index
+        manifest_data = manifest(index)
+        labels = instance_index.labels(instance_name, manifest_data, HOSTNAME)
+        container_id = client.create(manifest_data['image'], labels=labels)
+        # Half of the unrecorded containers died before being started.
+        if index >= unrecorded or index % 2:
+            client.start(container_id)
+        if unscheduled <= index < duplicated:
+            client.start(client.create(manifest_data['image'], labels=labels))
+        if index >= unscheduled:
+            manifest_data['container_id'] = container_id
+            with open(os.path.join(root, instance_index.RUNNING_DIR, instance_name), 'w') as f:
+                yaml.dump(manifest_data, stream=f)
+        if not unrecorded <= index < unscheduled:
+            with open(os.path.join(root, instance_index.CACHE_DIR, instance_name), 'w') as f:
+                yaml.dump(manifest(index), stream=f)
+    return client
+
+
+def from_manifests(client, root):
+    """Recover as the agent could without labels: check each manifest."""
+    for instance_name in os.listdir(os.path.join(root, instance_index.RUNNING_DIR)):
+        with open(os.path.join(root, instance_index.RUNNING_DIR, instance_name)) as f:
+            container_id = yaml.safe_load(f)['container_id']
+        try:
+            client.state(container_id)
+        except runtime.NotFound:
+            pass
+    return set()
+
+
+def from_index(client, root):
+    """Recover from the labelled listing, returns the adopted containers."""
+    adopted, _removed = instance_index.recover(client, root, HOSTNAME)
+    return set(container_id for container_id, _manifest in adopted.values())
+
+
+def run(instances, latency, recover):
+    root = tempfile.mkdtemp()
+    try:
+        client = LatencyRuntime(crashed_desktop(root, instances), latency)
+        started = time.time()
+        known = recover(client, root)
+        elapsed = time.time() - started
+        for instance_name in os.listdir(os.path.join(root, instance_index.RUNNING_DIR)):
+            with open(os.path.join(root, instance_index.RUNNING_DIR, instance_name)) as f:
+                known.add(yaml.safe_load(f)['container_id'])
+        containers = client.client.containers(all=True)
+        return {
+            'recovery (ms)': elapsed * 1000,
+            'engine requests': client.requests,
+            'containers left': len(containers),
+            'leaked containers': len([c for c in containers if c.id not in known]),
+            'created not started': len([c for c in containers if c.state == runtime.CREATED]),
+        }
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001
+    manifests = run(instances, latency, from_manifests)
+    index = run(instances, latency, from_index)
+    print('{name:<20} {manifests:>12} {index:>12}'.format(
+        name='', manifests='manifests', index='index'))
+    for name in sorted(manifests):
+        print('{name:<20} {manifests:>12.1f} {index:>12.1f}'.format(
+            name=name, manifests=manifests[name], index=index[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,843 @@
+"""Replay benchmark.
+
+Replay a trace of gcp_wc.recording against the fakes, to compare the
+behavior and the latencies of agent versions on the exact placements,
+exits and revocations a desktop saw.
+
+The calls of the trace tell what the rest of the world did: a read or a
+watch showing a node the agent did not write, a listing showing a container
+exited, are changes made by the scheduler or Docker. These are the
+stimuli; they happen at the ctime or mtime of their node when known, when
+the agent saw them otherwise (a container exit at "Exited (0) N seconds
+ago"). The writes of the --external traces, e.g. the watchdog's when only
+the agent host is replayed, are stimuli too.
+
+The agent host workers of the configuration then run on Linux as in
+benchmarks/bench_agent.py, against FakeZooKeeper and FakeRuntime, while
+the stimuli are applied at their times. A stimulus about an instance
+whose container ran when it happened, e.g. its exit or its revocation,
+waits until the container runs in the replay, at most --wait seconds, so
+that the replay keeps the order of the recording when the agent is slower.
+At --speed N the stimuli, the loop intervals and the waits of the
+services (the *Interval and *Delay settings) are N times closer; the
+latencies of the replay are given in the time of the recording, and only
+compare at the same speed, the fakes and the floors of the loops not
+scaling. A stimulus applied after its --wait leaves its instance
+inconclusive: its writes are not compared. The traffic of the replay is
+recorded in turn, and both are analyzed alike:
+
+- behavior: the writes of the agent to Zookeeper and Docker, by instance,
+  the host and the times left out, in no order since the services run
+  concurrently; the writes about the host, only which ones,
+- latencies: placement to service_running event, container exit to its
+  terminal event, revocation to the removal of the container.
+
+--save writes the analysis of the replay, --baseline compares it to the
+one saved by another version: the instances whose writes differ, and the
+latencies. The exit status is 1 when the behavior differs or a median
+latency is over the baseline's by more than --tolerance, for CI.
+
+--record writes a trace to replay: bench_agent's scenario on the fakes,
+the agent recorded until --settle seconds after the last revocation.
+
+Usage:
+    python benchmarks/bench_replay.py <trace>... [--external TRACE]...
+        [--speed N] [--settle S] [--wait S] [--config FILE] [--save FILE]
+        [--baseline FILE] [--tolerance F] [--json]
+    python benchmarks/bench_replay.py --record FILE [--rounds N] [--settle S]
+"""
+import os
+import re
+import sys
+import json
+import time
+import bisect
+import shutil
+import socket
+import logging
+import argparse
+import tempfile
+import collections
+
+# Stubs the Windows modules; its scenario is the one of --record.
+import bench_agent
+
+from gcp_wc import agent_host
+from gcp_wc import config
+from gcp_wc import instance_index
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import recording
+from gcp_wc import runtime
+from gcp_wc import screen_state
+from gcp_wc.fake_zookeeper import FakeZooKeeper
+
+HOSTNAME = socket.gethostname()
+HOST = '<host>'
+
+PLACEMENT = '/placement/'
+TASKS = '/tasks/'
+
+TERMINAL_EVENTS = ('aborted', 'finished', 'killed')
+
+ZOOKEEPER_WRITES = ('create', 'delete', 'ensure_path', 'set', 'transaction')
+RUNTIME_WRITES = ('create', 'kill', 'pause', 'remove', 'start', 'unpause', 'update')
+
+# Fields of a ZnodeStat, and of a ContainerSummary.
+CTIME, MTIME = 2, 3
+SUMMARY_ID, SUMMARY_STATE, SUMMARY_STATUS, SUMMARY_LABELS, SUMMARY_EXIT_CODE = range(5)
+
+_AGO = re.compile(r'^Exited \(-?\d+\) (\d+|an?) (second|minute|hour)s? ago')
+_UNITS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+# Median seconds a stage may be slower than in the baseline, on top of the
+# tolerance, for the jitter of the loops.
+SLACK = 0.5
+
+# Seconds run after the last stimulus at any speed, for the reactions the
+# speed does not scale, e.g. the container exits of the fakes.
+MIN_SETTLE = 10
+
+Call = collections.namedtuple('Call', 'time kind operation args kwargs result error taken external')
+
+# A change of the rest of the world; applied once the instance it is about
+# has a running container if it had one then.
+Stimulus = collections.namedtuple('Stimulus', 'time action args instance running')
+
+
+def load(paths, external=()):
+    """Returns the hostname of the traces and their calls, in time order.
+
+    The times are seconds since the start of the earliest trace.
+    """
+    traces = [(path, False) for path in paths] + [(path, True) for path in external]
+    loaded = [(recording.read(path), is_external) for path, is_external in traces]
+    start = min(header['start'] for (header, _calls), _ in loaded)
+    calls = []
+    for (header, records), is_external in loaded:
+        offset = header['start'] - start
+        for record in records:
+            ms, kind, operation, args, kwargs, result, error, taken = record
+            calls.append(Call(offset + ms / 1000.0, kind, operation, args, kwargs,
+                              result, error, taken / 1000.0, is_external))
+    calls.sort(key=lambda call: call.time)
+    return loaded[0][0][0]['hostname'], start, calls
+
+
+def _argument(call, index, name, default=None):
+    if len(call.args) > index:
+        return call.args[index]
+    return call.kwargs.get(name, default)
+
+
+class Inference(object):
+    """Infer the stimuli of a trace from a model of Zookeeper and Docker."""
+
+    def __init__(self, calls, start):
+        self.calls = calls
+        self.start = start
+        # path -> data, None if unknown
+        self.nodes = {}
+        # container id -> [state, exit code, labels, time last seen]
+        self.containers = {}
+        # (time, action, args...) in time order
+        self.stimuli = []
+        self._writes = collections.defaultdict(list)
+        self._observed = collections.defaultdict(list)
+        for call in calls:
+            if call.error is not None:
+                continue
+            if call.kind == 'zk' and call.operation in ZOOKEEPER_WRITES and not call.external:
+                for path in written(call):
+                    self._writes[path].append(call.time)
+            elif call.kind == 'zk' and call.operation == 'get':
+                self._observed[call.args[0]].append((call.time, call.result[0], call.result[1]))
+            elif call.kind == 'watch' and call.operation == 'data' and call.result[1]:
+                self._observed[call.args[0]].append((call.time, call.result[0], call.result[1]))
+
+    def run(self):
+        """Returns the stimuli, in time order."""
+        for call in self.calls:
+            if call.error is not None:
+                self._failed(call)
+            elif call.kind == 'zk':
+                self._zookeeper(call)
+            elif call.kind == 'watch':
+                self._watch(call)
+            elif call.kind == 'docker':
+                self._docker(call)
+        self.stimuli.sort(key=lambda stimulus: stimulus.time)
+        return self.stimuli
+
+    def _racing(self, path, call):
+        """Returns True if the agent writes path while call runs."""
+        times = self._writes.get(path, ())
+        index = bisect.bisect_left(times, call.time)
+        return index < len(times) and times[index] <= call.time + call.taken
+
+    def _stimulus(self, when, action, *args):
+        if action in ('exit', 'remove_container', 'add_container'):
+            instance = args[0] if action != 'add_container' else _instance(args[0])
+        else:
+            instance = _path_instance(args[0])
+        running = action in ('exit', 'remove_container') or (
+            action == 'delete' and instance is not None and any(
+                _instance(container[2]) == instance and
+                container[0] in (runtime.RUNNING, runtime.PAUSED)
+                for container in self.containers.values()))
+        self.stimuli.append(Stimulus(max(when, 0.0), action, args, instance, running))
+
+    def _external(self, call, *action):
+        if call.external:
+            self._stimulus(call.time, *action)
+
+    def _since_start(self, epoch_ms, call):
+        """Returns the time of a ctime or mtime, at most the call's."""
+        return min(epoch_ms / 1000.0 - self.start, call.time)
+
+    # Zookeeper.
+
+    def _zookeeper(self, call):
+        operation = call.operation
+        if operation == 'create':
+            data = recording.decode(_argument(call, 1, 'value', '')) or b''
+            makepath = _argument(call, 5, 'makepath', False)
+            if not makepath and not call.external:
+                self._implied(call.result)
+            self._create(call.result, data, makepath)
+            self._external(call, 'create', call.result, data)
+        elif operation == 'ensure_path':
+            self._create(call.args[0], b'', True)
+            self._external(call, 'create', call.args[0], b'')
+        elif operation == 'set':
+            data = recording.decode(_argument(call, 1, 'value'))
+            self.nodes[call.args[0]] = data
+            self._external(call, 'set', call.args[0], data)
+        elif operation == 'delete':
+            self._delete(call.args[0])
+            self._external(call, 'delete', call.args[0])
+        elif operation == 'transaction':
+            for operation, result in zip(call.args, call.result or ()):
+                if isinstance(result, str) and not result.startswith('/'):
+                    continue
+                if operation[0] == 'create':
+                    data = recording.decode(operation[2] if len(operation) > 2 else '') or b''
+                    self._create(result, data, False)
+                    self._external(call, 'create', result, data)
+                elif operation[0] == 'delete':
+                    self._delete(operation[1])
+                    self._external(call, 'delete', operation[1])
+                elif operation[0] == 'set_data':
+                    self.nodes[operation[1]] = recording.decode(operation[2])
+                    self._external(call, 'set', operation[1], self.nodes[operation[1]])
+        elif operation == 'exists':
+            self._exists(call, call.args[0], call.result)
+        elif operation == 'get':
+            self._data(call, call.args[0], call.result[0], call.result[1])
+        elif operation == 'get_children':
+            self._children(call, call.args[0], call.result)
+
+    def _watch(self, call):
+        if call.operation == 'data':
+            data, stat = call.result
+            if stat is None:
+                self._exists(call, call.args[0], None)
+            else:
+                self._data(call, call.args[0], data, stat)
+        else:
+            self._children(call, call.args[0], call.result)
+
+    def _failed(self, call):
+        if call.kind == 'docker':
+            container_id = call.args[0] if call.args else None
+            if call.error == 'NotFound' and container_id in self.containers:
+                self._container_gone(call, container_id)
+            return
+        if call.kind != 'zk' or not call.args or call.operation == 'transaction':
+            return
+        path = call.args[0]
+        if call.error == 'NoNodeError':
+            if call.operation == 'create':
+                path = path.rsplit('/', 1)[0]
+            if path in self.nodes and not self._racing(path, call):
+                self._delete(path)
+                self._stimulus(call.time, 'delete', path)
+        elif call.error == 'NodeExistsError' and call.operation == 'create':
+            if path not in self.nodes and not self._racing(path, call):
+                self._appeared(call, path)
+
+    def _exists(self, call, path, stat):
+        if self._racing(path, call):
+            return
+        if stat is None and path in self.nodes:
+            self._delete(path)
+            self._stimulus(call.time, 'delete', path)
+        elif stat is not None and path not in self.nodes:
+            self._appeared(call, path, stat=stat)
+
+    def _data(self, call, path, data, stat):
+        if self._racing(path, call):
+            return
+        data = recording.decode(data)
+        if path not in self.nodes:
+            self._appeared(call, path, data, stat)
+        elif self.nodes[path] is None:
+            self.nodes[path] = data
+        elif self.nodes[path] != data:
+            self.nodes[path] = data
+            self._stimulus(self._since_start(stat[MTIME], call), 'set', path, data)
+
+    def _children(self, call, path, children):
+        if self._racing(path, call):
+            return
+        prefix = path.rstrip('/') + '/'
+        known = set(
+            node[len(prefix):] for node in self.nodes
+            if node.startswith(prefix) and '/' not in node[len(prefix):]
+        )
+        for child in sorted(set(children) - known):
+            if not self._racing(prefix + child, call):
+                self._appeared(call, prefix + child)
+        for child in sorted(known - set(children)):
+            if not self._racing(prefix + child, call):
+                self._delete(prefix + child)
+                self._stimulus(call.time, 'delete', prefix + child)
+
+    def _appeared(self, call, path, data=None, stat=None):
+        """Create a node made outside of the agent, with its first data seen."""
+        if data is None or stat is None:
+            for seen, seen_data, seen_stat in self._observed.get(path, ()):
+                if seen >= call.time:
+                    data, stat = recording.decode(seen_data), seen_stat
+                    break
+        when = call.time if stat is None else self._since_start(stat[CTIME], call)
+        self._create(path, data, True)
+        self._stimulus(when, 'create', path, data or b'')
+
+    def _implied(self, path):
+        """Create the missing parents of a node the agent created: they
+        were there, from the start as far as the agent can tell.
+        """
+        missing = []
+        parent = path.rsplit('/', 1)[0]
+        while parent and parent not in self.nodes:
+            missing.append(parent)
+            parent = parent.rsplit('/', 1)[0]
+        for node in reversed(missing):
+            self.nodes[node] = b''
+            self._stimulus(0.0, 'create', node, b'')
+
+    def _create(self, path, data, makepath):
+        parent = path.rsplit('/', 1)[0]
+        while makepath and parent and parent not in self.nodes:
+            self.nodes[parent] = b''
+            parent = parent.rsplit('/', 1)[0]
+        self.nodes[path] = data
+
+    def _delete(self, path):
+        prefix = path + '/'
+        for node in [node for node in self.nodes if node == path or node.startswith(prefix)]:
+            del self.nodes[node]
+
+    # Docker.
+
+    def _docker(self, call):
+        operation = call.operation
+        if operation == 'create':
+            labels = _argument(call, 3, 'labels') or {}
+            self.containers[call.result] = [runtime.CREATED, None, labels, call.time]
+            return
+        if operation == 'containers':
+            for summary in call.result:
+                self._seen(call, summary[SUMMARY_ID], summary[SUMMARY_STATE],
+                           summary[SUMMARY_EXIT_CODE], summary[SUMMARY_LABELS],
+                           summary[SUMMARY_STATUS])
+            return
+        container_id = call.args[0]
+        if operation == 'state':
+            self._seen(call, container_id, call.result, None, None, '')
+            return
+        container = self.containers.get(container_id)
+        if container is None:
+            return
+        state = {
+            'start': runtime.RUNNING,
+            'kill': runtime.EXITED,
+            'pause': runtime.PAUSED,
+            'unpause': runtime.RUNNING,
+        }.get(operation)
+        if operation == 'remove':
+            del self.containers[container_id]
+            self._external(call, 'remove_container', _instance(container[2]))
+        elif state is not None:
+            container[0] = state
+            container[3] = call.time
+            if operation == 'kill':
+                container[1] = 137
+                self._external(call, 'exit', _instance(container[2]), 137)
+
+    def _seen(self, call, container_id, state, exit_code, labels, status):
+        container = self.containers.get(container_id)
+        if container is None:
+            if labels is None:
+                return
+            self.containers[container_id] = [state, exit_code, labels, call.time]
+            self._stimulus(call.time, 'add_container', labels, state, exit_code)
+            return
+        if state == runtime.EXITED and container[0] in (runtime.RUNNING, runtime.PAUSED):
+            when = call.time
+            match = _AGO.match(status or '')
+            if match:
+                count = 1 if match.group(1) in ('a', 'an') else int(match.group(1))
+                when = max(call.time - count * _UNITS[match.group(2)], container[3])
+            self._stimulus(when, 'exit', _instance(container[2]),
+                           0 if exit_code is None else exit_code)
+        container[0] = state
+        if exit_code is not None:
+            container[1] = exit_code
+        container[3] = call.time
+
+    def _container_gone(self, call, container_id):
+        container = self.containers.pop(container_id)
+        self._stimulus(call.time, 'remove_container', _instance(container[2]))
+
+
+def written(call):
+    """Returns the paths a Zookeeper write wrote."""
+    if call.operation == 'transaction':
+        return [operation[1] for operation in call.args]
+    if call.operation == 'create':
+        return [call.result]
+    return [call.args[0]]
+
+
+def _instance(labels):
+    return (labels or {}).get(instance_index.LABEL_INSTANCE)
+
+
+def _path_instance(path):
+    """Returns the instance a path is about, None if none."""
+    if path.startswith(TASKS):
+        parts = path[len(TASKS):].split('/')
+        if len(parts) >= 2:
+            return '%s#%s' % (parts[0], parts[1])
+        return None
+    name = path.rsplit('/', 1)[-1]
+    return name if '#' in name else None
+
+
+def _normalize(path, hostname):
+    """Returns path with the host and the time of the events left out."""
+    path = path.replace(hostname, HOST)
+    if path.startswith(TASKS) and path.count('/') == 4:
+        parent, node = path.rsplit('/', 1)
+        path = '%s/%s' % (parent, node.split(',')[2])
+    return path
+
+
+def analyze(calls, start, hostname, speed=1.0):
+    """Returns the behavior and the latencies of the agent in a trace.
+
+    The latencies are multiplied by speed, in the time of the recording.
+    """
+    stimuli = Inference(calls, start).run()
+    behavior = collections.defaultdict(list)
+    others = collections.Counter()
+    containers = {}
+    # (instance, kind) -> times of the reactions of the agent
+    reactions = collections.defaultdict(list)
+    for call in calls:
+        if call.external or call.error is not None:
+            continue
+        if call.kind == 'zk' and call.operation in ZOOKEEPER_WRITES:
+            for path in written(call):
+                action = '%s %s' % (call.operation, _normalize(path, hostname))
+                instance = _path_instance(path)
+                if instance is None:
+                    others[action] += 1
+                    continue
+                behavior[instance].append(action)
+                if path.startswith(TASKS) and path.count('/') == 4:
+                    event_type = path.rsplit('/', 1)[1].split(',')[2]
+                    kind = 'running' if event_type == 'service_running' else (
+                        'ended' if event_type in TERMINAL_EVENTS else None)
+                    if kind is not None:
+                        reactions[(instance, kind)].append(call.time)
+        elif call.kind == 'docker' and call.operation in RUNTIME_WRITES:
+            if call.operation == 'create':
+                instance = _instance(_argument(call, 3, 'labels'))
+                containers[call.result] = instance
+            else:
+                instance = containers.get(call.args[0])
+            if instance is None:
+                others['docker %s' % call.operation] += 1
+                continue
+            behavior[instance].append('docker %s' % call.operation)
+            if call.operation == 'remove':
+                reactions[(instance, 'removed')].append(call.time)
+
+    latencies = collections.defaultdict(list)
+    for stimulus in stimuli:
+        instance = stimulus.instance
+        if instance is None:
+            continue
+        if stimulus.action in ('create', 'delete') and stimulus.args[0].startswith(PLACEMENT):
+            stage, kind = ('place', 'running') if stimulus.action == 'create' else (
+                'revoke', 'removed')
+        elif stimulus.action == 'exit':
+            stage, kind = 'exit', 'ended'
+        else:
+            continue
+        when = stimulus.time
+        times = reactions.get((instance, kind), ())
+        index = bisect.bisect_left(times, when)
+        if index < len(times):
+            latencies[stage].append((times[index] - when) * speed)
+    return {
+        'speed': speed,
+        'stimuli': len(stimuli),
+        'behavior': dict((instance, sorted(actions)) for instance, actions in behavior.items()),
+        'others': dict(others),
+        'latencies': dict((stage, _summary(values)) for stage, values in latencies.items()),
+    }
+
+
+def _summary(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'median': values[len(values) // 2],
+        'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+        'max': values[-1],
+    }
+
+
+def _configure(root, args):
+    settings = {}
+    if args.config:
+        with open(args.config) as f:
+            settings = json.load(f)
+    settings.update({
+        'workDirectory': root,
+        'zookeeper': bench_agent.ZOOKEEPER,
+        'metricsPort': '0',
+        'recordTraffic': '0',
+        'loopReportInterval': str(10 ** 9),
+    })
+    defaults = dict((setting.name, setting) for setting in config.SETTINGS)
+    for name, setting in defaults.items():
+        if name.endswith(('Interval', 'Delay')) and name not in (
+                'loopReportInterval', 'profileInterval'):
+            value = int(settings.get(name, setting.default))
+            settings[name] = str(max(int(value / args.speed), setting.minimum or 0))
+    filename = os.path.join(root, 'configure.json')
+    with open(filename, 'w') as f:
+        json.dump(settings, f)
+    config.reload(filename)
+
+
+def _workdir(root):
+    for directory in bench_agent.DIRECTORIES + ('log',):
+        os.makedirs(os.path.join(root, directory))
+    # Locked for long, for the desktop to be advertised.
+    state_file = os.path.join(root, screen_state.screen_state_file)
+    with open(state_file, 'w') as f:
+        f.write(screen_state.LOCK)
+    os.utime(state_file, (time.time() - 3600, time.time() - 3600))
+
+
+class Driver(object):
+    """Apply the stimuli to the fakes."""
+
+    def __init__(self, zk, client, hostname, speed=1.0, wait=60):
+        """
+        zk: FakeZooKeeper
+        client: FakeRuntime
+        hostname: host of the trace, replaced by ours
+        speed: times faster than the recording
+        wait: seconds of the recording a stimulus waits for its instance
+        """
+        self.zk = zk
+        self.client = client
+        self.hostname = hostname
+        self.speed = speed
+        self.wait = wait
+        self.failed = collections.Counter()
+        self.late = 0
+        # Instances with a stimulus applied late, their behavior is moot.
+        self.inconclusive = set()
+
+    def run(self, stimuli, start, supervise):
+        """Apply the stimuli at their times since start, the ones about an
+        instance in order and once it runs if it ran then.
+        """
+        pending = collections.deque(stimuli)
+        waiting = []
+        while pending or waiting:
+            now = time.time() - start
+            while pending and pending[0].time / self.speed <= now:
+                waiting.append(pending.popleft())
+            held, blocked = [], set()
+            for stimulus in waiting:
+                if stimulus.instance in blocked or not self.ready(stimulus):
+                    if (stimulus.time + self.wait) / self.speed > now:
+                        held.append(stimulus)
+                        if stimulus.instance is not None:
+                            blocked.add(stimulus.instance)
+                        continue
+                    self.late += 1
+                    if stimulus.instance is not None:
+                        self.inconclusive.add(stimulus.instance)
+                self.apply(stimulus)
+            waiting = held
+            time.sleep(0.05)
+            supervise()
+
+    def ready(self, stimulus):
+        if not stimulus.running:
+            return True
+        return any(
+            self.client.state(container_id) in (runtime.RUNNING, runtime.PAUSED)
+            for container_id in self._containers(self._local(stimulus.instance))
+        )
+
+    def apply(self, stimulus):
+        args = [self._local(arg) for arg in stimulus.args]
+        try:
+            getattr(self, '_' + stimulus.action)(*args)
+        except Exception as e:
+            self.failed['%s %s' % (stimulus.action, type(e).__name__)] += 1
+
+    def _local(self, value):
+        if isinstance(value, str):
+            return value.replace(self.hostname, HOSTNAME)
+        if isinstance(value, bytes):
+            return value.replace(self.hostname.encode('utf-8'), HOSTNAME.encode('utf-8'))
+        if isinstance(value, dict):
+            return dict((key, self._local(item)) for key, item in value.items())
+        return value
+
+    def _create(self, path, data):
+        if self.zk.exists(path):
+            self.zk.set(path, data)
+        else:
+            self.zk.create(path, data, makepath=True)
+
+    def _set(self, path, data):
+        self.zk.set(path, data)
+
+    def _delete(self, path):
+        self.zk.delete(path, recursive=True)
+
+    def _containers(self, instance):
+        return [
+            summary.id for summary in self.client.containers(all=True, filters={
+                'label': [instance_index.LABEL_INSTANCE + '=' + instance]})
+        ]
+
+    def _exit(self, instance, exit_code):
+        for container_id in self._containers(instance):
+            if self.client.state(container_id) in (runtime.RUNNING, runtime.PAUSED):
+                self.client.exit(container_id, exit_code)
+
+    def _remove_container(self, instance):
+        for container_id in self._containers(instance):
+            self.client.remove(container_id, force=True)
+
+    def _add_container(self, labels, state, exit_code):
+        container_id = self.client.create(image='replayed', labels=labels)
+        if state in (runtime.RUNNING, runtime.PAUSED, runtime.EXITED):
+            self.client.start(container_id)
+        if state == runtime.EXITED:
+            self.client.exit(container_id, exit_code or 0)
+
+
+def replay(args, hostname, stimuli):
+    """Run the agent on the fakes with the stimuli, returns its trace and
+    the instances whose stimuli were applied late.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        _workdir(root)
+        _configure(root, args)
+        fake_zk = FakeZooKeeper()
+        fake_zk.start()
+        fake_client = runtime.FakeRuntime()
+        driver = Driver(fake_zk, fake_client, hostname, args.speed, args.wait)
+        # The stimuli at the start are the state the agent started with.
+        pending = collections.deque(stimuli)
+        while pending and pending[0].time <= 0:
+            driver.apply(pending.popleft())
+        path = os.path.join(root, 'log', 'replay.trace')
+        trace = recording.Trace(path, 2 ** 40)
+        zk = recording.RecordingZooKeeper(metrics.zookeeper(fake_zk), trace)
+        client = recording.RecordingRuntime(fake_client, trace)
+        loop.install(loop.ThreadActivity())
+        host = agent_host.AgentHost(root, zk, client, agent_host.workers())
+        host.start()
+        try:
+            driver.run(pending, trace.start, host.supervise)
+            time.sleep(max(args.settle / args.speed, MIN_SETTLE))
+        finally:
+            host.stop()
+            trace.close()
+        if driver.failed or driver.late:
+            logging.warning('Stimuli failed: %s, applied late: %d', dict(driver.failed), driver.late)
+        header, records = recording.read(path)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    calls = [Call(ms / 1000.0, kind, operation, call_args, kwargs, result, error,
+                  taken / 1000.0, False)
+             for ms, kind, operation, call_args, kwargs, result, error, taken in records]
+    calls.sort(key=lambda call: call.time)
+    return header['start'], calls, driver.inconclusive
+
+
+def record(args):
+    """Record bench_agent's scenario to args.record."""
+    root = tempfile.mkdtemp()
+    try:
+        _workdir(root)
+        _configure(root, args)
+        fake_zk = FakeZooKeeper()
+        fake_zk.start()
+        fake_client = runtime.FakeRuntime()
+        fake_zk.create('/servers/node', b'cpu: 400%\nmemory: 16G\ndisk: 100G\n', makepath=True)
+        scheduler = bench_agent.Scheduler(fake_zk, fake_client, root, args.rounds)
+        trace = recording.Trace(args.record, 2 ** 40)
+        zk = recording.RecordingZooKeeper(metrics.zookeeper(fake_zk), trace)
+        client = recording.RecordingRuntime(fake_client, trace)
+        loop.install(loop.ThreadActivity())
+        host = agent_host.AgentHost(root, zk, client, agent_host.workers())
+        host.start()
+        exiting = [instance for instance in scheduler.instances if instance.exit_code is not None]
+        revoked = [instance for instance in scheduler.instances if instance.exit_code is None]
+        try:
+            scheduler.place()
+            bench_agent.wait(scheduler.instances, scheduler.running, 'place', 'placed')
+            for instance in exiting:
+                scheduler.exit(instance)
+            bench_agent.wait(exiting, scheduler.exit_reported, 'exit', 'exited')
+            for instance in revoked:
+                scheduler.revoke(instance)
+            bench_agent.wait(revoked, scheduler.freed, 'revoke', 'revoked')
+            # The reactions after the last stimulus, as the replay runs them.
+            time.sleep(args.settle)
+        finally:
+            host.stop()
+            trace.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print('%s: %d bytes' % (args.record, os.path.getsize(args.record)))
+
+
+def differences(before, after):
+    """Returns the instances whose writes differ, '' for the host's, with
+    their writes before and after. The instances inconclusive in either are
+    left out.
+    """
+    differ = []
+    inconclusive = set(before.get('inconclusive', ())) | set(after.get('inconclusive', ()))
+    for instance in sorted(set(before['behavior']) | set(after['behavior'])):
+        if instance in inconclusive:
+            continue
+        if before['behavior'].get(instance) != after['behavior'].get(instance):
+            differ.append((instance, before['behavior'].get(instance),
+                           after['behavior'].get(instance)))
+    if set(before['others']) != set(after['others']):
+        differ.append(('', sorted(before['others']), sorted(after['others'])))
+    return differ
+
+
+def compare(baseline, current, tolerance):
+    """Returns the differences of current from baseline, as lines."""
+    lines = []
+    if baseline.get('speed') != current['speed']:
+        lines.append('speed %s, baseline at %s: the latencies do not compare' % (
+            current['speed'], baseline.get('speed')))
+    for instance, before, after in differences(baseline, current):
+        lines.append('behavior %s:\n    baseline %s\n    current  %s' % (
+            instance or 'of the host', before, after))
+    for stage, summary in sorted(current['latencies'].items()):
+        before = baseline['latencies'].get(stage)
+        if before is None:
+            continue
+        if summary['median'] > before['median'] * (1 + tolerance) + SLACK:
+            lines.append('latency %s: median %.2f s, baseline %.2f s' % (
+                stage, summary['median'], before['median']))
+    return lines
+
+
+def report(results):
+    names = list(results)
+    print('{:<8} {}'.format('', ''.join('{:>30}'.format(name) for name in names)))
+    stages = sorted(set(stage for result in results.values() for stage in result['latencies']))
+    for stage in stages:
+        cells = []
+        for name in names:
+            summary = results[name]['latencies'].get(stage)
+            cells.append('{:>30}'.format('-' if summary is None else '%d  p50 %.2f  p95 %.2f s' % (
+                summary['count'], summary['median'], summary['p95'])))
+        print('{:<8} {}'.format(stage, ''.join(cells)))
+    print('{:<8} {}'.format('stimuli', ''.join(
+        '{:>30}'.format(results[name]['stimuli']) for name in names)))
+    differ = differences(results['recorded'], results['replayed'])
+    print('behavior of the replay: %s' % (
+        'as recorded' if not differ else 'differs for %s' % ', '.join(
+            instance or 'the host' for instance, _before, _after in differ)))
+    inconclusive = results['replayed'].get('inconclusive')
+    if inconclusive:
+        print('inconclusive, stimuli applied after --wait: %s' % ', '.join(inconclusive))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay benchmark')
+    parser.add_argument('traces', nargs='*', help='traces of the replayed processes')
+    parser.add_argument('--external', action='append', default=[],
+                        help='trace of a process not replayed, its writes are stimuli')
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--settle', type=float, default=30,
+                        help='seconds run after the last stimulus, recorded time')
+    parser.add_argument('--wait', type=float, default=60,
+                        help='seconds a stimulus waits for its instance to run, recorded time')
+    parser.add_argument('--config', help='configure.json of the agent')
+    parser.add_argument('--save', help='file to save the analysis of the replay to')
+    parser.add_argument('--baseline', help='analysis saved by another version')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--record', help='record bench_agent\'s scenario to this file')
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.record:
+        record(args)
+        return 0
+    if not args.traces:
+        parser.error('a trace is needed')
+    hostname, start, calls = load(args.traces, args.external)
+    results = collections.OrderedDict()
+    results['recorded'] = analyze(calls, start, hostname)
+    stimuli = Inference(calls, start).run()
+    replay_start, replay_calls, inconclusive = replay(args, hostname, stimuli)
+    results['replayed'] = analyze(replay_calls, replay_start, HOSTNAME, args.speed)
+    results['replayed']['inconclusive'] = sorted(inconclusive)
+    differences = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['baseline'] = json.load(f)
+        differences = compare(results['baseline'], results['replayed'], args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results['replayed'], f, indent=4, sort_keys=True)
+    if args.json:
+        print(json.dumps(dict(results, differences=differences), indent=4, sort_keys=True))
+    else:
+        report(results)
+        for line in differences:
+            print(line)
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Service control benchmark.
+
+Time a watchdog tick over the agent's services: one status query per
+service, as the watchdog did before the service group, against the single
+EnumServicesStatusEx of ServiceGroup.refresh. The Service Control Manager is
+a stub of pywin32's win32service, with its argument order and types and a
+latency per call, so that it runs anywhere. Exits with 1 when the group
+does not get the status of every service from the stub.
+
+Usage:
+    python benchmarks/bench_service_control.py [ticks] [call ms]
+"""
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gcp_wc import service_control
+
+SERVICES = [
+    'AppCfgMgrService',
+    'AppeventService',
+    'CleanupService',
+    'EventDaemonService',
+    'RegisterZookeeperService',
+    'StateMonitorService',
+    'UpdateResourcesService',
+    'ScreenMonitorService',
+]
+
+
+class error(Exception):
+    """pywintypes.error"""
+    pass
+
+
+def win32service(latency):
+    """Returns a stub of win32service, every call taking latency seconds."""
+    module = types.ModuleType('win32service')
+    module.error = error
+    module.SC_MANAGER_ALL_ACCESS = 0xF003F
+    module.SERVICE_WIN32 = 0x30
+    module.SERVICE_STATE_ALL = 3
+    module.SC_ENUM_PROCESS_INFO = 0
+    module.SERVICE_STOPPED = 1
+    module.SERVICE_START_PENDING = 2
+    module.SERVICE_STOP_PENDING = 3
+    module.SERVICE_RUNNING = 4
+    module.SERVICE_CONTROL_STOP = 1
+    module.calls = 0
+    states = dict((name, module.SERVICE_RUNNING) for name in SERVICES)
+
+    def call(function):
+        def called(*args):
+            module.calls += 1
+            time.sleep(latency)
+            return function(*args)
+        setattr(module, function.__name__, called)
+        return called
+
+    def expect(value, types_, name):
+        if not isinstance(value, types_):
+            raise TypeError('%s must be %s, not %s' % (
+                name, ' or '.join(t.__name__ for t in types_), type(value).__name__))
+
+    @call
+    def OpenSCManager(machine, database, access):
+        return 'scm'
+
+    @call
+    def OpenService(scm, name, access):
+        return name
+
+    @call
+    def CloseServiceHandle(handle):
+        pass
+
+    @call
+    def EnumServicesStatus(scm, service_type, service_state):
+        return [(name, name, (service_type, states[name], 0, 0, 0, 0, 0)) for name in SERVICES]
+
+    @call
+    def EnumServicesStatusEx(scm, service_type, service_state, info_level, group_name):
+        expect(info_level, (int,), 'InfoLevel')
+        expect(group_name, (str, type(None)), 'GroupName')
+        return [{
+            'ServiceName': name,
+            'DisplayName': name,
+            'ServiceType': service_type,
+            'CurrentState': states[name],
+            'ProcessId': 1000 + number,
+        } for number, name in enumerate(SERVICES)]
+
+    @call
+    def QueryServiceStatus(handle):
+        return (module.SERVICE_WIN32, states[handle], 0, 0, 0, 0, 0)
+
+    return module
+
+
+def main():
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 2) / 1000.0
+    module = sys.modules['win32service'] = win32service(latency)
+    manager = service_control.Win32ServiceControlManager(SERVICES)
+    group = service_control.ServiceGroup(manager, SERVICES)
+
+    def timed(tick):
+        module.calls = 0
+        started = time.time()
+        for _ in range(ticks):
+            tick()
+        return (time.time() - started) * 1000 / ticks, module.calls / float(ticks)
+
+    def per_service():
+        for name in SERVICES:
+            module.QueryServiceStatus(manager.handles[name])
+
+    try:
+        for name, tick in (('per service', per_service), ('group', group.refresh)):
+            ms, calls = timed(tick)
+            print('{name:<12} {ms:>8.2f} ms  {calls:>4.1f} calls per tick'.format(
+                name=name, ms=ms, calls=calls))
+        unknown = [name for name, status in group.refresh().items()
+                   if status != service_control.RUNNING]
+    finally:
+        group.close()
+    if unknown:
+        print('status unknown: %s' % ', '.join(unknown), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Service startup benchmark.
+
+Import each service module in a fresh interpreter, as the service control
+manager does when it starts the service, and report the import time and its
+heaviest imports. The Windows and Docker modules are stubbed, so that it
+runs anywhere. Exits with 1 when a service is over the startup budget.
+
+Usage:
+    python benchmarks/bench_startup.py [budget ms] [runs]
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Import time a service is allowed, in ms.
+STARTUP_BUDGET = 75
+
+SERVICES = [
+    'agent_host',
+    'app_config_manager_service',
+    'app_event_service',
+    'cleanup_service',
+    'event_daemon_service',
+    'monitor_screen_service',
+    'register_zookeeper_service',
+    'state_monitor_service',
+    'update_resource_service',
+    'watchdog_service',
+    'zk_broker_service',
+]
+
+STUBS = '''
+import sys, types
+for name in ('win32serviceutil', 'win32service', 'win32event', 'win32api', 'win32con',
+             'win32gui', 'win32ts', 'docker', 'docker.errors', 'events'):
+    sys.modules[name] = types.ModuleType(name)
+class ServiceFramework(object):
+    pass
+sys.modules['win32serviceutil'].ServiceFramework = ServiceFramework
+sys.modules['docker'].errors = sys.modules['docker.errors']
+sys.modules['docker.errors'].APIError = Exception
+'''
+
+# Imports reported, when imported by the service.
+HEAVY = ('kazoo', 'yaml', 'psutil', 'socketserver', 'concurrent', 'logging')
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| *(\S+)')
+
+
+def measure(service, workdir):
+    """Returns the import time of a service in ms, and the ms spent in
+    each of the HEAVY packages.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT, workDirectory=workdir)
+    code = STUBS + 'import gcp_wc.%s\n' % service
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    ).stderr
+    total = 0.0
+    heavy = {}
+    for match in LINE.finditer(output):
+        cumulative, name = int(match.group(2)), match.group(3)
+        if name == 'gcp_wc.' + service:
+            total = cumulative / 1000.0
+        elif name.split('.')[0] in HEAVY:
+            top = name.split('.')[0]
+            heavy[top] = max(heavy.get(top, 0.0), cumulative / 1000.0)
+    return total, heavy
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else STARTUP_BUDGET
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    workdir = tempfile.mkdtemp()
+    over = []
+    print('{name:<28} {ms:>8}  {heavy}'.format(name='service', ms='ms', heavy='heaviest imports (ms)'))
+    try:
+        for service in SERVICES:
+            results = sorted((measure(service, workdir) for _ in range(runs)),
+                             key=lambda result: result[0])
+            total, heavy = results[len(results) // 2]
+            print('{name:<28} {ms:>8.1f}  {heavy}'.format(
+                name=service, ms=total,
+                heavy=', '.join('%s %.1f' % item for item in
+                                sorted(heavy.items(), key=lambda item: -item[1]))))
+            if total > budget:
+                over.append(service)
+    finally:
+        shutil.rmtree(workdir)
+    if over:
+        print('over the %d ms budget: %s' % (budget, ', '.join(over)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""State API benchmark.
+
+Fill the state index with the instances of a busy host (short-lived
+instances, most of them removed and kept in the history), then time the
+queries operators make, in process and over HTTP: the first page of all the
+instances, the running ones, the ones of an image, a single instance, and
+paging through all of them.
+
+Usage:
+    python benchmarks/bench_state_api.py [instances] [queries]
+"""
+import os
+import sys
+import json
+import time
+import random
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from urllib.request import urlopen
+
+from gcp_wc import metrics
+from gcp_wc import runtime
+from gcp_wc import state_api
+
+IMAGES = ('python', 'nginx', 'java', 'node', 'dotnet')
+
+
+def fill(index, instances, rng):
+    """Place, run and end instances, a tenth still running."""
+    for number in range(instances):
+        name = 'proid.app#%010d' % number
+        manifest_data = {
+            'image': rng.choice(IMAGES), 'cpu': '10%', 'memory': '100M',
+            'services': [{'name': 'app', 'command': 'run'}],
+        }
+        container_id = '%064x' % number
+        index.update(name, manifest_data, None)
+        index.event(name, 'configured', container_id)
+        container = runtime.ContainerSummary(
+            id=container_id, state=runtime.RUNNING, status='', labels={}, exit_code=None)
+        index.update(name, manifest_data, container)
+        if rng.random() < 0.9:
+            index.event(name, 'finished', '0.0')
+            index.update(name, None, None)
+
+
+def timed(function, queries):
+    """Returns the ms of a call of function, median of queries."""
+    times = []
+    for _ in range(queries):
+        started = time.time()
+        function()
+        times.append((time.time() - started) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def page_through(get):
+    after, pages = None, 0
+    while True:
+        page = get(after)
+        pages += 1
+        after = page['next']
+        if after is None:
+            return pages
+
+
+def main():
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    index = state_api.StateIndex(history=instances)
+    started = time.time()
+    fill(index, instances, random.Random(0))
+    print('{name:<24} {ms:>8.2f} ms  {counts}'.format(
+        name='fill', ms=(time.time() - started) * 1000, counts=index.counts()))
+
+    state_api.serve(index)
+    server = metrics.MetricsServer(0).start()
+    url = 'http://%s:%d' % server.address
+
+    def http(path):
+        return json.loads(urlopen(url + path).read().decode('utf-8'))
+
+    cases = collections.OrderedDict([
+        ('first page', (lambda: index.query(),
+                        lambda: http('/instances'))),
+        ('running', (lambda: index.query(states=['running']),
+                     lambda: http('/instances?state=running'))),
+        ('image', (lambda: index.query(image='nginx'),
+                   lambda: http('/instances?image=nginx'))),
+        ('running and image', (lambda: index.query(states=['running'], image='nginx'),
+                               lambda: http('/instances?state=running&image=nginx'))),
+        ('one instance', (lambda: index.get('proid.app#%010d' % (instances // 2)),
+                          lambda: http('/instance?name=proid.app%%23%010d' % (instances // 2)))),
+    ])
+    try:
+        print('{name:<24} {local:>11} {http:>11}'.format(name='', local='in process', http='http'))
+        for name, (local, remote) in cases.items():
+            print('{name:<24} {local:>8.2f} ms {http:>8.2f} ms'.format(
+                name=name, local=timed(local, queries), http=timed(remote, queries)))
+        started = time.time()
+        pages = page_through(lambda after: http(
+            '/instances?limit=1000' + ('' if after is None else '&after=' + after.replace('#', '%23'))))
+        print('{name:<24} {ms:>8.2f} ms  {pages} pages'.format(
+            name='page through, http', ms=(time.time() - started) * 1000, pages=pages))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
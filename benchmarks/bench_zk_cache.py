@@ -0,0 +1,140 @@
+"""Zookeeper cache benchmark.
+
+Replay the reads the agent makes on its placement (children of the
+placement, manifest and placement of each app) against an in memory
+Zookeeper with a simulated round trip time, with the placement being
+changed between the passes, then during an outage. Compare reading directly
+with reading through the ZkCache mirror.
+
+Usage:
+    python benchmarks/bench_zk_cache.py [apps] [passes] [rtt ms]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kazoo.exceptions import ConnectionLoss, NoNodeError
+
+from gcp_wc import zk_cache
+from gcp_wc.fake_zookeeper import FakeZooKeeper
+
+HOSTNAME = 'desktop'
+PLACEMENT = zk_cache.PLACEMENT + '/' + HOSTNAME
+
+
+class LatencyZooKeeper(object):
+    """Delay the reads of a client by the round trip time."""
+
+    def __init__(self, zk, rtt):
+        self.zk = zk
+        self.rtt = rtt
+
+    def __getattr__(self, name):
+        return getattr(self.zk, name)
+
+    def _delayed(self, name, *args, **kwargs):
+        time.sleep(self.rtt)
+        return getattr(self.zk, name)(*args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._delayed('get', *args, **kwargs)
+
+    def exists(self, *args, **kwargs):
+        return self._delayed('exists', *args, **kwargs)
+
+    def get_children(self, *args, **kwargs):
+        return self._delayed('get_children', *args, **kwargs)
+
+
+def place(zk, app):
+    zk.create(zk_cache.SCHEDULED + '/' + app, b'cpu: 10%\nmemory: 100M\n', makepath=True)
+    zk.create(PLACEMENT + '/' + app, b'expires: 0\n', makepath=True)
+
+
+def unplace(zk, app):
+    zk.delete(PLACEMENT + '/' + app)
+    zk.delete(zk_cache.SCHEDULED + '/' + app)
+
+
+def read_placement(zk):
+    """The reads of one synchronization, returns (reads, failures)."""
+    reads = failures = 0
+    try:
+        apps = zk.get_children(PLACEMENT)
+        reads += 1
+    except ConnectionLoss:
+        return 0, 1
+    for app in apps:
+        for read, path in ((zk.get, zk_cache.SCHEDULED + '/' + app),
+                           (zk.exists, PLACEMENT + '/' + app)):
+            try:
+                read(path)
+                reads += 1
+            except NoNodeError:
+                reads += 1
+            except ConnectionLoss:
+                failures += 1
+    return reads, failures
+
+
+def run(apps, passes, rtt, cached):
+    fake = FakeZooKeeper()
+    fake.start()
+    rng = random.Random(0)
+    names = ['proid.app#%010d' % index for index in range(apps)]
+    for app in names:
+        place(fake, app)
+    zk = LatencyZooKeeper(fake, rtt)
+    if cached:
+        zk = zk_cache.ZkCache(zk, HOSTNAME).start()
+    fake.requests.clear()
+
+    reads = failures = 0
+    elapsed = 0.0
+    for index in range(passes):
+        # The scheduler moves one app.
+        unplace(fake, names.pop(rng.randrange(len(names))))
+        names.append('proid.app#%010d' % (apps + index))
+        place(fake, names[-1])
+        started = time.time()
+        done, failed = read_placement(zk)
+        elapsed += time.time() - started
+        reads += done
+        failures += failed
+    requests = sum(count for operation, count in fake.requests.items()
+                   if operation in ('get', 'exists', 'get_children', 'watch'))
+
+    assert zk.get_children(PLACEMENT) == fake.get_children(PLACEMENT)
+
+    fake.suspend()
+    time.sleep(0.1)
+    outage_reads, outage_failures = read_placement(zk)
+    staleness = zk.staleness() if cached else None
+    fake.resume()
+    return {
+        'read latency (us)': elapsed / max(reads, 1) * 1e6,
+        'zk read requests': requests,
+        'reads': reads,
+        'outage reads': outage_reads,
+        'outage failures': outage_failures,
+        'outage staleness (s)': staleness or 0.0,
+    }
+
+
+def main():
+    apps = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    passes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rtt = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0005
+    direct = run(apps, passes, rtt, cached=False)
+    cached = run(apps, passes, rtt, cached=True)
+    print('{name:<22} {direct:>12} {cached:>12}'.format(name='', direct='direct', cached='cached'))
+    for name in sorted(direct):
+        print('{name:<22} {direct:>12.1f} {cached:>12.1f}'.format(
+            name=name, direct=direct[name], cached=cached[name]))
+
+
+if __name__ == '__main__':
+    main()
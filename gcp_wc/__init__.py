@@ -1,11 +1,36 @@
 __all__ = [
+    'agent_host',
     'app_config_manager_service',
     'app_event_service',
     'cleanup_service',
+    'config',
+    'container_stats',
+    'elasticity',
+    'evacuation',
     'event_daemon_service',
+    'fake_zookeeper',
+    'freeze',
+    'instance_index',
+    'intent_log',
+    'lazy',
+    'logs',
+    'loop',
+    'metrics',
     'monitor_screen_service',
+    'node_data',
+    'priority',
+    'profiler',
+    'reconciler',
+    'recording',
     'register_zookeeper_service',
+    'runtime',
+    'screen_state',
+    'service_control',
+    'state_api',
     'state_monitor_service',
     'update_resource_service',
     'watchdog_service',
+    'zk_broker',
+    'zk_broker_service',
+    'zk_cache',
 ]
@@ -0,0 +1,205 @@
+"""Agent Host Service.
+
+Run the loops of the agent services as supervised threads of a single process,
+sharing one Zookeeper session and one container runtime.
+
+A worker whose loop fails or returns is restarted in-process after a delay
+that doubles with each consecutive failure. The per-service entry points are
+still available, the watchdog runs this service instead of them when the
+"agentHost" setting is "1".
+
+With the "reconciler" setting at "1", the reconciler worker replaces the
+event daemon, app config manager, state monitor and cleanup workers.
+"""
+import time
+import socket
+import logging
+import threading
+
+import win32serviceutil
+import win32service
+import win32event
+
+from gcp_wc import app_config_manager_service
+from gcp_wc import app_event_service
+from gcp_wc import cleanup_service
+from gcp_wc import config
+from gcp_wc import event_daemon_service
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import reconciler
+from gcp_wc import recording
+from gcp_wc import register_zookeeper_service
+from gcp_wc import runtime
+from gcp_wc import state_monitor_service
+from gcp_wc import update_resource_service
+
+kazoo_client = lazy.module('kazoo.client')
+
+WORKERS = [
+    ('AppCfgMgrService', app_config_manager_service.run),
+    ('AppeventService', app_event_service.run),
+    ('CleanupService', cleanup_service.run),
+    ('EventDaemonService', event_daemon_service.run),
+    ('RegisterZookeeperService', register_zookeeper_service.run),
+    ('StateMonitorService', state_monitor_service.run),
+    ('UpdateResourcesService', update_resource_service.run),
+]
+# Workers replaced by the reconciler.
+RECONCILED = (
+    'AppCfgMgrService',
+    'CleanupService',
+    'EventDaemonService',
+    'StateMonitorService',
+)
+
+# Seconds to wait before restarting a failed worker, doubled on each
+# consecutive failure up to the maximum.
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# A worker that ran that long is healthy again.
+HEALTHY_TIME = 60
+
+
+def workers():
+    """Returns the workers to run, the reconciler in place of the services
+    it replaces if the "reconciler" setting is "1".
+    """
+    if config.current().reconciler:
+        return [
+            (name, target) for name, target in WORKERS if name not in RECONCILED
+        ] + [('Reconciler', reconciler.run)]
+    return WORKERS
+
+
+class Worker(object):
+    """A service loop running in a thread."""
+
+    def __init__(self, name, target):
+        self.name = name
+        self.target = target
+        self.thread = None
+        self.started = None
+        self.failures = 0
+        self.restart_at = 0
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+class AgentHost(object):
+    """Supervise the agent workers."""
+
+    def __init__(self, root, zk, client, workers=None):
+        """
+        root: work directory
+        zk: shared Zookeeper client
+        client: shared container runtime
+        workers: (name, run function) of the workers
+        """
+        self.root = root
+        self.zk = zk
+        self.client = client
+        self.workers = [Worker(name, target) for name, target in (workers or WORKERS)]
+        self._stop = threading.Event()
+
+    def should_stop(self, timeout):
+        """Wait up to timeout ms, returns True if the host is stopping."""
+        return self._stop.wait(timeout / 1000.0)
+
+    def start(self):
+        """Start all the workers."""
+        for worker in self.workers:
+            self._start(worker)
+
+    def supervise(self):
+        """Restart the workers that stopped, returns the number restarted."""
+        restarted = 0
+        now = time.time()
+        for worker in self.workers:
+            if self._stop.is_set() or worker.is_alive():
+                continue
+            if worker.restart_at == 0:
+                if now - worker.started >= HEALTHY_TIME:
+                    worker.failures = 0
+                delay = min(RESTART_DELAY * 2 ** worker.failures, MAX_RESTART_DELAY)
+                worker.failures += 1
+                worker.restart_at = now + delay
+                logging.info('Worker %s stopped, restart in %ss', worker.name, delay)
+            if now >= worker.restart_at:
+                self._start(worker)
+                restarted += 1
+        return restarted
+
+    def stop(self, timeout=10):
+        """Stop all the workers, waiting up to timeout seconds."""
+        self._stop.set()
+        # Wake the workers sleeping between iterations.
+        loop.signal()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            if worker.thread is not None:
+                worker.thread.join(max(deadline - time.time(), 0))
+
+    def _start(self, worker):
+        worker.restart_at = 0
+        worker.started = time.time()
+        worker.thread = threading.Thread(
+            target=self._run, args=(worker,), name=worker.name
+        )
+        worker.thread.daemon = True
+        worker.thread.start()
+
+    def _run(self, worker):
+        logging.info('Worker %s started', worker.name)
+        try:
+            worker.target(self.root, self.zk, self.client, self.should_stop)
+        except Exception:
+            logging.exception('Worker %s failed', worker.name)
+
+
+class AgentHostSvc (win32serviceutil.ServiceFramework):
+    """Agent Host Service"""
+
+    _svc_name_ = "AgentHostService"
+    _svc_display_name_ = "AgentHostService"
+
+    def __init__(self,args):
+        win32serviceutil.ServiceFramework.__init__(self,args)
+        self.hWaitStop = win32event.CreateEvent(None,0,0,None)
+        self.root = config.current().workDirectory
+        socket.setdefaulttimeout(60)
+
+    def SvcStop(self):
+        self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+        win32event.SetEvent(self.hWaitStop)
+
+    def SvcDoRun(self):
+        logs.setup('agentHostSVC.txt')
+        config.watch()
+        loop.install(loop.ThreadActivity())
+        metrics.serve('agentHost', self.root)
+        profiler.control('agentHost', self.root)
+        try:
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = recording.zookeeper(metrics.zookeeper(kazoo_client.KazooClient(hosts=master_hosts)))
+            zk.start()
+            client = runtime.DockerRuntime.from_env()
+            host = AgentHost(self.root, zk, client, workers())
+            host.start()
+            while True:
+                host.supervise()
+                if win32event.WaitForSingleObject(self.hWaitStop, config.current().agentHostInterval) == win32event.WAIT_OBJECT_0:
+                    host.stop()
+                    break
+        except:
+            pass
+
+
+if __name__ == '__main__':
+    win32serviceutil.HandleCommandLine(AgentHostSvc)
@@ -9,26 +9,29 @@ import os
 import abc
 import glob
 import time
-import yaml
-import docker
 import socket
 import tempfile
-import logging.config
-from kazoo.client import KazooClient
+import logging
 
 import enum
 
+from gcp_wc import config
+from gcp_wc import instance_index
+from gcp_wc import intent_log
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import runtime
+from gcp_wc import zk_broker
+
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'appCfgMgrSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+yaml = lazy.module('yaml')
 
 _HOSTNAME = socket.gethostname()
 
@@ -49,7 +52,7 @@ class AppCfgMgrSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -57,38 +60,111 @@ class AppCfgMgrSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('appCfgMgrSVC.txt')
+        config.watch()
+        loop.install(loop.EventActivity('appCfgMgr', self.hWaitStop))
+        metrics.serve('appCfgMgr', self.root)
+        profiler.control('appCfgMgr', self.root)
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts=master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            client = docker.from_env()
-            while True:
-                cached_files = glob.glob(
-                    os.path.join(os.path.join(self.root, CACHE_DIR), '*')
-                )
-                running_links = glob.glob(
-                    os.path.join(os.path.join(self.root, RUNNING_DIR), '*')
-                )
-                for file_name in set(cached_files) - set(running_links):
-                    if not os.path.exists(os.path.join(os.path.join(self.root, RUNNING_DIR), os.path.basename(file_name))):
-                        configure(zk, client, self.root, os.path.basename(file_name))
-                if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
-                    break
+            client = runtime.DockerRuntime.from_env()
+            run(self.root, zk, client,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
-def configure(zk, client, root, instance_name):
+def run(root, zk, client, should_stop):
+    """Configure the cached instances that are not running yet.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    """
+    log, pending = intent_log.open_log(root, 'appCfgMgr')
+    recover(zk, client, root, log, pending)
+    pace = loop.Loop('appCfgMgr', should_stop)
+    while True:
+        worked = 0
+        cached_files = glob.glob(
+            os.path.join(os.path.join(root, CACHE_DIR), '*')
+        )
+        running_links = glob.glob(
+            os.path.join(os.path.join(root, RUNNING_DIR), '*')
+        )
+        for file_name in set(cached_files) - set(running_links):
+            if not os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), os.path.basename(file_name))):
+                configure(zk, client, root, os.path.basename(file_name), log)
+                worked += 1
+        if pace.sleep(worked):
+            log.close()
+            break
+
+def recover(zk, client, root, log, pending):
+    """Finish or roll back the configurations interrupted by a crash.
+
+    Without an intent log, adopt the containers created before the agent
+    stopped and remove the orphans.
+    """
+    if not log.existed:
+        try:
+            adopted, _removed = instance_index.recover(client, root, _HOSTNAME)
+        except runtime.ContainerError as e:
+            logging.info('recovery failed: %s', e)
+            return
+        for instance_name, (container_id, manifest_data) in adopted.items():
+            running(zk, root, instance_name, manifest_data, container_id)
+        return
+    for intent in pending:
+        try:
+            replay(zk, client, root, intent)
+            log.done(intent)
+        except runtime.ContainerError as e:
+            logging.info('cannot replay %r: %s', intent, e)
+
+def replay(zk, client, root, intent):
+    """Finish a configuration that created its container, roll back the others."""
+    instance_name = intent.instance
+    event_file = os.path.join(os.path.join(root, CACHE_DIR), instance_name)
+    if os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), instance_name)):
+        return
+    if intent.container_id is not None and os.path.exists(event_file):
+        try:
+            if client.state(intent.container_id) == runtime.CREATED:
+                client.start(intent.container_id)
+            with open(event_file) as f:
+                manifest_data = yaml.load(stream=f)
+            logging.info('resuming %s: %s', instance_name, intent.container_id)
+            running(zk, root, instance_name, manifest_data, intent.container_id)
+            return
+        except runtime.ContainerError as e:
+            logging.info('cannot resume %s: %s', instance_name, e)
+    # Configured again from the start.
+    container_ids = set(instance_index.instance_containers(client, instance_name))
+    if intent.container_id is not None:
+        container_ids.add(intent.container_id)
+    for container_id in container_ids:
+        try:
+            client.remove(container_id, force=True)
+        except runtime.NotFound:
+            pass
+    logging.info('rolled back %s: %s', instance_name, sorted(container_ids))
+
+def configure(zk, client, root, instance_name, log):
     """Configures and starts the instance based on instance cached event.
 
     :param ``str`` instance_name:
         Name of the instance to configure
+    :param ``IntentLog`` log:
+        Intent log of the service
     :returns ``bool``:
         True for successfully configured container.
     """
     if instance_name[0] == '.':
         # Ignore all dot files
         return
-    time.sleep(3)
+    time.sleep(config.current().configureDelay / 1000.0)
     event_file = os.path.join(
         os.path.join(root, CACHE_DIR),
         instance_name
@@ -97,63 +173,81 @@ def configure(zk, client, root, instance_name):
     logging.info("configuring %s", instance_name)
     with open(event_file) as f:
         manifest_data = yaml.load(stream=f)
+    # The cpu shares of the level the watchdog set, and the reserved cores
+    # left to the desktop user.
+    cpu_options = priority.PriorityManager.from_env(root=root).container_options(
+        int(manifest_data['cpu'][:len(manifest_data['cpu']) - 1]))
+    labels = instance_index.labels(instance_name, manifest_data, _HOSTNAME)
+    intent = log.begin('configure', instance_name)
     if manifest_data['image']=="nginx":
         port = {}
         container_port = '80/tcp'
         port[container_port] = int(manifest_data['endpoints'][0]['port'])
-        docker_container = client.containers.create(image=manifest_data['image'],
-                                                    mem_limit=manifest_data['memory'],
-                                                    cpu_percent=int(
-                                                        manifest_data['cpu'][:len(manifest_data['cpu']) - 1]),
-                                                    ports=port)
+        container_id = client.create(image=manifest_data['image'],
+                                     mem_limit=manifest_data['memory'],
+                                     ports=port,
+                                     labels=labels,
+                                     **cpu_options)
     else:
-        docker_container = client.containers.create(image = manifest_data['image'],
-                                                    mem_limit = manifest_data['memory'],
-                                                    cpu_percent = int(manifest_data['cpu'][:len(manifest_data['cpu'])-1]),
-                                                    command = manifest_data['services'][0]['command'])
-
-    if docker_container in client.containers.list(all):
-        post(
-            os.path.join(root, APP_EVENTS_DIR),
-            ConfiguredTraceEvent(
-                instanceid=instance_name,
-                uniqueid=docker_container.id
-            )
+        container_id = client.create(image = manifest_data['image'],
+                                     mem_limit = manifest_data['memory'],
+                                     command = manifest_data['services'][0]['command'],
+                                     labels = labels,
+                                     **cpu_options)
+    log.step(intent, 'created', container_id)
+
+    post(
+        os.path.join(root, APP_EVENTS_DIR),
+        ConfiguredTraceEvent(
+            instanceid=instance_name,
+            uniqueid=container_id
         )
-        logging.info("configure success %s", instance_name)
+    )
+    logging.info("configure success %s", instance_name)
 
 
     logging.info("starting %s", instance_name)
     canstarted = True
     try:
-        docker_container.start()
-    except docker.errors.APIError:
+        client.start(container_id)
+    except runtime.ContainerError:
         canstarted = False
     if canstarted:
-        manifest_file = os.path.join(os.path.join(root, RUNNING_DIR), instance_name)
-        manifest_data['container_id'] = docker_container.id
-        #manifest = {'container_id':docker_container.id}
-        if not os.path.exists(manifest_file):
-            with tempfile.NamedTemporaryFile(dir=os.path.join(root, RUNNING_DIR),
-                                            prefix='.%s-' % instance_name,
-                                            delete=False,
-                                            mode='w') as temp_manifest:
-                yaml.dump(manifest_data, stream=temp_manifest)
-            os.rename(temp_manifest.name, manifest_file)
-        logging.info('Created running manifest: %s', manifest_file)
-
-        post(
-            os.path.join(root, APP_EVENTS_DIR),
-            ServiceRunningTraceEvent(
-                instanceid=instance_name,
-                uniqueid=docker_container.id,
-                service=manifest_data['services'][0]['name']
-            )
+        log.step(intent, 'started', durable=False)
+        running(zk, root, instance_name, manifest_data, container_id)
+    else:
+        # Not left behind for the next configuration.
+        try:
+            client.remove(container_id, force=True)
+        except runtime.ContainerError:
+            pass
+    log.done(intent)
+
+def running(zk, root, instance_name, manifest_data, container_id):
+    """Record a started container: running manifest, event and node."""
+    manifest_file = os.path.join(os.path.join(root, RUNNING_DIR), instance_name)
+    manifest_data['container_id'] = container_id
+    if not os.path.exists(manifest_file):
+        with tempfile.NamedTemporaryFile(dir=os.path.join(root, RUNNING_DIR),
+                                        prefix='.%s-' % instance_name,
+                                        delete=False,
+                                        mode='w') as temp_manifest:
+            yaml.dump(manifest_data, stream=temp_manifest)
+        os.rename(temp_manifest.name, manifest_file)
+    logging.info('Created running manifest: %s', manifest_file)
+
+    post(
+        os.path.join(root, APP_EVENTS_DIR),
+        ServiceRunningTraceEvent(
+            instanceid=instance_name,
+            uniqueid=container_id,
+            service=manifest_data['services'][0]['name']
         )
-        app_data = _HOSTNAME
-        if not zk.exists(path_running(instance_name)):
-            zk.create(path_running(instance_name), app_data.encode('utf-8'))
-        logging.info("running %s", instance_name)
+    )
+    app_data = _HOSTNAME
+    if not zk.exists(path_running(instance_name)):
+        zk.create(path_running(instance_name), app_data.encode('utf-8'))
+    logging.info("running %s", instance_name)
 
 def path_scheduled(instance_name):
     return SCHEDULED+'/'+instance_name
@@ -3,24 +3,23 @@
 """
 import os
 import glob
-import kazoo
+import kazoo.exceptions
 import socket
 import functools
-import logging.config
-from kazoo.client import KazooClient
+import logging
+
+from gcp_wc import config
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import zk_broker
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'appeventsSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
-
 TASKS = '/tasks'
 SCHEDULED = '/scheduled'
 
@@ -38,7 +37,7 @@ class AppeventSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -46,45 +45,67 @@ class AppeventSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('appeventsSVC.txt')
+        config.watch()
+        loop.install(loop.EventActivity('appEvents', self.hWaitStop))
+        metrics.serve('appEvents', self.root)
+        profiler.control('appEvents', self.root)
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts = master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            while True:
-                post_files = glob.glob(
-                    os.path.join(os.path.join(self.root, APP_EVENTS_DIR), '*')
-                )
-                logging.info('content of %r : %r',
-                             os.path.join(self.root, APP_EVENTS_DIR),
-                             post_files)
-                for post_file in post_files:
-                    self._post(zk, post_file)
-
-                if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
-                    break
+            run(self.root, zk, None,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
-    def _post(self, zk, path):
-        localpath = os.path.basename(path)
-
-        logging.info("post: %s", localpath)
-        eventtime, appname, event, data = localpath.split(',', 4)
-        with open(path, mode='rb') as f:
-            eventnode = '%s,%s,%s,%s' % (eventtime, _HOSTNAME, event, data)
-            logging.info('Creating %s', task_path(appname, eventnode))
-            try:
-                zk.create(task_path(appname, eventnode))
-            except kazoo.client.NodeExistsError:
-                pass
-
-        if event in ['aborted', 'killed', 'finished']:
-            scheduled_node = scheduled_path(appname)
-            logging.info(scheduled_node)
-            logging.info('Unscheduling, event=%s: %s', event, scheduled_node)
-            if zk.exists(scheduled_node):
-                zk.delete(scheduled_node)
-        os.unlink(path)
+def run(root, zk, client, should_stop, hostname=None):
+    """Post the application events of the event directory to Zookeeper.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    :param hostname:
+        Name the desktop registers as, the name of the machine by default.
+    """
+    hostname = hostname or _HOSTNAME
+    pace = loop.Loop('appEvents', should_stop)
+    while True:
+        if pace.sleep(post(zk, root, hostname)):
+            break
+
+def post(zk, root, hostname):
+    """Post the events of the event directory, returns their number."""
+    post_files = glob.glob(
+        os.path.join(os.path.join(root, APP_EVENTS_DIR), '*')
+    )
+    logging.info('content of %r : %r',
+                 os.path.join(root, APP_EVENTS_DIR),
+                 post_files)
+    for post_file in post_files:
+        _post(zk, post_file, hostname)
+    return len(post_files)
+
+def _post(zk, path, hostname):
+    localpath = os.path.basename(path)
+
+    logging.info("post: %s", localpath)
+    eventtime, appname, event, data = localpath.split(',', 4)
+    with open(path, mode='rb') as f:
+        eventnode = '%s,%s,%s,%s' % (eventtime, hostname, event, data)
+        logging.info('Creating %s', task_path(appname, eventnode))
+        try:
+            zk.create(task_path(appname, eventnode))
+        except kazoo.exceptions.NodeExistsError:
+            pass
+
+    if event in ['aborted', 'killed', 'finished']:
+        scheduled_node = scheduled_path(appname)
+        logging.info(scheduled_node)
+        logging.info('Unscheduling, event=%s: %s', event, scheduled_node)
+        if zk.exists(scheduled_node):
+            zk.delete(scheduled_node)
+    os.unlink(path)
 
 def join_zookeeper_path(root, *child):
     """"Returns zookeeper path joined by slash."""
@@ -3,26 +3,31 @@
 """
 import os
 import glob
-import yaml
 import errno
 import socket
-import docker
 import functools
 import collections
-import logging.config
-from kazoo.client import KazooClient
+import logging
+from kazoo.exceptions import KazooException
+
+from gcp_wc import config
+from gcp_wc import instance_index
+from gcp_wc import intent_log
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import runtime
+from gcp_wc import zk_broker
+from gcp_wc import zk_cache
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'cleanupSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+yaml = lazy.module('yaml')
 
 PLACEMENT = '/placement'
 RUNNING = '/running'
@@ -42,7 +47,7 @@ class CleanupSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -50,66 +55,121 @@ class CleanupSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('cleanupSVC.txt')
+        config.watch()
+        loop.install(loop.EventActivity('cleanup', self.hWaitStop))
+        metrics.serve('cleanup', self.root)
+        profiler.control('cleanup', self.root)
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts = master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            client = docker.from_env()
-            while True:
-                cleanup_files = glob.glob(
-                    os.path.join(os.path.join(self.root, CLEANUP_DIR), '*')
-                )
-                cache_apps = {
-                    os.path.basename(manifest)
-                    for manifest in glob.glob(os.path.join(os.path.join(self.root, CACHE_DIR), '*'))
-                }
-                running_apps = {
-                    os.path.basename(manifest)
-                    for manifest in glob.glob(os.path.join(os.path.join(self.root, RUNNING_DIR), '*'))
-                }
-                logging.info('content of %r : %r',
-                             os.path.join(self.root, CLEANUP_DIR),
-                             cleanup_files)
-                for cleanup_file in cleanup_files:
-                    instance_name = os.path.basename(cleanup_file)
-                    if instance_name not in cache_apps and instance_name not in running_apps:
-                        try:
-                            with open(os.path.join(os.path.join(self.root, CLEANUP_DIR), instance_name)) as f:
-                                manifest_data = yaml.load(stream=f)
-                            client.containers.get(manifest_data['container_id']).remove()
-                        except:
-                            pass
-                        rm_safe(cleanup_file)
-                    else:
-                        self._cleanup(zk, client, cleanup_file)
-                if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
-                    break
+            client = runtime.DockerRuntime.from_env()
+            run(self.root, zk, client,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
-    def _cleanup(self, zk, client, event_file):
-        """Handle a new cleanup event: cleanup a container.
+def run(root, zk, client, should_stop):
+    """Cleanup the instances of the cleanup directory.
 
-        :param event_file:
-             Full path to an event file
-        :type event_file:
-            ``str``
-        """
-        try:
-            instance_name = os.path.basename(event_file)
-
-            logging.info("cleanup: %s", instance_name)
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    """
+    zk = zk_cache.mirror(zk, _HOSTNAME, 'cleanup')
+    try:
+        _run(root, zk, client, should_stop)
+    finally:
+        zk_cache.close(zk)
+
+def _run(root, zk, client, should_stop):
+    log, pending = intent_log.open_log(root, 'cleanup')
+    for intent in pending:
+        _cleanup(zk, client, root,
+                 os.path.join(os.path.join(root, CLEANUP_DIR), intent.instance),
+                 log, intent)
+    pace = loop.Loop('cleanup', should_stop)
+    while True:
+        cleanup_files = glob.glob(
+            os.path.join(os.path.join(root, CLEANUP_DIR), '*')
+        )
+        cache_apps = {
+            os.path.basename(manifest)
+            for manifest in glob.glob(os.path.join(os.path.join(root, CACHE_DIR), '*'))
+        }
+        running_apps = {
+            os.path.basename(manifest)
+            for manifest in glob.glob(os.path.join(os.path.join(root, RUNNING_DIR), '*'))
+        }
+        logging.info('content of %r : %r',
+                     os.path.join(root, CLEANUP_DIR),
+                     cleanup_files)
+        for cleanup_file in cleanup_files:
+            instance_name = os.path.basename(cleanup_file)
+            if instance_name not in cache_apps and instance_name not in running_apps:
+                try:
+                    remove_containers(client, root, instance_name)
+                except:
+                    pass
+                rm_safe(cleanup_file)
+            else:
+                _cleanup(zk, client, root, cleanup_file, log)
+        if pace.sleep(len(cleanup_files)):
+            log.close()
+            break
+
+def _cleanup(zk, client, root, event_file, log, intent=None):
+    """Handle a new cleanup event: cleanup a container.
+
+    :param event_file:
+         Full path to an event file
+    :type event_file:
+        ``str``
+    :param intent:
+        Intent of an interrupted cleanup, resumed from its last step
+    :type intent:
+        ``Intent``
+    """
+    instance_name = os.path.basename(event_file)
+    if intent is None:
+        # Resume a cleanup that failed at an earlier iteration.
+        intent = log.find('cleanup', instance_name) or log.begin('cleanup', instance_name)
+    try:
+        logging.info("cleanup: %s", instance_name)
+        if intent.step is None:
             if zk.exists(path.placement(_HOSTNAME + '/' + instance_name)):
                 zk.delete(path.placement(_HOSTNAME + '/' + instance_name))
             if zk.exists(path_running(instance_name)):
                 zk.delete(path_running(instance_name))
-            rm_safe(os.path.join(os.path.join(self.root, CACHE_DIR), instance_name))
-            with open(os.path.join(os.path.join(self.root, CLEANUP_DIR), instance_name)) as f:
-                manifest_data = yaml.load(stream=f)
-            client.containers.get(manifest_data['container_id']).remove()
-            rm_safe(os.path.join(os.path.join(self.root, RUNNING_DIR), instance_name))
-            rm_safe(event_file)
-        except:
+            log.step(intent, 'unregistered', durable=False)
+        if intent.step == 'unregistered':
+            rm_safe(os.path.join(os.path.join(root, CACHE_DIR), instance_name))
+            remove_containers(client, root, instance_name)
+            log.step(intent, 'removed', durable=False)
+        rm_safe(os.path.join(os.path.join(root, RUNNING_DIR), instance_name))
+        rm_safe(event_file)
+    except (KazooException, runtime.ContainerError, OSError) as e:
+        # The cleanup file and the intent are left for the next iteration.
+        logging.warning('Cleanup of %s failed at step %s: %s', instance_name, intent.step, e)
+        return
+    log.done(intent)
+
+def remove_containers(client, root, instance_name):
+    """Remove the containers of an instance: the one of its manifest and the
+    ones labelled with it.
+    """
+    container_ids = set(instance_index.instance_containers(client, instance_name))
+    try:
+        with open(os.path.join(os.path.join(root, CLEANUP_DIR), instance_name)) as f:
+            manifest_data = yaml.load(stream=f)
+        container_ids.add(manifest_data['container_id'])
+    except (IOError, OSError, KeyError, TypeError):
+        pass
+    for container_id in container_ids:
+        try:
+            client.remove(container_id, force=True)
+        except runtime.NotFound:
             pass
 
 def rm_safe(path):
@@ -0,0 +1,354 @@
+"""Configuration.
+
+Typed configuration of the agent, loaded from configure.json: the file the
+installation copies to the machine environment variables. The settings
+missing from the file are taken from the environment, then from their
+default. Values are validated when loaded; durations are in ms, as in the
+file.
+
+The file is watched for changes (change notifications on Windows, polling
+elsewhere) and reloaded in place: the loops read their interval from
+`current()` at each iteration, so a change applies without a restart. The
+settings read once, when a client or a pool is built, apply on the next
+start of the service; their change is logged as such. A file that does not
+validate is logged and ignored, the previous configuration stays in effect.
+"""
+import os
+import json
+import logging
+import threading
+
+# Milliseconds between two checks of the file, without change notifications.
+DEFAULT_POLL_INTERVAL = 1000
+
+_FILENAME = 'configure.json'
+
+_lock = threading.Lock()
+_config = None
+_watcher = None
+_listeners = []
+
+
+class ConfigError(ValueError):
+    """The configuration does not validate."""
+
+
+class Setting(object):
+    """A setting, its type and its bounds."""
+
+    __slots__ = (
+        'name',
+        'type',
+        'default',
+        'minimum',
+        'maximum',
+        'restart',
+    )
+
+    def __init__(self, name, type, default, minimum=None, maximum=None, restart=False):
+        """
+        name: name of the setting in the file and the environment
+        type: int, float, bool or str
+        default: value when set nowhere, None if required
+        minimum, maximum: bounds of the value
+        restart: whether a change only applies on the next start
+        """
+        self.name = name
+        self.type = type
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.restart = restart
+
+    def parse(self, value):
+        """Returns the value converted and checked, raises ValueError."""
+        if self.type is bool:
+            if str(value).lower() not in ('0', '1', 'false', 'true'):
+                raise ValueError('%r is not 0 or 1' % (value,))
+            value = str(value).lower() in ('1', 'true')
+        elif self.type is str:
+            value = str(value)
+        else:
+            value = self.type(value)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError('%r is below %r' % (value, self.minimum))
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError('%r is above %r' % (value, self.maximum))
+        return value
+
+
+SETTINGS = [
+    # Machine.
+    Setting('workDirectory', str, None, restart=True),
+    Setting('zookeeper', str, None, restart=True),
+    # Loop intervals (ms).
+    Setting('agentHostInterval', int, 1000, minimum=10),
+    Setting('appCfgMgrInterval', int, 2000, minimum=10),
+    Setting('appEventsInterval', int, 2000, minimum=10),
+    Setting('cleanupInterval', int, 2000, minimum=10),
+    Setting('eventDaemonInterval', int, 2000, minimum=10),
+    Setting('reconcilerInterval', int, 2000, minimum=10),
+    Setting('registerZookeeperInterval', int, 100, minimum=10),
+    Setting('screenMonitorInterval', int, 2000, minimum=10),
+    Setting('stateMonitorInterval', int, 2000, minimum=10),
+    Setting('updateResourcesInterval', int, 60000, minimum=1000),
+    Setting('watchdogInterval', int, 2000, minimum=10),
+    # Intervals of the idle loops (ms), see gcp_wc.loop.
+    Setting('appCfgMgrMaxInterval', int, 16000, minimum=10),
+    Setting('appEventsMaxInterval', int, 16000, minimum=10),
+    Setting('cleanupMaxInterval', int, 16000, minimum=10),
+    Setting('eventDaemonMaxInterval', int, 16000, minimum=10),
+    Setting('reconcilerMaxInterval', int, 16000, minimum=10),
+    Setting('registerZookeeperMaxInterval', int, 1000, minimum=10),
+    Setting('stateMonitorMaxInterval', int, 8000, minimum=10),
+    Setting('loopBackoff', float, 2.0, minimum=1.0),
+    Setting('loopReportInterval', int, 600000, minimum=1000),
+    # Waits of the services (ms): before configuring an instance, and
+    # between the removal of the manifests of an instance no longer placed
+    # and the kill of its container.
+    Setting('configureDelay', int, 3000, minimum=0),
+    Setting('unplaceDelay', int, 2000, minimum=0),
+    # Services run.
+    Setting('agentHost', bool, False, restart=True),
+    Setting('reconciler', bool, False, restart=True),
+    Setting('zkBroker', bool, False, restart=True),
+    Setting('zkCache', bool, True, restart=True),
+    # Zookeeper.
+    Setting('zkBrokerPort', int, 2182, minimum=1, maximum=65535, restart=True),
+    Setting('zkSessionTimeout', int, 10000, minimum=1000, restart=True),
+    # Docker.
+    Setting('dockerTimeout', int, 60000, minimum=1000, restart=True),
+    Setting('dockerPools', int, 4, minimum=1, restart=True),
+    Setting('statsMaxStreams', int, 16, minimum=0, restart=True),
+    # Revocation of the containers on unlock, deadline and grace period in ms.
+    Setting('evacuationDeadline', int, 1000, minimum=0),
+    Setting('evacuationWorkers', int, 16, minimum=1),
+    Setting('freezePolicy', bool, False, restart=True),
+    Setting('freezeGracePeriod', int, 300000, minimum=0, restart=True),
+    Setting('freezeWorkers', int, 16, minimum=1, restart=True),
+    Setting('serviceControlWorkers', int, 8, minimum=1, restart=True),
+    # Screen state (ms).
+    Setting('screenLockSettle', int, 30000, minimum=0, restart=True),
+    Setting('screenUnlockSettle', int, 0, minimum=0, restart=True),
+    Setting('minLockDuration', int, 60000, minimum=0, restart=True),
+    Setting('screenHistory', int, 200, minimum=1, restart=True),
+    # Removed instances kept by the state API.
+    Setting('instanceHistory', int, 1000, minimum=0, restart=True),
+    # Priority and elasticity.
+    Setting('reservedCores', int, 1, minimum=0),
+    Setting('userActiveThreshold', int, 5000, minimum=0),
+    Setting('elasticDeepIdle', int, 300000, minimum=0, restart=True),
+    Setting('elasticStep', int, 10, minimum=1, maximum=100, restart=True),
+    Setting('elasticMinInterval', int, 30000, minimum=0, restart=True),
+    # Metrics, 0 to serve none, and sampling interval of the profiles (ms).
+    Setting('metricsPort', int, 9400, minimum=0, maximum=65535, restart=True),
+    Setting('profileInterval', int, 5, minimum=1),
+    # Trace of the Zookeeper and Docker traffic, see gcp_wc.recording.
+    Setting('recordTraffic', bool, False, restart=True),
+    Setting('recordMaxBytes', int, 100 * 1024 * 1024, minimum=1024, restart=True),
+    # Intent log and logs.
+    Setting('intentLogCompactSize', int, 64 * 1024, minimum=1024, restart=True),
+    Setting('logMaxBytes', int, 10 * 1024 * 1024, minimum=1024, restart=True),
+    Setting('logBackupCount', int, 5, minimum=0, restart=True),
+    Setting('logRate', int, 30, minimum=1, restart=True),
+]
+
+_SETTINGS = dict((setting.name, setting) for setting in SETTINGS)
+
+
+class Config(object):
+    """Values of the settings, as attributes named after them."""
+
+    def __init__(self, values):
+        self._values = dict(values)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_values'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __eq__(self, other):
+        return isinstance(other, Config) and self._values == other._values
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Config<{values}>'.format(values=self._values)
+
+    def values(self):
+        return dict(self._values)
+
+    def changes(self, other):
+        """Returns the names of the settings that differ in other."""
+        return sorted(name for name in self._values if self._values[name] != other._values[name])
+
+    @classmethod
+    def parse(cls, data, environ=None):
+        """Returns the Config of the file data, falling back on environ.
+
+        :param ``dict`` data:
+            Setting name to value, as in configure.json.
+        :param ``dict`` environ:
+            Environment variables, for the settings not in data.
+        """
+        environ = environ if environ is not None else {}
+        values = {}
+        errors = []
+        for setting in SETTINGS:
+            value = data.get(setting.name, environ.get(setting.name))
+            if value is None:
+                if setting.default is None:
+                    errors.append('%s: required' % setting.name)
+                values[setting.name] = setting.default
+                continue
+            try:
+                values[setting.name] = setting.parse(value)
+            except (TypeError, ValueError) as e:
+                errors.append('%s: %s' % (setting.name, e))
+        unknown = sorted(set(data) - set(_SETTINGS))
+        if unknown:
+            logging.warning('Unknown settings ignored: %s', ', '.join(unknown))
+        if errors:
+            raise ConfigError('; '.join(errors))
+        return cls(values)
+
+
+def path():
+    """Returns the path of configure.json: the "agentConfig" environment
+    variable, or the one at the root of the installation.
+    """
+    return os.getenv("agentConfig") or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), _FILENAME)
+
+
+def load(filename=None, environ=None):
+    """Returns the Config of a file (default: path()), raises ConfigError.
+
+    A missing file leaves the settings to the environment.
+    """
+    filename = filename or path()
+    environ = environ if environ is not None else os.environ
+    try:
+        with open(filename, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError):
+        data = {}
+    except ValueError as e:
+        raise ConfigError('%s: %s' % (filename, e))
+    if not isinstance(data, dict):
+        raise ConfigError('%s is not a mapping' % filename)
+    return Config.parse(data, environ)
+
+
+def current():
+    """Returns the Config of the process, loaded on first use."""
+    global _config
+    config = _config
+    if config is None:
+        with _lock:
+            if _config is None:
+                _config = load()
+            config = _config
+    return config
+
+
+def reload(filename=None):
+    """Load the file again, returns the names of the settings changed.
+
+    The Config of the process is replaced, and the listeners called with
+    the previous and the new Config. A file that does not validate is
+    logged and ignored.
+    """
+    global _config
+    try:
+        config = load(filename)
+    except ConfigError as e:
+        logging.error('Configuration not reloaded: %s', e)
+        return []
+    with _lock:
+        previous, _config = _config, config
+        listeners = list(_listeners)
+    if previous is None:
+        return []
+    changed = previous.changes(config)
+    for name in changed:
+        logging.info('%s changed from %r to %r%s', name, getattr(previous, name),
+                     getattr(config, name),
+                     ', applied on the next start' if _SETTINGS[name].restart else '')
+    if changed:
+        for listener in listeners:
+            try:
+                listener(previous, config)
+            except Exception:
+                logging.exception('Configuration listener failed')
+    return changed
+
+
+def subscribe(listener):
+    """Call listener(previous, config) when the configuration changes."""
+    with _lock:
+        _listeners.append(listener)
+
+
+class ConfigWatcher(threading.Thread):
+    """Thread reloading the configuration when its file changes."""
+
+    def __init__(self, filename=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        super(ConfigWatcher, self).__init__(name='ConfigWatcher')
+        self.daemon = True
+        self.filename = filename or path()
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def check(self):
+        """Reload if the file changed since the last check."""
+        signature = self._stat()
+        if signature != self._signature:
+            self._signature = signature
+            reload(self.filename)
+
+    def run(self):
+        try:
+            import win32file
+            import win32con
+            import win32event
+        except ImportError:
+            while not self._stopped.wait(self.poll_interval / 1000.0):
+                self.check()
+            return
+        handle = win32file.FindFirstChangeNotification(
+            os.path.dirname(self.filename), False,
+            win32con.FILE_NOTIFY_CHANGE_LAST_WRITE | win32con.FILE_NOTIFY_CHANGE_FILE_NAME)
+        try:
+            while not self._stopped.is_set():
+                # Notified of any file of the directory, and woken up to stop.
+                result = win32event.WaitForSingleObject(handle, self.poll_interval)
+                if result == win32event.WAIT_OBJECT_0:
+                    self.check()
+                    win32file.FindNextChangeNotification(handle)
+        finally:
+            win32file.FindCloseChangeNotification(handle)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def watch(filename=None):
+    """Start watching the configuration file, once per process."""
+    global _watcher
+    current()
+    with _lock:
+        if _watcher is None:
+            _watcher = ConfigWatcher(filename)
+            _watcher.start()
+        return _watcher
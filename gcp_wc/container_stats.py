@@ -0,0 +1,306 @@
+"""Container Stats.
+
+Follow the docker stats of the instances in the running directory and keep
+the latest cpu and memory usage of each instance, so that the resources used
+by the agent can be told apart from the resources used by the desktop user.
+"""
+import os
+import glob
+import json
+import time
+import codecs
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from gcp_wc import lazy
+
+yaml = lazy.module('yaml')
+
+RUNNING_DIR = 'running'
+
+# Number of stats streams followed at the same time, the other instances are
+# sampled once per refresh.
+DEFAULT_MAX_STREAMS = 16
+# Number of samples taken at the same time, a sample takes docker 1-2 s.
+DEFAULT_SAMPLE_WORKERS = 4
+# Seconds a refresh waits for its samples, the late ones are recorded when
+# they complete.
+DEFAULT_SAMPLE_TIMEOUT = 2.0
+
+# A stats frame is a few KB, anything bigger is garbage and is dropped.
+_MAX_BUFFER = 1024 * 1024
+
+Usage = collections.namedtuple('Usage', 'cpu memory')
+
+
+class FrameDecoder(object):
+    """Incremental decoder of a stream of concatenated JSON frames."""
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+
+    def feed(self, chunk):
+        """Feed a chunk of the stream and return the completed frames."""
+        if isinstance(chunk, bytes):
+            chunk = self._utf8.decode(chunk)
+        self._buffer += chunk
+        frames = []
+        while True:
+            data = self._buffer.lstrip()
+            if not data:
+                self._buffer = ''
+                break
+            try:
+                frame, end = self._decoder.raw_decode(data)
+            except ValueError:
+                self._buffer = data
+                break
+            frames.append(frame)
+            self._buffer = data[end:]
+        if len(self._buffer) > _MAX_BUFFER:
+            logging.info('Drop %d bytes of undecodable stats', len(self._buffer))
+            self._buffer = ''
+        return frames
+
+
+class StatsCollector(object):
+    """Collect the cpu and memory usage of the running instances."""
+
+    def __init__(self, client, root, max_streams=DEFAULT_MAX_STREAMS,
+                 sample_workers=DEFAULT_SAMPLE_WORKERS,
+                 sample_timeout=DEFAULT_SAMPLE_TIMEOUT):
+        """
+        client: container runtime
+        root: work directory
+        max_streams: maximum number of stats streams (and threads)
+        sample_workers: number of samples taken at the same time
+        sample_timeout: seconds a refresh waits for its samples
+        """
+        self.client = client
+        self.root = root
+        self.max_streams = max_streams
+        self.sample_timeout = sample_timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=sample_workers)
+        self._lock = threading.Lock()
+        # instance -> Future of its sample being taken
+        self._samples = {}
+        # instance -> (container_id, stop event)
+        self._streams = {}
+        # instance -> Usage
+        self._usage = {}
+        # instance -> manifest data
+        self._manifests = {}
+
+    def refresh(self):
+        """Follow the instances of the running directory.
+
+        Streams of instances that are gone are stopped and their usage is
+        forgotten, so memory use does not grow with the instances seen.
+        """
+        running = self._running()
+        with self._lock:
+            for instance in set(self._streams) - set(running):
+                self._streams.pop(instance)[1].set()
+            for instance in set(self._usage) - set(running):
+                del self._usage[instance]
+            following = set(self._streams)
+
+        samples = []
+        for instance in set(running) - following:
+            container_id = running[instance].get('container_id')
+            if container_id is None:
+                continue
+            with self._lock:
+                can_follow = len(self._streams) < self.max_streams
+                if can_follow:
+                    stop = threading.Event()
+                    self._streams[instance] = (container_id, stop)
+            if can_follow:
+                thread = threading.Thread(target=self._follow,
+                                          args=(instance, container_id, stop))
+                thread.daemon = True
+                thread.start()
+            elif instance not in self._samples:
+                # Not sampled again while its last sample is pending.
+                future = self._executor.submit(self._sample, instance, container_id)
+                self._samples[instance] = future
+                future.add_done_callback(
+                    lambda _future, instance=instance: self._samples.pop(instance, None))
+                samples.append(future)
+        if samples:
+            concurrent.futures.wait(samples, timeout=self.sample_timeout)
+
+    def usage(self):
+        """Returns the total Usage of the instances."""
+        with self._lock:
+            samples = list(self._usage.values())
+        return Usage(
+            cpu=sum(sample.cpu for sample in samples),
+            memory=sum(sample.memory for sample in samples)
+        )
+
+    def container_usage(self):
+        """Returns the Usage of the measured instances by container id."""
+        with self._lock:
+            return dict(
+                (self._manifests[instance].get('container_id'), usage)
+                for instance, usage in self._usage.items()
+                if instance in self._manifests
+            )
+
+    def reserved(self):
+        """Returns the total Usage reserved by the manifests of the instances."""
+        with self._lock:
+            manifests = list(self._manifests.values())
+        return Usage(
+            cpu=sum(_cpu(manifest.get('cpu')) for manifest in manifests),
+            memory=sum(_memory(manifest.get('memory')) for manifest in manifests)
+        )
+
+    def remaining(self, free_cpu, free_memory):
+        """Returns the free resources net of the reservations.
+
+        The free resources already account for what the instances use, only
+        the part of the reservations that is not used yet is withheld.
+        """
+        with self._lock:
+            pending_cpu = pending_memory = 0
+            for instance, manifest in self._manifests.items():
+                used = self._usage.get(instance, Usage(0, 0))
+                pending_cpu += max(_cpu(manifest.get('cpu')) - used.cpu, 0)
+                pending_memory += max(_memory(manifest.get('memory')) - used.memory, 0)
+        return Usage(
+            cpu=max(int(free_cpu - pending_cpu), 0),
+            memory=max(int(free_memory - pending_memory), 0)
+        )
+
+    def close(self):
+        """Stop all the streams."""
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            for _container_id, stop in self._streams.values():
+                stop.set()
+            self._streams.clear()
+            self._usage.clear()
+
+    def _running(self):
+        """Returns the manifests of the running directory by instance."""
+        instances = {
+            os.path.basename(manifest)
+            for manifest in glob.glob(os.path.join(os.path.join(self.root, RUNNING_DIR), '*'))
+        }
+        with self._lock:
+            for instance in set(self._manifests) - instances:
+                del self._manifests[instance]
+            missing = instances - set(self._manifests)
+        for instance in missing:
+            try:
+                with open(os.path.join(os.path.join(self.root, RUNNING_DIR), instance)) as f:
+                    manifest_data = yaml.safe_load(f)
+            except (IOError, OSError, yaml.YAMLError):
+                continue
+            if isinstance(manifest_data, dict):
+                with self._lock:
+                    self._manifests[instance] = manifest_data
+        with self._lock:
+            return dict(self._manifests)
+
+    def _record(self, instance, container_id, usage):
+        with self._lock:
+            if instance not in self._manifests:
+                return
+            stream = self._streams.get(instance)
+            if stream is not None and stream[0] != container_id:
+                return
+            self._usage[instance] = usage
+
+    def _follow(self, instance, container_id, stop):
+        """Follow the stats stream of a container until stopped or exited."""
+        stream = None
+        try:
+            stream = self.client.stats(container_id, stream=True)
+            decoder = FrameDecoder()
+            previous = None
+            for chunk in stream:
+                if stop.is_set():
+                    break
+                for frame in decoder.feed(chunk):
+                    received = time.time()
+                    usage = usage_from_frame(frame, previous)
+                    previous = (frame, received)
+                    if usage is not None:
+                        self._record(instance, container_id, usage)
+        except Exception as e:
+            logging.info('Stats of %s stopped: %s', instance, e)
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                stream.close()
+            with self._lock:
+                if self._streams.get(instance, (None,))[0] == container_id:
+                    del self._streams[instance]
+
+    def _sample(self, instance, container_id):
+        """Take a single stats sample of a container."""
+        try:
+            frame = self.client.stats(container_id, stream=False)
+        except Exception as e:
+            logging.info('Stats of %s failed: %s', instance, e)
+            return
+        usage = usage_from_frame(frame, None)
+        if usage is not None:
+            self._record(instance, container_id, usage)
+
+
+def usage_from_frame(frame, previous):
+    """Returns the Usage (cpu in % of the host, memory in MB) of a stats frame.
+
+    :param frame:
+        Decoded stats frame.
+    :param previous:
+        (frame, receive time) of the previous frame of the stream, or None.
+    """
+    if not isinstance(frame, dict):
+        return None
+    memory_stats = frame.get('memory_stats') or {}
+    # Windows containers report the private working set.
+    memory = memory_stats.get('privateworkingset', memory_stats.get('usage', 0))
+
+    cpu_stats = frame.get('cpu_stats') or {}
+    precpu_stats = frame.get('precpu_stats') or {}
+    total = cpu_stats.get('cpu_usage', {}).get('total_usage', 0)
+    cpu = 0.0
+    if cpu_stats.get('system_cpu_usage') and precpu_stats.get('system_cpu_usage'):
+        system_delta = cpu_stats['system_cpu_usage'] - precpu_stats['system_cpu_usage']
+        cpu_delta = total - precpu_stats.get('cpu_usage', {}).get('total_usage', 0)
+        if system_delta > 0:
+            cpu = 100.0 * cpu_delta / system_delta
+    elif previous is not None and frame.get('num_procs'):
+        # Windows: total_usage is in 100ns units, there is no system usage.
+        previous_frame, received = previous
+        elapsed = time.time() - received
+        cpu_delta = total - previous_frame.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0)
+        if elapsed > 0:
+            cpu = 100.0 * cpu_delta / (elapsed * 1e7 * frame['num_procs'])
+    return Usage(cpu=max(cpu, 0.0), memory=memory / 1024.0 / 1024.0)
+
+
+def _cpu(value):
+    """Returns the cpu percent of a manifest value like '10%'."""
+    if value is None:
+        return 0
+    return int(str(value).rstrip('%'))
+
+
+def _memory(value):
+    """Returns the MB of a manifest value like '50m' or '1G'."""
+    if value is None:
+        return 0
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value) / 1024 / 1024
@@ -0,0 +1,180 @@
+"""Elasticity.
+
+Resize the cpu limit of the containers with the idleness of the desktop: while
+the desktop is deeply idle the limit is raised step by step up to the ceiling
+declared by the manifest, and it shrinks back toward the floor (the manifest
+cpu) as the user's load returns. The limit drops back to the floor as soon as
+the user is active again, or when the idleness of the desktop is unknown.
+The user's load is the host cpu less what the containers use, as measured
+by gcp_wc.container_stats.
+
+A manifest opts in by declaring its ceiling:
+
+    cpu: 10%
+    cpu_ceiling: 60%
+
+Other changes of a container are rate-limited to avoid oscillation.
+"""
+import os
+import time
+import logging
+
+from gcp_wc import config
+from gcp_wc import container_stats
+
+# Seconds without user input for the desktop to be deeply idle.
+DEFAULT_DEEP_IDLE = 300
+# Host cpu percent used by the user under which limits grow, over which
+# they shrink.
+DEFAULT_LOW_LOAD = 20
+DEFAULT_HIGH_LOAD = 50
+# Cpu percent added or removed per change.
+DEFAULT_STEP = 10
+# Seconds between two changes of a container.
+DEFAULT_MIN_INTERVAL = 30
+
+CPU_PERIOD = 100000
+
+
+class ElasticityController(object):
+    """Raise and shrink the cpu limits of the elastic containers."""
+
+    def __init__(self, client, deep_idle=DEFAULT_DEEP_IDLE,
+                 low_load=DEFAULT_LOW_LOAD, high_load=DEFAULT_HIGH_LOAD,
+                 step=DEFAULT_STEP, min_interval=DEFAULT_MIN_INTERVAL,
+                 cpu_count=None, stats=None):
+        """
+        client: container runtime
+        deep_idle: seconds without input for the desktop to be deeply idle
+        low_load, high_load: user cpu percent thresholds
+        step: cpu percent added or removed per change
+        min_interval: seconds between two changes of a container
+        stats: StatsCollector of the running instances, for their cpu usage
+        """
+        self.client = client
+        self.deep_idle = deep_idle
+        self.low_load = low_load
+        self.high_load = high_load
+        self.step = step
+        self.min_interval = min_interval
+        self.cpu_count = cpu_count or os.cpu_count() or 1
+        self.stats = stats
+        # container_id -> (cpu percent, time of the last change)
+        self.limits = {}
+        self._backend = None
+
+    @classmethod
+    def from_env(cls, client, root):
+        """Returns the ElasticityController of the agent configuration,
+        measuring the instances of the work directory root.
+        """
+        settings = config.current()
+        return cls(
+            client,
+            deep_idle=settings.elasticDeepIdle / 1000.0,
+            step=settings.elasticStep,
+            min_interval=settings.elasticMinInterval / 1000.0,
+            stats=container_stats.StatsCollector(client, root),
+        )
+
+    def close(self):
+        """Stop measuring the containers."""
+        if self.stats is not None:
+            self.stats.close()
+
+    def sample(self, instances):
+        """Resize the limits of the instances from the host utilization."""
+        if not instances:
+            self.limits.clear()
+            return 0
+        import psutil
+        if self._backend is None:
+            from gcp_wc import priority
+            self._backend = priority.PsutilBackend()
+        usage = None
+        if self.stats is not None:
+            self.stats.refresh()
+            usage = dict((container_id, measured.cpu)
+                         for container_id, measured in self.stats.container_usage().items())
+        return self.tick(instances, psutil.cpu_percent(interval=None),
+                         self._backend.idle_seconds(), usage=usage)
+
+    def tick(self, instances, host_cpu, idle, now=None, usage=None):
+        """Resize the limits of the instances.
+
+        :param ``dict`` instances:
+            container_id -> (floor, ceiling) in cpu percent of the host.
+        :param ``float`` host_cpu:
+            Cpu percent of the host in use, including the containers.
+        :param idle:
+            Seconds since the last user input, None if unknown.
+        :param ``dict`` usage:
+            container_id -> cpu percent of the host it uses; the containers
+            not measured are taken to use their limit.
+        :returns ``int``:
+            Number of containers updated.
+        """
+        now = now or time.time()
+        for container_id in set(self.limits) - set(instances):
+            del self.limits[container_id]
+
+        # What the containers do not use is the user's load.
+        usage = usage or {}
+        user_load = max(host_cpu - sum(
+            usage.get(container_id, self.limits.get(container_id, (floor, 0))[0])
+            for container_id, (floor, _ceiling) in instances.items()
+        ), 0)
+        deeply_idle = idle is not None and idle >= self.deep_idle
+        grow = deeply_idle and user_load < self.low_load
+        shrink = user_load > self.high_load
+
+        updated = 0
+        for container_id, (floor, ceiling) in instances.items():
+            if container_id not in self.limits:
+                # Its limit is unknown, e.g. raised before the service
+                # restarted: start over from the floor.
+                if self._update(container_id, floor):
+                    self.limits[container_id] = (floor, now)
+                    updated += 1
+                continue
+            current, changed_at = self.limits[container_id]
+            if not deeply_idle:
+                # The user is back, give the cores back at once.
+                target = floor
+            elif grow:
+                target = min(current + self.step, ceiling)
+            elif shrink:
+                target = max(current - self.step, floor)
+            else:
+                target = current
+            if target == current:
+                continue
+            if (target != floor and changed_at is not None and
+                    now - changed_at < self.min_interval):
+                continue
+            if self._update(container_id, target):
+                self.limits[container_id] = (target, now)
+                updated += 1
+        return updated
+
+    def _update(self, container_id, cpu):
+        try:
+            self.client.update(
+                container_id,
+                cpu_period=CPU_PERIOD,
+                cpu_quota=int(CPU_PERIOD * self.cpu_count * cpu / 100)
+            )
+            logging.info('Cpu limit of %s: %s%%', container_id, cpu)
+            return True
+        except Exception as e:
+            logging.info('Cannot update %s: %s', container_id, e)
+            return False
+
+
+def elastic_limits(manifest_data):
+    """Returns the (floor, ceiling) cpu percent of a manifest, None if static."""
+    ceiling = manifest_data.get('cpu_ceiling')
+    if ceiling is None:
+        return None
+    floor = int(str(manifest_data['cpu']).rstrip('%'))
+    return floor, max(int(str(ceiling).rstrip('%')), floor)
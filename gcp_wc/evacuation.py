@@ -0,0 +1,166 @@
+"""Evacuation.
+
+Give the desktop back to its user when the screen is unlocked: the presence
+is dropped first so that nothing new is scheduled, the placements are deleted
+in one transaction, then the containers are stopped in parallel with a hard
+deadline. The duration of each phase is recorded.
+"""
+import os
+import glob
+import time
+import logging
+import collections
+import concurrent.futures
+from kazoo.exceptions import NoNodeError
+
+from gcp_wc import lazy
+
+yaml = lazy.module('yaml')
+
+SERVER_PRESENCE = '/server.presence'
+PLACEMENT = '/placement'
+
+CACHE_DIR = 'cache'
+RUNNING_DIR = 'running'
+CLEANUP_DIR = 'cleanup'
+
+# Seconds given to the containers to be stopped.
+DEFAULT_DEADLINE = 1.0
+# Number of containers stopped at the same time.
+DEFAULT_WORKERS = 16
+
+
+def evacuate(zk, client, root, hostname, stop_services=None,
+             deadline=DEFAULT_DEADLINE, workers=DEFAULT_WORKERS):
+    """Evacuate the desktop.
+
+    :param stop_services:
+        Called without arguments to stop the agent services, last.
+    :param ``float`` deadline:
+        Seconds to wait for the containers to be stopped, the containers
+        still being stopped are left to the cleanup service.
+    :returns ``OrderedDict``:
+        Phase name to duration in seconds.
+    """
+    phases = collections.OrderedDict()
+
+    started = time.time()
+    _delete(zk, SERVER_PRESENCE + '/' + hostname)
+    phases['presence'] = time.time() - started
+
+    started = time.time()
+    apps = delete_placements(zk, hostname)
+    phases['placements'] = time.time() - started
+
+    started = time.time()
+    container_ids = revoke_instances(root)
+    stopped = kill_containers(client, container_ids, deadline, workers)
+    phases['containers'] = time.time() - started
+
+    if stop_services is not None:
+        started = time.time()
+        stop_services()
+        phases['services'] = time.time() - started
+
+    if apps or container_ids:
+        logging.info('Evacuated %d placements, stopped %d/%d containers: %s',
+                     len(apps), stopped, len(container_ids),
+                     ', '.join('%s %.3fs' % phase for phase in phases.items()))
+    return phases
+
+
+def delete_placements(zk, hostname):
+    """Delete all the placements of the host in a single transaction.
+
+    :returns ``list``:
+        The names of the apps that were placed.
+    """
+    placement = PLACEMENT + '/' + hostname
+    try:
+        apps = zk.get_children(placement)
+    except NoNodeError:
+        return []
+    if not apps:
+        return apps
+    transaction = zk.transaction()
+    for app in apps:
+        transaction.delete(placement + '/' + app)
+    results = transaction.commit()
+    if any(isinstance(result, Exception) for result in results):
+        # Some placement went away meanwhile, the transaction was rolled
+        # back: delete the others one by one.
+        for app in apps:
+            _delete(zk, placement + '/' + app)
+    return apps
+
+
+def revoke_instances(root):
+    """Revoke the local instances, as if they were no longer placed.
+
+    The running manifests are moved to the cleanup directory and the cache
+    is emptied so that nothing is configured again.
+
+    :returns ``list``:
+        The ids of the containers of the running instances.
+    """
+    container_ids = []
+    for manifest in glob.glob(os.path.join(os.path.join(root, RUNNING_DIR), '*')):
+        app = os.path.basename(manifest)
+        try:
+            with open(manifest) as f:
+                manifest_data = yaml.safe_load(f)
+            # Moved at once, the cleanup service never reads a partial copy.
+            os.replace(manifest, os.path.join(os.path.join(root, CLEANUP_DIR), app))
+        except (IOError, OSError, yaml.YAMLError) as e:
+            logging.info('Cannot revoke %s: %s', app, e)
+            continue
+        _unlink(os.path.join(os.path.join(root, CACHE_DIR), app))
+        if isinstance(manifest_data, dict) and manifest_data.get('container_id'):
+            container_ids.append(manifest_data['container_id'])
+    for manifest in glob.glob(os.path.join(os.path.join(root, CACHE_DIR), '*')):
+        _unlink(manifest)
+    return container_ids
+
+
+def kill_containers(client, container_ids, deadline=DEFAULT_DEADLINE,
+                    workers=DEFAULT_WORKERS):
+    """Kill the containers in parallel, waiting at most deadline seconds.
+
+    :returns ``int``:
+        The number of containers killed in time.
+    """
+    if not container_ids:
+        return 0
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(workers, len(container_ids))
+    )
+    futures = [
+        executor.submit(_kill, client, container_id)
+        for container_id in container_ids
+    ]
+    done, _not_done = concurrent.futures.wait(futures, timeout=deadline)
+    executor.shutdown(wait=False)
+    return sum(1 for future in done if future.result())
+
+
+def _kill(client, container_id):
+    try:
+        client.kill(container_id)
+        return True
+    except Exception as e:
+        logging.info('Cannot kill %s: %s', container_id, e)
+        return False
+
+
+def _delete(zk, path):
+    try:
+        zk.delete(path)
+    except NoNodeError:
+        pass
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -13,27 +13,31 @@ Applications that are scheduled to run on the desktop are mirrored in the
 import os
 import glob
 import time
-import yaml
-import kazoo
-import docker
+import kazoo.exceptions
 import tempfile
 import socket
 import collections
 import functools
-import logging.config
-from kazoo.client import KazooClient
+import logging
+import threading
+
+from gcp_wc import config
+from gcp_wc import intent_log
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import runtime
+from gcp_wc import zk_broker
+from gcp_wc import zk_cache
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'eventDaemonSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+yaml = lazy.module('yaml')
 
 _SEEN_FILE = '.seen'
 CACHE_DIR = 'cache'
@@ -55,7 +59,7 @@ class EventDaemonSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -63,46 +67,123 @@ class EventDaemonSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('eventDaemonSVC.txt')
+        config.watch()
+        loop.install(loop.EventActivity('eventDaemon', self.hWaitStop))
+        metrics.serve('eventDaemon', self.root)
+        profiler.control('eventDaemon', self.root)
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts = master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            seen = zk.handler.event_object()
-            # start not ready
-            seen.clear()
-            while True:
-                # Wait for presence node to appear. Once up, syncronize the placement.
-                @zk.DataWatch(path.server_presence(_HOSTNAME))
-                def _server_presence_update(data, _stat, event):
-                    """Watch server presence"""
-                    if data is None and event is None:
-                        # The node is not there yet, wait
-                        logging.info('Server node missing.')
-                        seen.clear()
-                        cache_notify(self.root, False)
-                    elif event is not None and event.type == 'DELETED':
-                        seen.set()
-                        if not zk.exists(path.placement(_HOSTNAME)):
-                            zk.create(path.placement(_HOSTNAME))
-                        apps = zk.get_children(path.placement(_HOSTNAME))
-                        synchronize(zk, apps, self.root)
-                        logging.info('Presence node deleted.')
-                        seen.clear()
-                        cache_notify(self.root, False)
-                    else:
-                        # logging.info('Presence is up.')
-                        seen.set()
-                        if not zk.exists(path.placement(_HOSTNAME)):
-                            zk.create(path.placement(_HOSTNAME))
-                        apps = zk.get_children(path.placement(_HOSTNAME))
-                        synchronize(zk, apps, self.root)
-                    return True
-                if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
-                    break
+            client = runtime.DockerRuntime.from_env()
+            run(self.root, zk, client,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
-def synchronize(zk, expected, root):
+def run(root, zk, client, should_stop):
+    """Mirror the placement of the desktop in the cache directory.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    """
+    zk = zk_cache.mirror(zk, _HOSTNAME, 'eventDaemon')
+    try:
+        _run(root, zk, client, should_stop)
+    finally:
+        zk_cache.close(zk)
+
+def _run(root, zk, client, should_stop):
+    log, pending = intent_log.open_log(root, 'eventDaemon')
+    for intent in pending:
+        unplace(root, client, intent.instance, intent, log)
+    seen = zk.handler.event_object()
+    # start not ready
+    seen.clear()
+    # Set once stopped, for the watches to unregister.
+    done = zk.handler.event_object()
+    # The work is done by the watches, which wake the peers of the loop.
+    pace = loop.Loop('eventDaemon', should_stop)
+    placement = path.placement(_HOSTNAME)
+    watching_children = zk.handler.event_object()
+    # Synchronizations in progress, the log is closed once they are done.
+    synchronizing = threading.Condition()
+    active = [0]
+
+    def _synchronize(apps=None):
+        """Synchronize the cache with the placement, while seen."""
+        with synchronizing:
+            if done.is_set() or not seen.is_set():
+                return
+            active[0] += 1
+        try:
+            if apps is None:
+                if not zk.exists(placement):
+                    zk.create(placement)
+                apps = zk.get_children(placement)
+            if synchronize(zk, apps, root, client, log):
+                pace.notify()
+        finally:
+            with synchronizing:
+                active[0] -= 1
+                synchronizing.notify_all()
+
+    # Wait for presence node to appear. Once up, syncronize the placement.
+    @zk.DataWatch(path.server_presence(_HOSTNAME))
+    def _server_presence_update(data, _stat, event):
+        """Watch server presence"""
+        if done.is_set():
+            return False
+        if data is None and event is None:
+            # The node is not there yet, wait
+            logging.info('Server node missing.')
+            seen.clear()
+            cache_notify(root, False)
+        elif event is not None and event.type == 'DELETED':
+            seen.set()
+            _synchronize()
+            logging.info('Presence node deleted.')
+            seen.clear()
+            cache_notify(root, False)
+        else:
+            # logging.info('Presence is up.')
+            seen.set()
+            _synchronize()
+        return True
+
+    def _placement_children(apps):
+        """Watch the placed apps"""
+        if done.is_set():
+            return False
+        _synchronize(apps)
+        return True
+
+    # Synchronize on each change of the placement. The children watch stops
+    # with the node, it is set again when the node is created again.
+    @zk.DataWatch(placement)
+    def _placement_update(_data, stat):
+        """Watch the placement node"""
+        if done.is_set():
+            return False
+        if stat is None:
+            watching_children.clear()
+        elif not watching_children.is_set():
+            watching_children.set()
+            zk.ChildrenWatch(placement)(_placement_children)
+        return True
+
+    while True:
+        if pace.sleep(0):
+            with synchronizing:
+                done.set()
+                while active[0]:
+                    synchronizing.wait()
+            log.close()
+            break
+
+def synchronize(zk, expected, root, client, log):
     """synchronize local app cache with the expected list.
 
     :param expected:
@@ -113,6 +194,16 @@ def synchronize(zk, expected, root):
         connection with zookeeper
     :type zk:
         "KazooClient"
+    :param client:
+        container runtime
+    :type client:
+        ``ContainerRuntime``
+    :param log:
+        intent log of the service
+    :type log:
+        ``IntentLog``
+    :returns ``bool``:
+        Whether the cache changed.
     """
     expected_set = set(expected)
     current_set = {
@@ -122,39 +213,60 @@ def synchronize(zk, expected, root):
     extra = current_set - expected_set
     missing = expected_set - current_set
 
-    logging.info('expected : %s', ','.join(expected_set))
-    logging.info('actual   : %s', ','.join(current_set))
-    logging.info('extra    : %s', ','.join(extra))
-    logging.info('missing  : %s', ','.join(missing))
+    # Nothing to log when nothing changed, the sets are not even joined.
+    if extra or missing:
+        logging.info('expected : %s', ','.join(expected_set))
+        logging.info('actual   : %s', ','.join(current_set))
+        logging.info('extra    : %s', ','.join(extra))
+        logging.info('missing  : %s', ','.join(missing))
 
     # If app is extra, remove the entry from the cache
     for app in extra:
         if os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), app)):
             with open(os.path.join(os.path.join(root, RUNNING_DIR), app)) as f:
                 manifest_data = yaml.load(stream=f)
-            os.unlink(os.path.join(os.path.join(root, CACHE_DIR), app))
-            os.unlink(os.path.join(os.path.join(root, RUNNING_DIR), app))
-            time.sleep(2)
-            try:
-                client = docker.from_env()
-                if client.containers.get(manifest_data['container_id']).status == 'running':
-                    client.containers.get(manifest_data['container_id']).kill()
-                    client.containers.get(manifest_data['container_id']).remove()
-            except:
-                pass
-            manifest_file = os.path.join(os.path.join(root, CLEANUP_DIR), app)
-            if not os.path.exists(manifest_file):
-                with tempfile.NamedTemporaryFile(dir=os.path.join(root, CLEANUP_DIR),
-                                                 prefix='.%s-' % app,
-                                                 delete=False,
-                                                 mode='w') as temp_manifest:
-                    yaml.dump(manifest_data, stream=temp_manifest)
-                os.rename(temp_manifest.name, manifest_file)
+            intent = log.begin('unplace', app, manifest_data['container_id'])
+            unplace(root, client, app, intent, log, manifest_data)
         logging.info('Deleted cache manifest: %s', app)
 
     # If app is missing, fetch its manifest in the cache
     for app in missing:
         cache(zk, app, root)
+    return bool(extra or missing)
+
+def unplace(root, client, app, intent, log, manifest_data=None):
+    """Remove an app no longer placed: its cache and running manifests, its
+    container, and hand it over to the cleanup.
+
+    Resumes from the last step of the intent when replayed after a crash.
+    """
+    manifest_file = os.path.join(os.path.join(root, CLEANUP_DIR), app)
+    if manifest_data is None:
+        manifest_data = {'container_id': intent.container_id}
+    if intent.step is None:
+        for directory in (CACHE_DIR, RUNNING_DIR):
+            try:
+                os.unlink(os.path.join(os.path.join(root, directory), app))
+            except OSError:
+                pass
+        log.step(intent, 'unlinked', durable=False)
+        time.sleep(config.current().unplaceDelay / 1000.0)
+    if intent.step == 'unlinked':
+        try:
+            if client.state(intent.container_id) == runtime.RUNNING:
+                client.kill(intent.container_id)
+                client.remove(intent.container_id)
+        except:
+            pass
+        log.step(intent, 'killed', durable=False)
+    if not os.path.exists(manifest_file):
+        with tempfile.NamedTemporaryFile(dir=os.path.join(root, CLEANUP_DIR),
+                                         prefix='.%s-' % app,
+                                         delete=False,
+                                         mode='w') as temp_manifest:
+            yaml.dump(manifest_data, stream=temp_manifest)
+        os.rename(temp_manifest.name, manifest_file)
+    log.done(intent)
 
 def cache(zk, app, root):
     """Reads the manifest from Zk and stores it as YAML in <cache>/<app>.
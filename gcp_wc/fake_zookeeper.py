@@ -0,0 +1,409 @@
+"""Fake Zookeeper.
+
+In memory stand-in for KazooClient: the subset of its API the agent uses,
+with the same exceptions, stats and watch semantics, so the agent and the
+Zookeeper broker run without an ensemble.
+
+Watch callbacks are called synchronously on the thread making the change.
+`expire_session` drops the ephemeral nodes and notifies the listeners as a
+real session expiry would.
+"""
+import copy
+import time
+import inspect
+import threading
+
+from kazoo import exceptions
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+from gcp_wc import lazy
+
+kazoo_threading = lazy.module('kazoo.handlers.threading')
+
+SESSION_ID = 0x1000
+
+
+class _Node(object):
+
+    __slots__ = (
+        'data', 'czxid', 'mzxid', 'ctime', 'mtime', 'version', 'cversion',
+        'pzxid', 'ephemeral', 'sequence', 'children',
+    )
+
+    def __init__(self, data, zxid, now, ephemeral):
+        self.data = data
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = now
+        self.version = self.cversion = 0
+        self.ephemeral = ephemeral
+        self.sequence = 0
+        self.children = set()
+
+    def stat(self):
+        return ZnodeStat(
+            czxid=self.czxid, mzxid=self.mzxid, ctime=self.ctime,
+            mtime=self.mtime, version=self.version, cversion=self.cversion,
+            aversion=0, ephemeralOwner=SESSION_ID if self.ephemeral else 0,
+            dataLength=len(self.data), numChildren=len(self.children),
+            pzxid=self.pzxid
+        )
+
+
+class FakeZooKeeper(object):
+    """In memory Zookeeper tree with a KazooClient interface."""
+
+    def __init__(self, hosts=None):
+        self.hosts = hosts
+        self.handler = kazoo_threading.SequentialThreadingHandler()
+        self.state = KazooState.LOST
+        self._lock = threading.RLock()
+        self._zxid = 0
+        self._nodes = {'/': _Node(b'', 0, 0, False)}
+        self._listeners = []
+        self._data_watches = {}
+        self._children_watches = {}
+        # Number of requests, by operation.
+        self.requests = {}
+
+    @property
+    def connected(self):
+        return self.state == KazooState.CONNECTED
+
+    def start(self, timeout=None):
+        self._set_state(KazooState.CONNECTED)
+
+    def stop(self):
+        self._drop_ephemerals()
+        self._set_state(KazooState.LOST)
+
+    def close(self):
+        pass
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def expire_session(self):
+        """Drop the ephemeral nodes and reconnect with a new session."""
+        self._drop_ephemerals()
+        self._set_state(KazooState.LOST)
+        self._set_state(KazooState.CONNECTED)
+
+    def suspend(self):
+        """Lose the connection, keeping the session."""
+        self._set_state(KazooState.SUSPENDED)
+
+    def resume(self):
+        self._set_state(KazooState.CONNECTED)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def exists(self, path, watch=None):
+        self._count('exists')
+        with self._lock:
+            node = self._nodes.get(_normpath(path))
+            return node.stat() if node is not None else None
+
+    def get(self, path, watch=None):
+        self._count('get')
+        with self._lock:
+            node = self._node(path)
+            return node.data, node.stat()
+
+    def get_children(self, path, watch=None, include_data=False):
+        self._count('get_children')
+        with self._lock:
+            node = self._node(path)
+            children = sorted(node.children)
+            if include_data:
+                return children, node.stat()
+            return children
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        self._count('create')
+        with self._lock:
+            created = self._create(path, value, ephemeral, sequence, makepath)
+        self._notify(created, _parent(created), EventType.CREATED)
+        return created
+
+    def ensure_path(self, path, acl=None):
+        self._count('ensure_path')
+        path = _normpath(path)
+        with self._lock:
+            if path in self._nodes:
+                return True
+        try:
+            self.create(path, makepath=True)
+        except exceptions.NodeExistsError:
+            pass
+        return True
+
+    def set(self, path, value, version=-1):
+        self._count('set')
+        with self._lock:
+            stat = self._set(path, value, version)
+        self._notify(_normpath(path), None, EventType.CHANGED)
+        return stat
+
+    def delete(self, path, version=-1, recursive=False):
+        self._count('delete')
+        with self._lock:
+            deleted = self._delete(path, version, recursive)
+        for path in deleted:
+            self._notify(path, _parent(path), EventType.DELETED)
+        return True
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def DataWatch(self, path, func=None):
+        """Call func(data, stat[, event]) now and on each change of the node."""
+        def register(func):
+            path_ = _normpath(path)
+            with self._lock:
+                self._data_watches.setdefault(path_, []).append(func)
+            self._call_data(path_, func)
+            return func
+        if func is None:
+            return register
+        return register(func)
+
+    def ChildrenWatch(self, path, func=None):
+        """Call func(children) now and on each change of the children."""
+        def register(func):
+            path_ = _normpath(path)
+            with self._lock:
+                if path_ not in self._nodes:
+                    return func
+                self._children_watches.setdefault(path_, []).append(func)
+            self._call_children(path_, func)
+            return func
+        if func is None:
+            return register
+        return register(func)
+
+    def _count(self, operation):
+        self._read(operation)
+        if self.state != KazooState.CONNECTED:
+            raise exceptions.ConnectionLoss()
+
+    def _read(self, operation):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def _node(self, path):
+        node = self._nodes.get(_normpath(path))
+        if node is None:
+            raise exceptions.NoNodeError(path)
+        return node
+
+    def _next_zxid(self):
+        self._zxid += 1
+        return self._zxid
+
+    def _create(self, path, value, ephemeral, sequence, makepath):
+        path = _normpath(path)
+        if value is None:
+            value = b''
+        if not isinstance(value, bytes):
+            raise TypeError('value must be a byte string')
+        parent_path = _parent(path)
+        parent = self._nodes.get(parent_path)
+        if parent is None:
+            if not makepath:
+                raise exceptions.NoNodeError(parent_path)
+            self._create(parent_path, b'', False, False, True)
+            parent = self._nodes[parent_path]
+        if parent.ephemeral:
+            raise exceptions.NoChildrenForEphemeralsError(parent_path)
+        if sequence:
+            path = '%s%010d' % (path, parent.sequence)
+        if path in self._nodes:
+            raise exceptions.NodeExistsError(path)
+        zxid = self._next_zxid()
+        self._nodes[path] = _Node(value, zxid, int(time.time() * 1000), ephemeral)
+        parent.children.add(path.rsplit('/', 1)[1])
+        parent.cversion += 1
+        parent.sequence += 1
+        parent.pzxid = zxid
+        return path
+
+    def _set(self, path, value, version):
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise exceptions.BadVersionError(path)
+        node.data = value
+        node.version += 1
+        node.mzxid = self._next_zxid()
+        node.mtime = int(time.time() * 1000)
+        return node.stat()
+
+    def _delete(self, path, version, recursive):
+        path = _normpath(path)
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise exceptions.BadVersionError(path)
+        deleted = []
+        if node.children:
+            if not recursive:
+                raise exceptions.NotEmptyError(path)
+            for child in sorted(node.children):
+                deleted.extend(self._delete(path + '/' + child, -1, True))
+        del self._nodes[path]
+        parent = self._nodes[_parent(path)]
+        parent.children.discard(path.rsplit('/', 1)[1])
+        parent.cversion += 1
+        parent.pzxid = self._next_zxid()
+        deleted.append(path)
+        return deleted
+
+    def _check(self, path, version):
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise exceptions.BadVersionError(path)
+        return True
+
+    def _drop_ephemerals(self):
+        with self._lock:
+            ephemerals = [path for path, node in self._nodes.items() if node.ephemeral]
+            for path in ephemerals:
+                self._delete(path, -1, False)
+        for path in ephemerals:
+            self._notify(path, _parent(path), EventType.DELETED)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        for listener in list(self._listeners):
+            listener(state)
+
+    def _notify(self, data_path, children_path=None, event_type=None):
+        with self._lock:
+            data_watches = list(self._data_watches.get(data_path, ()))
+            children_watches = list(self._children_watches.get(children_path, ()))
+        event = WatchedEvent(event_type, KazooState.CONNECTED, data_path)
+        for func in data_watches:
+            self._call_data(data_path, func, event)
+        for func in children_watches:
+            self._call_children(children_path, func)
+
+    def _call_data(self, path, func, event=None):
+        # Each call stands for the read a watch makes.
+        self._read('watch')
+        with self._lock:
+            node = self._nodes.get(path)
+            data, stat = (node.data, node.stat()) if node is not None else (None, None)
+        if call_data_watch(func, data, stat, event) is False:
+            self._unwatch(self._data_watches, path, func)
+
+    def _call_children(self, path, func):
+        self._read('watch')
+        with self._lock:
+            node = self._nodes.get(path)
+            if node is None:
+                # As kazoo, a children watch stops with its node.
+                self._unwatch(self._children_watches, path, func)
+                return
+            children = sorted(node.children)
+        if func(children) is False:
+            self._unwatch(self._children_watches, path, func)
+
+    def _unwatch(self, watches, path, func):
+        with self._lock:
+            funcs = watches.get(path, [])
+            if func in funcs:
+                funcs.remove(func)
+            if not funcs:
+                watches.pop(path, None)
+
+
+class _Transaction(object):
+    """Operations committed atomically."""
+
+    def __init__(self, zk):
+        self.zk = zk
+        self.operations = []
+        self.committed = False
+
+    def create(self, path, value=b'', acl=None, ephemeral=False, sequence=False):
+        self.operations.append(('create', (path, value, ephemeral, sequence, False)))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', (path, version, False)))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set', (path, value, version)))
+
+    def check(self, path, version):
+        self.operations.append(('check', (path, version)))
+
+    def commit(self):
+        """Returns the results of the operations, exceptions if it failed."""
+        zk = self.zk
+        zk._count('transaction')
+        self.committed = True
+        with zk._lock:
+            nodes = copy.deepcopy(zk._nodes)
+            zxid = zk._zxid
+            results = []
+            changed = []
+            for operation, args in self.operations:
+                try:
+                    result = getattr(zk, '_' + operation)(*args)
+                except exceptions.ZookeeperError as e:
+                    zk._nodes, zk._zxid = nodes, zxid
+                    failed = len(results)
+                    return [exceptions.RolledBackError() if index != failed else e
+                            for index in range(len(self.operations))]
+                results.append(result)
+                if operation == 'create':
+                    changed.append((result, _parent(result), EventType.CREATED))
+                elif operation == 'delete':
+                    changed.extend((path, _parent(path), EventType.DELETED) for path in result)
+                    results[-1] = True
+                elif operation == 'set':
+                    changed.append((_normpath(args[0]), None, EventType.CHANGED))
+        for data_path, children_path, event_type in changed:
+            zk._notify(data_path, children_path, event_type)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not exc_type:
+            self.commit()
+
+
+def call_data_watch(func, data, stat, event):
+    """Call a data watch function, with the event if it takes one, as kazoo."""
+    try:
+        inspect.signature(func).bind(data, stat, event)
+    except TypeError:
+        return func(data, stat)
+    return func(data, stat, event)
+
+
+def _normpath(path):
+    if not path.startswith('/'):
+        path = '/' + path
+    if len(path) > 1:
+        path = path.rstrip('/')
+    return path
+
+
+def _parent(path):
+    return path.rsplit('/', 1)[0] or '/'
@@ -0,0 +1,161 @@
+"""Freeze.
+
+Opt-in alternative to revoking the placed instances when the screen is
+unlocked: the containers are paused and the desktop is marked unavailable,
+keeping its placements. If the screen is locked again within the grace period
+the containers are resumed, otherwise the normal revoke path runs.
+
+The time from the lock to serving again is tracked for both paths.
+"""
+import os
+import glob
+import time
+import logging
+import collections
+import concurrent.futures
+from kazoo.exceptions import NoNodeError
+
+from gcp_wc import lazy
+
+yaml = lazy.module('yaml')
+
+SERVER_PRESENCE = '/server.presence'
+
+RUNNING_DIR = 'running'
+
+# Milliseconds the containers stay paused before they are revoked.
+DEFAULT_GRACE_PERIOD = 300000
+
+# Number of time-to-serving samples kept per path.
+_SAMPLES = 100
+
+
+class FreezeManager(object):
+    """Pause the running containers and resume them."""
+
+    def __init__(self, client, root, grace_period=DEFAULT_GRACE_PERIOD, workers=16):
+        """
+        client: container runtime
+        root: work directory
+        grace_period: milliseconds the containers stay paused
+        workers: number of containers paused or resumed at the same time
+        """
+        self.client = client
+        self.root = root
+        self.grace_period = grace_period
+        self.workers = workers
+        self.frozen_at = None
+        self.container_ids = []
+
+    def is_frozen(self):
+        return self.frozen_at is not None
+
+    def expired(self, now=None):
+        """Returns True once the containers are paused for the grace period."""
+        if self.frozen_at is None:
+            return False
+        return ((now or time.time()) - self.frozen_at) * 1000 >= self.grace_period
+
+    def freeze(self, zk, hostname):
+        """Mark the desktop unavailable and pause the running containers.
+
+        :returns ``bool``:
+            False if some container could not be paused, the paused ones
+            are resumed and the caller should revoke the instances instead.
+        """
+        try:
+            zk.delete(SERVER_PRESENCE + '/' + hostname)
+        except NoNodeError:
+            pass
+        container_ids = running_containers(self.root)
+        paused = self._each('pause', container_ids)
+        if len(paused) != len(container_ids):
+            self._each('unpause', paused)
+            return False
+        self.container_ids = paused
+        self.frozen_at = time.time()
+        logging.info('Froze %d containers', len(paused))
+        return True
+
+    def thaw(self):
+        """Resume the paused containers."""
+        resumed = self._each('unpause', self.container_ids)
+        logging.info('Resumed %d/%d containers after %.1fs', len(resumed),
+                     len(self.container_ids), time.time() - self.frozen_at)
+        self.container_ids = []
+        self.frozen_at = None
+        return resumed
+
+    def _each(self, action, container_ids):
+        """Apply action to the containers in parallel, returns the ids done."""
+        if not container_ids:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.workers, len(container_ids))) as executor:
+            results = executor.map(
+                lambda container_id: self._apply(action, container_id),
+                container_ids
+            )
+            return [
+                container_id
+                for container_id, done in zip(container_ids, results) if done
+            ]
+
+    def _apply(self, action, container_id):
+        try:
+            getattr(self.client, action)(container_id)
+            return True
+        except Exception as e:
+            logging.info('Cannot %s %s: %s', action, container_id, e)
+            return False
+
+
+class ServingTimer(object):
+    """Track the time from a lock to serving again.
+
+    "resume" samples are taken when frozen containers are resumed,
+    "reschedule" samples when an instance runs again after a revoke.
+    """
+
+    def __init__(self):
+        self.locked_at = None
+        self.path = None
+        self.samples = collections.defaultdict(
+            lambda: collections.deque(maxlen=_SAMPLES)
+        )
+
+    def locked(self, path, now=None):
+        """Start timing from a lock, for the given path."""
+        self.locked_at = now or time.time()
+        self.path = path
+
+    def serving(self, now=None):
+        """Record the time to serving, if timing."""
+        if self.locked_at is None:
+            return None
+        elapsed = (now or time.time()) - self.locked_at
+        self.samples[self.path].append(elapsed)
+        logging.info('Serving %.1fs after lock (%s, mean %.1fs)', elapsed,
+                     self.path, self.mean(self.path))
+        self.locked_at = None
+        return elapsed
+
+    def mean(self, path):
+        samples = self.samples[path]
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+
+def running_containers(root):
+    """Returns the container ids of the running manifests."""
+    container_ids = []
+    for manifest in glob.glob(os.path.join(os.path.join(root, RUNNING_DIR), '*')):
+        try:
+            with open(manifest) as f:
+                manifest_data = yaml.safe_load(f)
+        except (IOError, OSError, yaml.YAMLError):
+            continue
+        if isinstance(manifest_data, dict) and manifest_data.get('container_id'):
+            container_ids.append(manifest_data['container_id'])
+    return container_ids
@@ -0,0 +1,160 @@
+"""Instance Index.
+
+Containers are labelled at create time with the name of their instance, the
+hash of its manifest and the host, so the containers of the desktop map back
+to their instances from a single labelled listing, without the manifests of
+the running directory.
+
+On startup, `recover` rebuilds the index and handles the containers left by
+an agent that died between the creation of a container and the write of its
+running manifest: a container whose instance is still cached with the same
+manifest is adopted (started if it was only created), the others are
+removed.
+"""
+import os
+import json
+import logging
+import hashlib
+import collections
+
+from gcp_wc import lazy
+from gcp_wc import runtime
+
+yaml = lazy.module('yaml')
+
+LABEL_INSTANCE = 'gcp_wc.instance'
+LABEL_MANIFEST_HASH = 'gcp_wc.manifest_hash'
+LABEL_HOST = 'gcp_wc.host'
+
+CACHE_DIR = 'cache'
+RUNNING_DIR = 'running'
+
+
+def manifest_hash(manifest_data):
+    """Returns the hash of a manifest, without its container id."""
+    manifest_data = {
+        key: value for key, value in manifest_data.items() if key != 'container_id'
+    }
+    return hashlib.sha1(
+        json.dumps(manifest_data, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+def labels(instance_name, manifest_data, hostname):
+    """Returns the labels of the container of an instance."""
+    return {
+        LABEL_INSTANCE: instance_name,
+        LABEL_MANIFEST_HASH: manifest_hash(manifest_data),
+        LABEL_HOST: hostname,
+    }
+
+
+class InstanceIndex(object):
+    """Instances of the labelled containers of a host."""
+
+    def __init__(self, summaries=()):
+        """
+        summaries: ContainerSummary of the labelled containers
+        """
+        self.by_container = {}
+        self.by_instance = collections.defaultdict(list)
+        for summary in summaries:
+            instance_name = summary.labels.get(LABEL_INSTANCE)
+            if instance_name is None:
+                continue
+            self.by_container[summary.id] = instance_name
+            self.by_instance[instance_name].append(summary)
+
+    @classmethod
+    def rebuild(cls, client, hostname):
+        """Returns the index of the containers of a host, in one listing."""
+        return cls(client.containers(
+            all=True, filters={'label': [LABEL_HOST + '=' + hostname]}
+        ))
+
+    def instance(self, container_id):
+        """Returns the instance of a container, None if not labelled."""
+        return self.by_container.get(container_id)
+
+    def containers(self, instance_name):
+        """Returns the ContainerSummary of the containers of an instance."""
+        return list(self.by_instance.get(instance_name, ()))
+
+
+def instance_containers(client, instance_name):
+    """Returns the ids of the containers labelled with an instance."""
+    return [
+        summary.id for summary in client.containers(
+            all=True, filters={'label': [LABEL_INSTANCE + '=' + instance_name]}
+        )
+    ]
+
+
+def recover(client, root, hostname):
+    """Adopt or remove the containers of the instances not running yet.
+
+    :returns ``tuple``:
+        The adopted {instance: (container id, manifest)}, and the ids of the
+        removed containers.
+    """
+    index = InstanceIndex.rebuild(client, hostname)
+    running = set(os.listdir(os.path.join(root, RUNNING_DIR)))
+    adopted = {}
+    removed = []
+    for instance_name, summaries in index.by_instance.items():
+        keep = None
+        if instance_name in running:
+            if len(summaries) == 1:
+                continue
+            # Only duplicates need the manifest, to tell which one runs.
+            keep = _running_container(root, instance_name)
+        else:
+            manifest_data = _cached_manifest(root, instance_name)
+            if manifest_data is not None:
+                keep = _adoptable(summaries, manifest_hash(manifest_data))
+            if keep is not None:
+                try:
+                    if client.state(keep) == runtime.CREATED:
+                        client.start(keep)
+                    adopted[instance_name] = (keep, manifest_data)
+                    logging.info('adopted %s: %s', instance_name, keep)
+                except runtime.ContainerError as e:
+                    logging.info('cannot adopt %s: %s', instance_name, e)
+                    keep = None
+        for summary in summaries:
+            if summary.id == keep:
+                continue
+            try:
+                client.remove(summary.id, force=True)
+                removed.append(summary.id)
+                logging.info('removed orphan of %s: %s', instance_name, summary.id)
+            except runtime.ContainerError as e:
+                logging.info('cannot remove %s: %s', summary.id, e)
+    return adopted, removed
+
+
+def _adoptable(summaries, expected_hash):
+    """Returns the container to adopt: running first, then created."""
+    candidates = [
+        summary for summary in summaries
+        if summary.labels.get(LABEL_MANIFEST_HASH) == expected_hash and
+        summary.state in (runtime.RUNNING, runtime.CREATED)
+    ]
+    candidates.sort(key=lambda summary: summary.state != runtime.RUNNING)
+    return candidates[0].id if candidates else None
+
+
+def _cached_manifest(root, instance_name):
+    try:
+        with open(os.path.join(os.path.join(root, CACHE_DIR), instance_name)) as f:
+            return yaml.safe_load(f)
+    except (IOError, OSError, yaml.YAMLError):
+        return None
+
+
+def _running_container(root, instance_name):
+    try:
+        with open(os.path.join(os.path.join(root, RUNNING_DIR), instance_name)) as f:
+            return yaml.safe_load(f).get('container_id')
+    except (IOError, OSError, AttributeError, yaml.YAMLError):
+        return None
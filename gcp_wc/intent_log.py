@@ -0,0 +1,199 @@
+"""Intent Log.
+
+Write-ahead log of the multi-step operations of a service. Before an
+operation changes anything, its intent (operation, instance, container id,
+step) is appended to the log; each step is appended as it completes, and the
+operation is marked done at the end. After a crash, only the intents not
+done are replayed or rolled back on startup, instead of re-deriving the
+state of every instance.
+
+Records are JSON lines. The appends that must be durable before the change
+they announce wait for an fsync, shared by the appends made meanwhile (group
+commit); the other appends are synced with the next one. The log is
+rewritten with the pending intents only when opened and whenever it grows
+past its compaction size.
+"""
+import os
+import json
+import logging
+import threading
+
+from gcp_wc import config
+from gcp_wc import metrics
+
+INTENTS_DIR = 'intents'
+
+# Bytes after which the log is compacted.
+DEFAULT_COMPACT_SIZE = 64 * 1024
+
+DONE = 'done'
+
+
+class Intent(object):
+    """An operation in flight."""
+
+    __slots__ = (
+        'id',
+        'operation',
+        'instance',
+        'container_id',
+        'step',
+    )
+
+    def __init__(self, id, operation, instance, container_id=None, step=None):
+        self.id = id
+        self.operation = operation
+        self.instance = instance
+        self.container_id = container_id
+        self.step = step
+
+    def __repr__(self):
+        return 'Intent(%d, %s, %s, %s, %s)' % (
+            self.id, self.operation, self.instance, self.container_id, self.step)
+
+    def record(self):
+        return [self.id, self.operation, self.instance, self.container_id, self.step]
+
+
+class IntentLog(object):
+    """Append-only log of the intents of a service."""
+
+    def __init__(self, path, compact_size=DEFAULT_COMPACT_SIZE):
+        """
+        path: file of the log
+        compact_size: bytes after which the log is compacted
+        """
+        self.path = path
+        self.compact_size = compact_size
+        self.pending = {}
+        self.existed = False
+        self.syncs = 0
+        self._next_id = 1
+        self._fd = None
+        self._size = 0
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._cond = threading.Condition()
+
+    def open(self):
+        """Read the log, keep its pending intents only, returns them."""
+        self.existed = os.path.exists(self.path)
+        if self.existed:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        intent = Intent(*json.loads(line.decode('utf-8')))
+                    except (ValueError, TypeError):
+                        # Torn by a crash while being appended.
+                        continue
+                    self._next_id = max(self._next_id, intent.id + 1)
+                    if intent.step == DONE:
+                        self.pending.pop(intent.id, None)
+                    else:
+                        self.pending[intent.id] = intent
+        self._rewrite()
+        return sorted(self.pending.values(), key=lambda intent: intent.id)
+
+    def begin(self, operation, instance, container_id=None):
+        """Record an operation about to start, returns its Intent."""
+        with self._cond:
+            intent = Intent(self._next_id, operation, instance, container_id)
+            self._next_id += 1
+            self.pending[intent.id] = intent
+        self._append(intent, durable=True)
+        return intent
+
+    def find(self, operation, instance):
+        """Returns the pending intent of an operation on an instance, None if none."""
+        with self._cond:
+            for intent in self.pending.values():
+                if intent.operation == operation and intent.instance == instance:
+                    return intent
+        return None
+
+    def step(self, intent, step, container_id=None, durable=True):
+        """Record the step an operation is about to take or just took."""
+        intent.step = step
+        if container_id is not None:
+            intent.container_id = container_id
+        self._append(intent, durable=durable)
+
+    def done(self, intent):
+        """Record an operation completed."""
+        with self._cond:
+            self.pending.pop(intent.id, None)
+        done = Intent(intent.id, intent.operation, intent.instance, intent.container_id, DONE)
+        self._append(done, durable=False)
+        with self._cond:
+            if self._size > self.compact_size:
+                self._sync(self._written)
+                # Not under the fsync of another thread.
+                while self._syncing:
+                    self._cond.wait()
+                self._rewrite()
+
+    def close(self):
+        """Sync and close the log."""
+        with self._cond:
+            if self._fd is not None:
+                self._sync(self._written)
+                os.close(self._fd)
+                self._fd = None
+
+    def _append(self, intent, durable):
+        line = (json.dumps(intent.record(), separators=(',', ':')) + '\n').encode('utf-8')
+        with self._cond:
+            os.write(self._fd, line)
+            self._size += len(line)
+            self._written += 1
+            if durable:
+                self._sync(self._written)
+
+    def _sync(self, written):
+        """Wait until the appends up to written are on disk, the lock held."""
+        while self._synced < written:
+            if self._syncing:
+                self._cond.wait()
+                continue
+            self._syncing = True
+            target = self._written
+            self._cond.release()
+            try:
+                os.fsync(self._fd)
+            finally:
+                self._cond.acquire()
+                self._syncing = False
+                self.syncs += 1
+                self._synced = max(self._synced, target)
+                self._cond.notify_all()
+
+    def _rewrite(self):
+        """Replace the log with the pending intents."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            for intent in sorted(self.pending.values(), key=lambda intent: intent.id):
+                f.write((json.dumps(intent.record(), separators=(',', ':')) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+        self._size = os.path.getsize(self.path)
+
+
+def open_log(root, service):
+    """Returns the opened IntentLog of a service and its pending intents."""
+    log = IntentLog(os.path.join(os.path.join(root, INTENTS_DIR), service + '.log'),
+                    compact_size=config.current().intentLogCompactSize)
+    pending = log.open()
+    metrics.gauge('gcp_wc_intents_pending', 'Operations in flight, by service.', ('service',)).set_function(
+        lambda: len(log.pending), service)
+    if pending:
+        logging.info('%s intents pending: %r', service, pending)
+    return log, pending
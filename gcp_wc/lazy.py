@@ -0,0 +1,31 @@
+"""Lazy Imports.
+
+`module(name)` returns a stand-in for a module that imports it on first
+attribute access. The services import their heavy dependencies (Zookeeper
+client, YAML, psutil) this way, so that starting a service, or running its
+command line to install it, only pays for them once they are used.
+"""
+import sys
+import types
+import importlib
+import threading
+
+_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """Module imported on first attribute access."""
+
+    def __getattr__(self, attr):
+        with _lock:
+            module = importlib.import_module(self.__name__)
+        # Later accesses find the attributes without going through here.
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def module(name):
+    """Returns the module of that name, imported on first use."""
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
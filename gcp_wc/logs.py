@@ -0,0 +1,168 @@
+"""Logs.
+
+Logging setup of the services. The threads of a service put their records
+on a queue, a background thread writes them to the log file of the service,
+rotated by size, and to the console.
+
+The records below ERROR are throttled on the queue side, per call site: a
+line repeating the previous one of its call site is suppressed (and counted
+on the next different line), and a call site logs at most a number of
+records per period (the suppressed ones are counted on the next one let
+through).
+"""
+import os
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+
+from gcp_wc import config
+from gcp_wc import metrics
+
+LOG_DIR = 'log'
+
+FORMAT = '# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s'
+
+# Bytes of a log file before it is rotated, and rotated files kept.
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+# Records of a call site let through per period, in seconds.
+DEFAULT_RATE = 30
+DEFAULT_PERIOD = 60
+# Seconds after which a repeated line is logged again.
+DEFAULT_REPEAT_INTERVAL = 3600
+
+_listener = None
+_lock = threading.Lock()
+
+
+class RepeatFilter(logging.Filter):
+    """Suppress the lines repeating the previous one of their call site."""
+
+    def __init__(self, interval=DEFAULT_REPEAT_INTERVAL, clock=time.time):
+        super(RepeatFilter, self).__init__()
+        self.interval = interval
+        self.clock = clock
+        # call site -> [message, time logged, times repeated]
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        with self._lock:
+            return self._filter(record)
+
+    def _filter(self, record):
+        key = (record.pathname, record.lineno)
+        message = record.getMessage()
+        now = self.clock()
+        last = self._last.get(key)
+        if last is not None and last[0] == message and now - last[1] < self.interval:
+            last[2] += 1
+            return False
+        if last is not None and last[2]:
+            _annotate(record, 'previous line repeated %d times' % last[2])
+        self._last[key] = [message, now, 0]
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most rate records of a call site per period."""
+
+    def __init__(self, rate=DEFAULT_RATE, period=DEFAULT_PERIOD, clock=time.time):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.period = period
+        self.clock = clock
+        # call site -> [period start, records let through, records dropped]
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        with self._lock:
+            return self._filter(record)
+
+    def _filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = self.clock()
+        site = self._sites.get(key)
+        if site is None or now - site[0] >= self.period:
+            dropped = site[2] if site is not None else 0
+            site = self._sites[key] = [now, 0, 0]
+            if dropped:
+                _annotate(record, '%d similar lines suppressed' % dropped)
+        if site[1] >= self.rate:
+            site[2] += 1
+            return False
+        site[1] += 1
+        return True
+
+
+def _annotate(record, note):
+    record.msg = '%s [%s]' % (record.getMessage(), note)
+    record.args = None
+
+
+def pipeline(handlers, rate=DEFAULT_RATE, period=DEFAULT_PERIOD,
+             repeat_interval=DEFAULT_REPEAT_INTERVAL, clock=time.time):
+    """Returns the QueueHandler feeding the handlers, and its started
+    QueueListener.
+    """
+    records = queue.Queue()
+    metrics.gauge('gcp_wc_log_queue_depth', 'Records queued for the log writer.').set_function(
+        records.qsize)
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(RepeatFilter(repeat_interval, clock))
+    handler.addFilter(RateLimitFilter(rate, period, clock))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return handler, listener
+
+
+def setup(filename, root=None, level=logging.INFO, console=True):
+    """Log the records of the process to <root>/log/<filename>.
+
+    Only the first call of a process sets up the logging.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return _listener
+        settings = config.current()
+        directory = os.path.join(root or settings.workDirectory, LOG_DIR)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        formatter = logging.Formatter(FORMAT)
+        handlers = [logging.handlers.RotatingFileHandler(
+            os.path.join(directory, filename),
+            maxBytes=settings.logMaxBytes,
+            backupCount=settings.logBackupCount,
+            delay=True,
+        )]
+        if console:
+            handlers.append(logging.StreamHandler())
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        handler, _listener = pipeline(
+            handlers,
+            rate=settings.logRate,
+        )
+        logger = logging.getLogger('')
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        atexit.register(shutdown)
+        return _listener
+
+
+def shutdown():
+    """Write the queued records and stop the writer thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
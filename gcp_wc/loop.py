@@ -0,0 +1,227 @@
+"""Loop.
+
+Pace of the agent loops. A loop sleeps its minimum interval after an
+iteration that found work; while it finds none, the interval is multiplied
+by the backoff factor at each iteration, up to its maximum interval. The
+interval settings of a loop are named after it: "<name>Interval" and
+"<name>MaxInterval" (ms), and are read at each iteration.
+
+A loop that found work signals its peers, which wake up and drop back to
+their minimum interval: the app config manager wakes as soon as the event
+daemon cached a manifest, rather than at its next timeout. The signal goes
+through the activity installed in the process: named events between the
+service processes of the desktop, a condition between the workers of the
+agent host. Without one, the loops only sleep.
+
+The duty cycle of the loops (time spent iterating over time elapsed) is
+logged every "loopReportInterval" ms.
+"""
+import time
+import logging
+import threading
+
+from gcp_wc import config
+from gcp_wc import metrics
+
+# Names of the loops, and prefix of their settings.
+LOOPS = (
+    'appCfgMgr',
+    'appEvents',
+    'cleanup',
+    'eventDaemon',
+    'reconciler',
+    'registerZookeeper',
+    'stateMonitor',
+)
+
+EVENT_PREFIX = 'Local\\gcp_wc.loop.'
+
+_lock = threading.Lock()
+_activity = None
+_loops = {}
+
+_SECONDS = metrics.histogram(
+    'gcp_wc_loop_iteration_seconds', 'Duration of the iterations of the loops.', ('loop',))
+_ITEMS = metrics.histogram(
+    'gcp_wc_loop_work_items', 'Work items found by the iterations of the loops.', ('loop',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+_WAKEUPS = metrics.counter(
+    'gcp_wc_loop_wakeups_total', 'Loops woken up by a peer.', ('loop',))
+_INTERVAL = metrics.gauge(
+    'gcp_wc_loop_interval_seconds', 'Next sleep of the loops.', ('loop',))
+_DUTY_CYCLE = metrics.gauge(
+    'gcp_wc_loop_duty_cycle', 'Fraction of the time the loops spent iterating.', ('loop',))
+
+
+class ThreadActivity(object):
+    """Activity of the loops of a process."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # Loops signaled since their last wait, as the auto-reset events.
+        self._signaled = set()
+
+    def signal(self, sender=None):
+        with self._cond:
+            self._signaled.update(loop for loop in LOOPS if loop != sender)
+            self._cond.notify_all()
+
+    def wait(self, name, timeout):
+        """Wait up to timeout ms, returns True if signaled."""
+        with self._cond:
+            signaled = self._cond.wait_for(lambda: name in self._signaled, timeout / 1000.0)
+            self._signaled.discard(name)
+            return signaled
+
+
+class EventActivity(object):
+    """Activity of the loops of the service processes, as named events."""
+
+    def __init__(self, name, stop_handle):
+        """
+        name: loop of the process
+        stop_handle: event of the service stop, also waited on
+        """
+        import win32event
+        self._win32event = win32event
+        self.name = name
+        self._stop_handle = stop_handle
+        # Auto-reset, created by whichever of the services starts first.
+        self._events = dict(
+            (loop, win32event.CreateEvent(None, False, False, EVENT_PREFIX + loop))
+            for loop in LOOPS
+        )
+
+    def signal(self, sender=None):
+        for loop, handle in self._events.items():
+            if loop != sender:
+                self._win32event.SetEvent(handle)
+
+    def wait(self, name, timeout):
+        """Wait up to timeout ms, returns True if signaled or stopped."""
+        result = self._win32event.WaitForMultipleObjects(
+            [self._events[name], self._stop_handle], False, int(timeout))
+        return result != self._win32event.WAIT_TIMEOUT
+
+
+def install(activity):
+    """Use activity to signal and wake the loops of the process."""
+    global _activity
+    _activity = activity
+
+
+def signal(sender=None):
+    """Wake the loops of the process and of its peers, but sender."""
+    activity = _activity
+    if activity is not None:
+        activity.signal(sender)
+
+
+def loops():
+    """Returns the loops of the process."""
+    with _lock:
+        return list(_loops.values())
+
+
+class Loop(object):
+    """Pace of a loop."""
+
+    def __init__(self, name, should_stop, clock=time.time):
+        """
+        name: name of the loop, prefix of its settings
+        should_stop: called with a timeout in ms, returns True to stop
+        clock: returns the time in seconds
+        """
+        self.name = name
+        self.should_stop = should_stop
+        self.clock = clock
+        self.interval = self.policy()[0]
+        self.iterations = 0
+        self.worked = 0
+        self.wakeups = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self._notified = False
+        self._woke = clock()
+        self._report = (self._woke, 0.0, 0)
+        self._seconds = _SECONDS.labels(name)
+        self._items = _ITEMS.labels(name)
+        self._wakeups = _WAKEUPS.labels(name)
+        _INTERVAL.set_function(lambda: self.interval / 1000.0, name)
+        _DUTY_CYCLE.set_function(self.duty_cycle, name)
+        with _lock:
+            _loops[name] = self
+
+    def policy(self):
+        """Returns the minimum and maximum intervals (ms) and the backoff."""
+        settings = config.current()
+        minimum = getattr(settings, self.name + 'Interval')
+        maximum = max(getattr(settings, self.name + 'MaxInterval'), minimum)
+        return minimum, maximum, settings.loopBackoff
+
+    def notify(self):
+        """Record work found outside of the iterations, e.g. by a watch."""
+        self._notified = True
+        signal(self.name)
+
+    def sleep(self, worked):
+        """Sleep after an iteration, returns True to stop.
+
+        :param ``int`` worked:
+            Number of work items the iteration found, or whether it found
+            work.
+        """
+        now = self.clock()
+        self.busy += now - self._woke
+        self.iterations += 1
+        self._seconds.observe(now - self._woke)
+        self._items.observe(int(worked))
+        minimum, maximum, backoff = self.policy()
+        idle = not (worked or self._notified)
+        if not idle:
+            self._notified = False
+            self.worked += 1
+            self.interval = minimum
+            if worked:
+                signal(self.name)
+        timeout = min(max(self.interval, minimum), maximum)
+        # The next sleep, unless work is found meanwhile.
+        self.interval = min(int(timeout * backoff), maximum) if idle else timeout
+        self._log(now)
+        activity = _activity
+        if activity is None:
+            stop = self.should_stop(timeout)
+        else:
+            if activity.wait(self.name, timeout):
+                self.wakeups += 1
+                self._wakeups.inc()
+                self.interval = minimum
+            stop = self.should_stop(0)
+        self._woke = self.clock()
+        self.idle += self._woke - now
+        return stop
+
+    def duty_cycle(self):
+        """Returns the fraction of the time spent iterating."""
+        elapsed = self.busy + self.idle
+        return self.busy / elapsed if elapsed else 0.0
+
+    def stats(self):
+        return {
+            'busy': self.busy,
+            'duty_cycle': self.duty_cycle(),
+            'idle': self.idle,
+            'interval': self.interval,
+            'iterations': self.iterations,
+            'wakeups': self.wakeups,
+            'worked': self.worked,
+        }
+
+    def _log(self, now):
+        started, busy, iterations = self._report
+        if (now - started) * 1000 < config.current().loopReportInterval:
+            return
+        logging.info('Loop %s: duty cycle %.3f%%, %d iterations, interval %d ms',
+                     self.name, 100.0 * (self.busy - busy) / (now - started),
+                     self.iterations - iterations, self.interval)
+        self._report = (now, self.busy, self.iterations)
@@ -0,0 +1,426 @@
+"""Metrics.
+
+In-process registry of counters, gauges and fixed-bucket histograms, served
+in the Prometheus text format on localhost, at /metrics.
+
+Each service serves its own registry, on the "metricsPort" setting plus the
+offset of the service in PORTS; with "metricsPort" at 0 nothing is served.
+Other pages are added to the server with `route`, e.g. /profile.
+The registry records:
+
+- the iterations of the agent loops: duration, work items and wakeups,
+- the Zookeeper requests by operation, and their latency,
+- the Docker API calls, and their latency,
+- the depth of the log queue and the pending intents,
+- the entries of the work directories,
+- the staleness of the Zookeeper mirrors.
+
+Recording a value takes a dictionary lookup and an uncontended lock: cheap
+enough to leave on (see benchmarks/bench_metrics.py). The hot paths keep
+the child of a labelled metric rather than looking it up at each call.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+
+# Offset of the port of each service from the "metricsPort" setting.
+PORTS = {
+    'agentHost': 0,
+    'appCfgMgr': 1,
+    'appEvents': 2,
+    'cleanup': 3,
+    'eventDaemon': 4,
+    'registerZookeeper': 5,
+    'screenMonitor': 6,
+    'stateMonitor': 7,
+    'updateResources': 8,
+    'watchdog': 9,
+    'zkBroker': 10,
+}
+
+# Seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DIRECTORIES = ('appevents', 'cache', 'cleanup', 'running')
+
+EXPOSITION_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+TEXT_TYPE = 'text/plain; charset=utf-8'
+
+ZOOKEEPER_OPERATIONS = (
+    'create',
+    'delete',
+    'ensure_path',
+    'exists',
+    'get',
+    'get_children',
+    'set',
+)
+
+
+class _Value(object):
+    """Value of a counter or a gauge."""
+
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function when collected."""
+        self.function = function
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception:
+            return float('nan')
+
+
+class _Buckets(object):
+    """Value of a histogram."""
+
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last count is of the values above the last bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Returns a context manager observing the seconds of its block."""
+        return _Timer(self)
+
+
+class _Timer(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.buckets.observe(time.time() - self.started)
+
+
+class Metric(object):
+    """A named metric, and its children by label values."""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Returns the child of the label values."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s has labels %r' % (self.name, self.labelnames))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._child()
+        return child
+
+    def children(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def samples(self):
+        """Returns the (name, labels, value) of the metric."""
+        samples = []
+        for values, child in self.children():
+            labels = list(zip(self.labelnames, values))
+            samples.append((self.name, labels, child.get()))
+        return samples
+
+
+class Counter(Metric):
+    """Value only going up."""
+
+    type = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Value going up and down, or read from a function."""
+
+    type = 'gauge'
+
+    def _child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set_function(self, function, *values):
+        self.labels(*values).set_function(function)
+
+
+class Histogram(Metric):
+    """Counts of the values observed, by bucket."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        samples = []
+        for values, child in self.children():
+            labels = list(zip(self.labelnames, values))
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + [('le', _number(bound))], cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry(object):
+    """Metrics of a process, by name."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Returns the metric of that name, metric if it is the first."""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError('%s is already registered' % metric.name)
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics():
+            lines.append('# HELP %s %s' % (metric.name, metric.help.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += '{%s}' % ','.join('%s="%s"' % (label, _escape(str(label_value)))
+                                              for label, label_value in labels)
+                lines.append('%s %s' % (name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+ZOOKEEPER_SECONDS = histogram(
+    'gcp_wc_zookeeper_request_seconds', 'Zookeeper requests by operation.', ('operation',))
+ZOOKEEPER_ERRORS = counter(
+    'gcp_wc_zookeeper_errors_total', 'Zookeeper requests failed, by operation.', ('operation',))
+
+
+class InstrumentedZooKeeper(object):
+    """Zookeeper client recording its requests, otherwise the client."""
+
+    def __init__(self, zk):
+        self._zk = zk
+
+    def __getattr__(self, name):
+        attr = getattr(self._zk, name)
+        if name not in ZOOKEEPER_OPERATIONS:
+            return attr
+        seconds = ZOOKEEPER_SECONDS.labels(name)
+        errors = ZOOKEEPER_ERRORS.labels(name)
+
+        def request(*args, **kwargs):
+            started = time.time()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.time() - started)
+        # Found in the instance from now on.
+        setattr(self, name, request)
+        return request
+
+
+def zookeeper(zk):
+    """Returns zk recording its requests."""
+    return InstrumentedZooKeeper(zk)
+
+
+_routes = {}
+
+
+def route(path, handler):
+    """Serve handler at path, next to /metrics.
+
+    :param ``function`` handler:
+        Called with the query parameters ({name: [values]}), returns the
+        HTTP status, the content type and the text of the response.
+    """
+    _routes[path] = handler
+
+
+class MetricsServer(object):
+    """HTTP server of a registry on localhost, in a thread."""
+
+    def __init__(self, port, registry=REGISTRY, routes=_routes):
+        import socketserver
+        import http.server
+        import urllib.parse
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/metrics':
+                    status, content_type, text = 200, EXPOSITION_TYPE, registry.exposition()
+                elif path in routes:
+                    try:
+                        status, content_type, text = routes[path](urllib.parse.parse_qs(query))
+                    except Exception as e:
+                        logging.exception('%s failed', path)
+                        status, content_type, text = 500, TEXT_TYPE, '%s\n' % e
+                else:
+                    self.send_error(404)
+                    return
+                body = text.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', port), Handler)
+        self.address = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def directories(root):
+    """Record the entries of the work directories of root."""
+    entries = gauge('gcp_wc_directory_entries', 'Entries of the work directories.', ('directory',))
+    for directory in DIRECTORIES:
+        path = os.path.join(root, directory)
+        entries.set_function(lambda path=path: len(os.listdir(path)), directory)
+
+
+def serve(service, root):
+    """Serve the metrics of a service on localhost, returns the
+    MetricsServer, None if disabled or the port is taken.
+    """
+    from gcp_wc import config
+    port = config.current().metricsPort
+    if not port:
+        return None
+    directories(root)
+    try:
+        server = MetricsServer(port + PORTS[service]).start()
+    except (IOError, OSError) as e:
+        logging.info('Metrics not served: %s', e)
+        return None
+    logging.info('Metrics served on %s:%s', *server.address)
+    return server
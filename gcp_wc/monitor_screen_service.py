@@ -7,7 +7,13 @@ from __future__ import print_function
 import os
 import sys
 import socket
-import logging.config
+import logging
+
+from gcp_wc import config
+from gcp_wc import logs
+from gcp_wc import metrics
+from gcp_wc import profiler
+from gcp_wc import screen_state
 
 import win32serviceutil
 import win32service
@@ -28,14 +34,6 @@ except ImportError:
     print("wtsmonitor: events.py not found", file=sys.stderr)
     sys.exit(1)
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'screenMonitorSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
-
 #windows message
 WM_WTSSESSION_CHANGE		= 0x2B1
 
@@ -74,7 +72,7 @@ class MonitorScreenSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -82,6 +80,10 @@ class MonitorScreenSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('screenMonitorSVC.txt')
+        config.watch()
+        metrics.serve('screenMonitor', self.root)
+        profiler.control('screenMonitor', self.root)
         try:
             f = open(os.path.join(self.root, screen_state_file), 'w')
             f.write("Unlock")
@@ -89,7 +91,7 @@ class MonitorScreenSvc (win32serviceutil.ServiceFramework):
             m = WTSMonitor(self.root, all_sessions=True)
             while True:
                 m.start()
-                if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
+                if win32event.WaitForSingleObject(self.hWaitStop, config.current().screenMonitorInterval) == win32event.WAIT_OBJECT_0:
                     break
                 # m.stop()
         except:
@@ -107,6 +109,7 @@ class WTSMonitor():
         wc.lpfnWndProc = self.WndProc
         self.classAtom = gui.RegisterClass(wc)
         self.root = root
+        self.lock_time = None
 
         style = 0
         self.hWnd = gui.CreateWindow(self.classAtom, self.wndName,style, 0, 0, con.CW_USEDEFAULT, con.CW_USEDEFAULT,0, 0, hInst, None)
@@ -138,14 +141,10 @@ class WTSMonitor():
         name = methods.get(event, "unknown")
         if name == 'SessionLock':
             logging.info("Scrren is locked!")
-            f = open(os.path.join(self.root, screen_state_file),'w')
-            f.write("Lock")
-            f.close()
+            self.lock_time = screen_state.record_event(self.root, screen_state.LOCK, self.lock_time)
         elif name == 'SessionUnlock':
             logging.info("Screen is unlocked!")
-            f = open(os.path.join(self.root, screen_state_file), 'w')
-            f.write("Unlock")
-            f.close()
+            self.lock_time = screen_state.record_event(self.root, screen_state.UNLOCK, self.lock_time)
 
         logging.info("event %s on session %d" % (methods.get(event, "unknown(0x%x)" % event), sessionId))
         try:
@@ -0,0 +1,137 @@
+"""Node Data.
+
+Typed model of the data of the /servers/<hostname> node of a desktop.
+
+The data is derived from the /servers/node template: the template is parsed
+once, the live resources and the label are merged in and the result is
+serialized deterministically, so that identical payloads can be detected and
+their write skipped.
+"""
+import logging
+import functools
+
+from gcp_wc import lazy
+
+yaml = lazy.module('yaml')
+
+# For desktop, we add a 'windows' label, in order to schedule better later.
+DESKTOP_LABEL = 'windows'
+
+RESOURCE_UNITS = {
+    'agent_cpu': '%',
+    'agent_memory': 'M',
+    'cpu': '%',
+    'disk': 'M',
+    'memory': 'M',
+}
+
+
+# Use the libyaml bindings when they are available.
+def _loader():
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _dumper():
+    return getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class NodeData(object):
+    """Data of a server node.
+
+    Instances are immutable, merge returns a new instance.
+    """
+
+    __slots__ = (
+        'fields',
+        '_serialized',
+    )
+
+    def __init__(self, fields):
+        self.fields = dict(fields)
+        self._serialized = None
+
+    @classmethod
+    def parse(cls, data):
+        """Parse the YAML data of a server node."""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        fields = yaml.load(data, Loader=_loader())
+        if fields is None:
+            fields = {}
+        if not isinstance(fields, dict):
+            raise ValueError('Server node data is not a mapping: %r' % data)
+        return cls(fields)
+
+    def merge(self, resources=None, label=None):
+        """Returns the node data with the live resources and label merged in.
+
+        :param ``dict`` resources:
+            Resource name to amount, e.g. {'cpu': 80, 'memory': 2048}. The
+            unit of the resource is appended.
+        :param ``str`` label:
+            Label of the server.
+        """
+        fields = dict(self.fields)
+        for name, amount in (resources or {}).items():
+            fields[name] = '{amount}{unit}'.format(
+                amount=int(amount), unit=RESOURCE_UNITS.get(name, '')
+            )
+        if label is not None:
+            fields['label'] = label
+        return NodeData(fields)
+
+    def serialize(self):
+        """Returns the node data as UTF-8 YAML with sorted keys."""
+        if self._serialized is None:
+            self._serialized = yaml.dump(
+                self.fields, Dumper=_dumper(), default_flow_style=False
+            ).encode('utf-8')
+        return self._serialized
+
+    def __eq__(self, other):
+        return isinstance(other, NodeData) and self.fields == other.fields
+
+    def __repr__(self):
+        return 'NodeData<{fields}>'.format(fields=self.fields)
+
+
+@functools.lru_cache(maxsize=4)
+def from_template(data):
+    """Returns the desktop NodeData of the /servers/node template data.
+
+    The parsed template is cached by its content.
+    """
+    template = NodeData.parse(data)
+    if template.fields.get('label') is None:
+        template = template.merge(label=DESKTOP_LABEL)
+    return template
+
+
+class NodeDataWriter(object):
+    """Write node data to Zookeeper, skipping identical payloads."""
+
+    def __init__(self, zk):
+        self.zk = zk
+        # path -> (payload, czxid, version) of the last write
+        self._written = {}
+
+    def write(self, path, node_data):
+        """Write node data to path if it exists.
+
+        The write is skipped when the payload is the one we last wrote and
+        the node was neither recreated nor modified since.
+
+        :returns ``bool``:
+            True if the node was written.
+        """
+        stat = self.zk.exists(path)
+        if stat is None:
+            self._written.pop(path, None)
+            return False
+        payload = node_data.serialize()
+        if self._written.get(path) == (payload, stat.czxid, stat.version):
+            return False
+        stat = self.zk.set(path, payload)
+        self._written[path] = (payload, stat.czxid, stat.version)
+        logging.info('Update node data %s', path)
+        return True
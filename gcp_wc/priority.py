@@ -0,0 +1,314 @@
+"""Priority.
+
+Run the agent with low impact on the desktop user: the agent processes get a
+below normal cpu priority and a low I/O priority, the containers get low cpu
+shares and leave reserved cores to the user. When the user becomes active
+(before the unlock fires) the agent and its containers are throttled further.
+
+The watchdog sets the level, it is kept in the work directory for the
+services creating containers to create them at that level. Docker cannot
+update the cpu of a Windows container, and its cpu shares conflict with the
+cpu percent, so there the level only applies to the agent processes.
+
+The OS calls sit behind PriorityBackend, FakePriorityBackend stands in for
+them in tests.
+"""
+import os
+import abc
+import tempfile
+import functools
+import logging
+
+from gcp_wc import config
+
+NORMAL = 'normal'
+BACKGROUND = 'background'
+THROTTLED = 'throttled'
+LEVELS = (NORMAL, BACKGROUND, THROTTLED)
+
+priority_level_file = 'priority_level.txt'
+
+# Cores left to the desktop user.
+DEFAULT_RESERVED_CORES = 1
+# Seconds without input after which the user is considered away.
+DEFAULT_ACTIVE_THRESHOLD = 5
+# Container cpu shares, the docker default is 1024.
+CPU_SHARES = {
+    NORMAL: 1024,
+    BACKGROUND: 256,
+    THROTTLED: 2,
+}
+# WTSGetActiveConsoleSessionId without a session attached to the console.
+NO_SESSION = 0xFFFFFFFF
+# WTS_INFO_CLASS of WTSINFO.
+WTS_SESSION_INFO = 24
+
+
+class PriorityBackend(object, metaclass=abc.ABCMeta):
+    """Interface to the OS priorities."""
+
+    @abc.abstractmethod
+    def set_priority(self, pid, level):
+        """Set the cpu and I/O priority of a process to level."""
+        pass
+
+    @abc.abstractmethod
+    def idle_seconds(self):
+        """Returns the seconds since the last input of the desktop user.
+
+        None if unknown.
+        """
+        pass
+
+    def cpu_count(self):
+        return os.cpu_count() or 1
+
+
+class PsutilBackend(PriorityBackend):
+    """Priorities through psutil, on Windows and POSIX."""
+
+    def __init__(self):
+        import psutil
+        self._psutil = psutil
+        if os.name == 'nt':
+            self._nice = {
+                NORMAL: psutil.NORMAL_PRIORITY_CLASS,
+                BACKGROUND: psutil.BELOW_NORMAL_PRIORITY_CLASS,
+                THROTTLED: psutil.IDLE_PRIORITY_CLASS,
+            }
+            # Windows I/O priorities: 0 very low, 1 low, 2 normal.
+            self._ionice = {NORMAL: (2,), BACKGROUND: (1,), THROTTLED: (0,)}
+        else:
+            self._nice = {NORMAL: 0, BACKGROUND: 10, THROTTLED: 19}
+            self._ionice = {
+                NORMAL: (psutil.IOPRIO_CLASS_BE, 4),
+                BACKGROUND: (psutil.IOPRIO_CLASS_BE, 7),
+                THROTTLED: (psutil.IOPRIO_CLASS_IDLE,),
+            }
+
+    def set_priority(self, pid, level):
+        process = self._psutil.Process(pid)
+        process.nice(self._nice[level])
+        try:
+            process.ionice(*self._ionice[level])
+        except (AttributeError, self._psutil.AccessDenied) as e:
+            logging.info('Cannot set I/O priority of %s: %s', pid, e)
+
+    def idle_seconds(self):
+        if os.name != 'nt':
+            return None
+        try:
+            return console_idle_seconds()
+        except OSError as e:
+            logging.info('Cannot get the idle time of the console: %s', e)
+            return None
+
+
+@functools.lru_cache(maxsize=None)
+def _structures():
+    """Returns the LASTINPUTINFO and WTSINFOW ctypes structures."""
+    import ctypes
+
+    class LastInputInfo(ctypes.Structure):
+        """LASTINPUTINFO"""
+        _fields_ = [
+            ('cbSize', ctypes.c_uint32),
+            ('dwTime', ctypes.c_uint32),
+        ]
+
+    class WtsInfo(ctypes.Structure):
+        """WTSINFOW"""
+        _fields_ = [
+            ('State', ctypes.c_int),
+            ('SessionId', ctypes.c_uint32),
+            ('IncomingBytes', ctypes.c_uint32),
+            ('OutgoingBytes', ctypes.c_uint32),
+            ('IncomingFrames', ctypes.c_uint32),
+            ('OutgoingFrames', ctypes.c_uint32),
+            ('IncomingCompressedBytes', ctypes.c_uint32),
+            ('OutgoingCompressedBytes', ctypes.c_uint32),
+            ('WinStationName', ctypes.c_wchar * 32),
+            ('Domain', ctypes.c_wchar * 17),
+            ('UserName', ctypes.c_wchar * 21),
+            ('ConnectTime', ctypes.c_int64),
+            ('DisconnectTime', ctypes.c_int64),
+            ('LastInputTime', ctypes.c_int64),
+            ('LogonTime', ctypes.c_int64),
+            ('CurrentTime', ctypes.c_int64),
+        ]
+
+    return LastInputInfo, WtsInfo
+
+
+def console_idle_seconds():
+    """Returns the seconds since the last input in the console session.
+
+    The services run in session 0, which never gets user input: input is
+    only reported to the processes of its session, so the console session
+    is queried through WTS. None without a user at the console.
+    """
+    import ctypes
+    LastInputInfo, WtsInfo = _structures()
+    kernel32 = ctypes.windll.kernel32
+    session = kernel32.WTSGetActiveConsoleSessionId() & 0xFFFFFFFF
+    if session == NO_SESSION:
+        return None
+    own_session = ctypes.c_uint32()
+    if (kernel32.ProcessIdToSessionId(kernel32.GetCurrentProcessId(), ctypes.byref(own_session))
+            and own_session.value == session):
+        # Run from the console, e.g. debugging a service.
+        info = LastInputInfo(ctypes.sizeof(LastInputInfo), 0)
+        if not ctypes.windll.user32.GetLastInputInfo(ctypes.byref(info)):
+            raise ctypes.WinError()
+        # Both tick counts wrap after 49.7 days.
+        return ((kernel32.GetTickCount() - info.dwTime) & 0xFFFFFFFF) / 1000.0
+
+    wtsapi32 = ctypes.windll.wtsapi32
+    buffer, size = ctypes.c_void_p(), ctypes.c_uint32()
+    if not wtsapi32.WTSQuerySessionInformationW(
+            None, session, WTS_SESSION_INFO, ctypes.byref(buffer), ctypes.byref(size)):
+        raise ctypes.WinError()
+    try:
+        info = ctypes.cast(buffer, ctypes.POINTER(WtsInfo)).contents
+        last_input, current = info.LastInputTime, info.CurrentTime
+    finally:
+        wtsapi32.WTSFreeMemory(buffer)
+    if not last_input:
+        return None
+    # FILETIME, in 100 ns.
+    return max(current - last_input, 0) / 10 ** 7
+
+
+class FakePriorityBackend(PriorityBackend):
+    """In memory priorities."""
+
+    def __init__(self, cpu_count=4, idle=None):
+        self.priorities = {}
+        self.idle = idle
+        self._cpu_count = cpu_count
+
+    def set_priority(self, pid, level):
+        self.priorities[pid] = level
+
+    def idle_seconds(self):
+        return self.idle
+
+    def cpu_count(self):
+        return self._cpu_count
+
+
+class PriorityManager(object):
+    """Apply the priorities of the agent processes and containers."""
+
+    def __init__(self, backend, reserved_cores=DEFAULT_RESERVED_CORES,
+                 active_threshold=DEFAULT_ACTIVE_THRESHOLD, level_path=None):
+        """
+        backend: PriorityBackend
+        reserved_cores: cores left to the desktop user
+        active_threshold: seconds without input after which the user is away
+        level_path: file keeping the level applied, None to keep it in memory
+        """
+        self.backend = backend
+        self.reserved_cores = reserved_cores
+        self.active_threshold = active_threshold
+        self.level_path = level_path
+        self.level = None
+
+    @classmethod
+    def from_env(cls, backend=None, root=None):
+        """Returns the PriorityManager of the agent configuration, keeping
+        its level in the work directory root.
+        """
+        settings = config.current()
+        return cls(
+            backend or PsutilBackend(),
+            reserved_cores=settings.reservedCores,
+            active_threshold=settings.userActiveThreshold / 1000.0,
+            level_path=os.path.join(root, priority_level_file) if root else None,
+        )
+
+    def lower(self, pid=None):
+        """Run a process (default: this one) in the background."""
+        self._set(pid or os.getpid(), BACKGROUND)
+
+    def user_active(self):
+        idle = self.backend.idle_seconds()
+        return idle is not None and idle < self.active_threshold
+
+    def target(self):
+        """Returns the level the agent should run at."""
+        return THROTTLED if self.user_active() else BACKGROUND
+
+    def apply(self, level, pids, client=None, container_ids=()):
+        """Apply level to the agent processes and containers."""
+        logging.info('Agent priority %s -> %s', self.level, level)
+        self.level = level
+        self._save(level)
+        for pid in pids:
+            if pid:
+                self._set(pid, level)
+        options = container_priority(level)
+        if not options:
+            return
+        for container_id in container_ids:
+            try:
+                client.update(container_id, **options)
+            except Exception as e:
+                logging.info('Cannot update %s: %s', container_id, e)
+
+    def current(self):
+        """Returns the level applied, by this manager or the watchdog's."""
+        if self.level is None and self.level_path is not None:
+            try:
+                with open(self.level_path) as f:
+                    level = f.read().strip()
+            except (IOError, OSError):
+                level = None
+            if level in LEVELS:
+                return level
+        return self.level or BACKGROUND
+
+    def container_options(self, cpu_percent):
+        """Returns the docker create options of a container, at the
+        current level.
+
+        Windows containers do not support cpu sets, the reserved cores are
+        withheld from the cpu percent instead.
+        """
+        count = self.backend.cpu_count()
+        usable = max(count - self.reserved_cores, 1)
+        if os.name == 'nt':
+            cpu_percent = min(cpu_percent, int(100 * usable / count))
+        options = {'cpu_percent': cpu_percent}
+        options.update(container_priority(self.current()))
+        if os.name != 'nt' and usable < count:
+            options['cpuset_cpus'] = '{first}-{last}'.format(
+                first=count - usable, last=count - 1
+            )
+        return options
+
+    def _set(self, pid, level):
+        try:
+            self.backend.set_priority(pid, level)
+        except Exception as e:
+            logging.info('Cannot set priority of %s: %s', pid, e)
+
+    def _save(self, level):
+        if self.level_path is None:
+            return
+        try:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.level_path),
+                                             prefix='.tmp', delete=False, mode='w') as temp:
+                temp.write(level)
+            os.replace(temp.name, self.level_path)
+        except (IOError, OSError) as e:
+            logging.info('Cannot save priority %s: %s', level, e)
+
+
+def container_priority(level):
+    """Returns the docker options giving a container level, the same at
+    creation and update; none on Windows.
+    """
+    if os.name == 'nt':
+        return {}
+    return {'cpu_shares': CPU_SHARES[level]}
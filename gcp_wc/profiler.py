@@ -0,0 +1,179 @@
+"""Profiler.
+
+Sampling profiler of a live service. While a profile runs, a thread takes
+the stacks of all the threads of the process (the loops, the kazoo and
+broker threads, the pools) every "profileInterval" ms and counts them; the
+threads are not traced, so the service runs at full speed in between. When
+the profile ends, the counts are written to log/<service>.<time>.folded in
+the collapsed stack format of the flame graph tools: one line per stack,
+the frames from the thread down separated by ';', then the count.
+
+A profile of N seconds is started by writing N to the control file
+profile.<service> of the work directory, removed once read, or by a GET of
+/profile?seconds=N on the metrics endpoint of the service, which answers
+with the profile when it ends. Nothing samples while no profile runs; the
+control file costs a stat per poll interval.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import collections
+
+from gcp_wc import config
+from gcp_wc import logs
+from gcp_wc import metrics
+
+CONTROL_PREFIX = 'profile.'
+
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 600
+
+# Milliseconds between two checks of the control file.
+DEFAULT_POLL_INTERVAL = 1000
+
+_lock = threading.Lock()
+_profile = None
+
+
+class Sampler(object):
+    """Counts of the stacks of the threads of the process."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.samples = 0
+
+    def sample(self, skip=None):
+        """Count the current stack of each thread, but skip (a thread id)."""
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == skip:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = frame.f_globals.get('__name__') or os.path.basename(code.co_filename)
+                stack.append('%s:%s' % (module, code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, 'thread-%d' % thread_id))
+            self.counts[';'.join(reversed(stack)).replace(' ', '_')] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        """Returns the stacks and their counts, in the collapsed format."""
+        return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(self.counts.items()))
+
+
+class Profile(threading.Thread):
+    """Thread sampling the process for some seconds, then writing the
+    collapsed stacks to the log directory.
+    """
+
+    def __init__(self, service, root, seconds, interval):
+        """
+        service: name of the service, prefix of the file
+        root: work directory
+        seconds: duration of the profile
+        interval: ms between two samples
+        """
+        super(Profile, self).__init__(name='Profile')
+        self.daemon = True
+        self.seconds = seconds
+        self.interval = interval
+        self.sampler = Sampler()
+        self.path = os.path.join(root, logs.LOG_DIR, '%s.%s.folded' % (
+            service, time.strftime('%Y%m%d-%H%M%S')))
+
+    def run(self):
+        global _profile
+        me = threading.get_ident()
+        deadline = time.time() + self.seconds
+        try:
+            while time.time() < deadline:
+                self.sampler.sample(skip=me)
+                time.sleep(self.interval / 1000.0)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                f.write(self.sampler.collapsed())
+            logging.info('Profile written to %s: %d samples', self.path, self.sampler.samples)
+        except (IOError, OSError):
+            logging.exception('Profile not written')
+        finally:
+            with _lock:
+                _profile = None
+
+
+def start(service, root, seconds=DEFAULT_SECONDS):
+    """Start a profile, returns it, None if one runs already."""
+    global _profile
+    seconds = min(max(float(seconds), 0), MAX_SECONDS)
+    with _lock:
+        if _profile is not None:
+            return None
+        _profile = Profile(service, root, seconds, config.current().profileInterval)
+        _profile.start()
+        logging.info('Profiling %s for %g s', service, seconds)
+        return _profile
+
+
+class ControlWatcher(threading.Thread):
+    """Thread starting a profile when the control file of its service
+    appears.
+    """
+
+    def __init__(self, service, root, poll_interval=DEFAULT_POLL_INTERVAL):
+        super(ControlWatcher, self).__init__(name='ProfileControl')
+        self.daemon = True
+        self.service = service
+        self.root = root
+        self.filename = os.path.join(root, CONTROL_PREFIX + service)
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def check(self):
+        """Start a profile if the control file exists, and remove it."""
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename) as f:
+                text = f.read().strip()
+            os.remove(self.filename)
+        except (IOError, OSError) as e:
+            logging.info('Profile control file not read: %s', e)
+            return None
+        try:
+            seconds = float(text) if text else DEFAULT_SECONDS
+        except ValueError:
+            logging.info('Profile control file ignored: %r', text)
+            return None
+        return start(self.service, self.root, seconds)
+
+    def run(self):
+        while not self._stopped.wait(self.poll_interval / 1000.0):
+            self.check()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def control(service, root):
+    """Profile the service on request: its control file, and /profile on
+    its metrics endpoint. Returns the ControlWatcher.
+    """
+
+    def profile(query):
+        seconds = query.get('seconds', [DEFAULT_SECONDS])[0]
+        try:
+            profile = start(service, root, seconds)
+        except ValueError:
+            return 400, metrics.TEXT_TYPE, 'seconds: %r is not a number\n' % seconds
+        if profile is None:
+            return 409, metrics.TEXT_TYPE, 'A profile is running\n'
+        profile.join()
+        return 200, metrics.TEXT_TYPE, profile.sampler.collapsed()
+
+    metrics.route('/profile', profile)
+    watcher = ControlWatcher(service, root)
+    watcher.start()
+    return watcher
@@ -0,0 +1,556 @@
+"""Reconciler.
+
+Single reconciliation of the instances of the desktop, in place of the diffs
+the services recompute on each iteration: the event daemon (placement
+against the cache directory), the app config manager (cache against
+running), the state monitor (running against the containers) and the cleanup
+service (cleanup against the others).
+
+The desired state (the placement of the desktop and the manifests of the
+placed apps, kept by watches) and the observed state (the labelled
+containers of the desktop) are held in maps indexed by instance. Each change
+of either bumps the generation of the instance, and a tick only reconciles
+the instances whose generation moved since they were last reconciled.
+
+The actions keep the records of the services: running manifests, app events,
+running nodes and placement nodes. The agent host runs the reconciler in
+place of the four services when the "reconciler" setting is "1".
+
+Usage:
+    python -m gcp_wc.reconciler --simulate [--apps N] [--steps N] [--seed N]
+"""
+import os
+import sys
+import time
+import shutil
+import random
+import logging
+import argparse
+import tempfile
+import threading
+
+from kazoo.exceptions import KazooException
+from kazoo.exceptions import NoNodeError
+
+from gcp_wc import elasticity
+from gcp_wc import instance_index
+from gcp_wc import lazy
+from gcp_wc import loop
+from gcp_wc import priority
+from gcp_wc import runtime
+from gcp_wc import state_api
+
+yaml = lazy.module('yaml')
+
+PLACEMENT = '/placement'
+SCHEDULED = '/scheduled'
+RUNNING = '/running'
+
+RUNNING_DIR = 'running'
+APP_EVENTS_DIR = 'appevents'
+
+
+class Instance(object):
+    """Desired and observed state of an instance."""
+
+    __slots__ = (
+        'name',
+        'scheduled',
+        'placement',
+        'container',
+        'generation',
+        'reconciled',
+    )
+
+    def __init__(self, name):
+        self.name = name
+        # Manifest of /scheduled/<name>, None if not scheduled.
+        self.scheduled = None
+        # Data of /placement/<host>/<name>, None if not placed.
+        self.placement = None
+        # ContainerSummary of its container, None if none.
+        self.container = None
+        self.generation = 0
+        self.reconciled = 0
+
+    def manifest(self):
+        """Returns the manifest to run, None if the instance is not desired."""
+        if self.scheduled is None or self.placement is None:
+            return None
+        manifest_data = dict(self.scheduled)
+        manifest_data['task'] = self.name[self.name.index('#') + 1:]
+        if isinstance(self.placement, dict):
+            manifest_data.update(self.placement)
+        return manifest_data
+
+
+class Reconciler(object):
+    """Reconcile the desired and observed instances of a host."""
+
+    def __init__(self, zk, client, hostname, actuator, on_change=None, index=None):
+        """
+        zk: Zookeeper client
+        client: container runtime
+        hostname: host whose instances are reconciled
+        actuator: Actuator applying the changes
+        on_change: called when an instance changes, e.g. to wake the loop
+        index: StateIndex of the state API, kept up to date
+        """
+        self.zk = zk
+        self.client = client
+        self.hostname = hostname
+        self.actuator = actuator
+        self.on_change = on_change
+        self.index = index
+        self.placement = PLACEMENT + '/' + hostname
+        self.instances = {}
+        self.generation = 0
+        self._dirty = set()
+        # app -> token of its watches
+        self._apps = {}
+        # Token of the placement watch, None once stopped.
+        self._token = None
+        self._lock = threading.RLock()
+
+    def start(self):
+        """Watch the placement of the host, the client must be started."""
+        self._token = token = object()
+        self.zk.ensure_path(self.placement)
+        self.zk.ChildrenWatch(self.placement)(self._children_watcher(token))
+        return self
+
+    def stop(self):
+        """Stop watching the placement, the watches stop at their next event."""
+        with self._lock:
+            self._token = None
+            self._apps = {}
+
+    def tick(self):
+        """Observe the containers and reconcile the changed instances.
+
+        :returns ``int``:
+            The number of instances reconciled.
+        """
+        self.observe(self.client.containers(
+            all=True, filters={'label': [instance_index.LABEL_HOST + '=' + self.hostname]}
+        ))
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for name in sorted(dirty):
+            self._reconcile(name)
+        return len(dirty)
+
+    def observe(self, summaries):
+        """Set the observed containers from a labelled listing."""
+        observed = {}
+        for summary in summaries:
+            name = summary.labels.get(instance_index.LABEL_INSTANCE)
+            if name is not None:
+                current = observed.get(name)
+                # Duplicates are removed one at a time, the running first kept.
+                if current is None or (current.state != runtime.RUNNING and
+                                       summary.state == runtime.RUNNING):
+                    observed[name] = summary
+        with self._lock:
+            for name in set(observed) | {
+                    name for name, instance in self.instances.items()
+                    if instance.container is not None}:
+                self._set_container(name, observed.get(name))
+
+    def desired(self):
+        """Returns the names of the desired instances."""
+        with self._lock:
+            return sorted(
+                name for name, instance in self.instances.items()
+                if instance.manifest() is not None
+            )
+
+    def _set_container(self, name, summary):
+        instance = self._instance(name)
+        if _key(instance.container) != _key(summary):
+            instance.container = summary
+            self._bump(instance)
+        else:
+            instance.container = summary
+
+    def _instance(self, name):
+        instance = self.instances.get(name)
+        if instance is None:
+            instance = self.instances[name] = Instance(name)
+        return instance
+
+    def _bump(self, instance):
+        self.generation += 1
+        instance.generation = self.generation
+        self._dirty.add(instance.name)
+        self._index(instance)
+        if self.on_change is not None:
+            self.on_change()
+
+    def _index(self, instance):
+        if self.index is not None:
+            self.index.update(instance.name, instance.manifest(), instance.container)
+
+    def _reconcile(self, name):
+        with self._lock:
+            instance = self.instances.get(name)
+            if instance is None:
+                return
+            generation = instance.generation
+            manifest_data = instance.manifest()
+            container = instance.container
+        container_id = container.id if container is not None else None
+        retry = False
+        try:
+            if manifest_data is None:
+                if container is not None:
+                    self.actuator.remove(name, container_id)
+                    container_id = None
+            elif container is None:
+                container_id = self.actuator.create(name, manifest_data)
+                container = runtime.ContainerSummary(
+                    id=container_id, state=runtime.RUNNING, status='',
+                    labels={}, exit_code=None
+                )
+            elif container.state == runtime.EXITED:
+                self.actuator.exited(name, manifest_data, container)
+                # The placement is deleted, without waiting for its watch.
+                with self._lock:
+                    instance.placement = None
+                container_id = None
+            elif container.state == runtime.CREATED:
+                # Left by a failed start, created again on the next tick.
+                self.actuator.remove(name, container_id, placed=True)
+                container_id = None
+                retry = True
+        except (runtime.ContainerError, KazooException) as e:
+            logging.info('reconcile %s failed: %s', name, e)
+            with self._lock:
+                self._dirty.add(name)
+            return
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logging.warning('reconcile %s failed, bad manifest: %r', name, e)
+            with self._lock:
+                self._dirty.add(name)
+            return
+        with self._lock:
+            if container_id is None:
+                instance.container = None
+            elif instance.container is None or instance.container.id != container_id:
+                instance.container = container
+            instance.reconciled = generation
+            self._index(instance)
+            if retry or instance.generation != generation:
+                self._dirty.add(name)
+            elif instance.manifest() is None and instance.container is None:
+                self.instances.pop(name, None)
+
+    def _children_watcher(self, token):
+        def watcher(children):
+            with self._lock:
+                if self._token is not token:
+                    return False
+                children = set(children)
+                for app in set(self._apps) - children:
+                    del self._apps[app]
+                    instance = self._instance(app)
+                    instance.placement = instance.scheduled = None
+                    self._bump(instance)
+                added = []
+                for app in children - set(self._apps):
+                    self._apps[app] = app_token = object()
+                    added.append((app, app_token))
+            for app, app_token in added:
+                self.zk.DataWatch(self.placement + '/' + app)(
+                    self._data_watcher(app, app_token, 'placement'))
+                self.zk.DataWatch(SCHEDULED + '/' + app)(
+                    self._data_watcher(app, app_token, 'scheduled'))
+            return None
+        return watcher
+
+    def _data_watcher(self, app, token, attribute):
+        def watcher(data, stat):
+            with self._lock:
+                if self._apps.get(app) is not token:
+                    return False
+                value = None
+                if stat is not None:
+                    value = _parse(data)
+                    if attribute == 'placement' and not isinstance(value, dict):
+                        value = {}
+                instance = self._instance(app)
+                if getattr(instance, attribute) != value:
+                    setattr(instance, attribute, value)
+                    self._bump(instance)
+            return None
+        return watcher
+
+
+class Actuator(object):
+    """Apply the changes of the reconciler, keeping the records of the services."""
+
+    def __init__(self, zk, client, root, hostname, index=None):
+        """
+        zk: Zookeeper client
+        client: container runtime
+        root: work directory
+        hostname: name of the host
+        index: StateIndex of the state API, given the app events
+        """
+        self.zk = zk
+        self.client = client
+        self.root = root
+        self.hostname = hostname
+        self.index = index
+
+    def create(self, name, manifest_data):
+        """Create and start the container of an instance, returns its id."""
+        options = priority.PriorityManager.from_env(root=self.root).container_options(
+            int(manifest_data['cpu'][:len(manifest_data['cpu']) - 1]))
+        options['labels'] = instance_index.labels(name, manifest_data, self.hostname)
+        if manifest_data['image'] == "nginx":
+            options['ports'] = {'80/tcp': int(manifest_data['endpoints'][0]['port'])}
+        else:
+            options['command'] = manifest_data['services'][0]['command']
+        container_id = self.client.create(
+            image=manifest_data['image'], mem_limit=manifest_data['memory'], **options
+        )
+        self._post(name, 'configured', container_id)
+        self.client.start(container_id)
+        manifest_data = dict(manifest_data, container_id=container_id)
+        _write(os.path.join(self.root, RUNNING_DIR), name, manifest_data)
+        self._post(name, 'service_running', '%s.%s' % (
+            container_id, manifest_data['services'][0]['name']))
+        if not self.zk.exists(RUNNING + '/' + name):
+            self.zk.create(RUNNING + '/' + name, self.hostname.encode('utf-8'))
+        logging.info('running %s: %s', name, container_id)
+        return container_id
+
+    def exited(self, name, manifest_data, container):
+        """Report the exit of the container of an instance and clean it up."""
+        rc = container.exit_code
+        service = manifest_data['services'][0]['name']
+        self._post(name, 'service_exited', '%s.%s.%s.%s' % (container.id, service, rc, rc))
+        if rc == 0:
+            self._post(name, 'finished', '0.0')
+            self._delete(SCHEDULED + '/' + name)
+        elif rc == 137:
+            self._post(name, 'killed', '')
+        else:
+            self._post(name, 'aborted', str(rc))
+        self.remove(name, container.id)
+
+    def remove(self, name, container_id, placed=False):
+        """Remove the container of an instance and its records."""
+        try:
+            self.client.remove(container_id, force=True)
+        except runtime.NotFound:
+            pass
+        if not placed:
+            self._delete(PLACEMENT + '/' + self.hostname + '/' + name)
+        self._delete(RUNNING + '/' + name)
+        try:
+            os.unlink(os.path.join(os.path.join(self.root, RUNNING_DIR), name))
+        except OSError:
+            pass
+        logging.info('removed %s: %s', name, container_id)
+
+    def _delete(self, path):
+        try:
+            self.zk.delete(path)
+        except NoNodeError:
+            pass
+
+    def _post(self, name, event_type, event_data):
+        """Post an app event, as the services do."""
+        events_dir = os.path.join(self.root, APP_EVENTS_DIR)
+        filename = '%s,%s,%s,%s' % (time.time(), name, event_type, event_data)
+        with tempfile.NamedTemporaryFile(dir=events_dir, delete=False,
+                                         prefix='.tmp', mode='w') as temp:
+            yaml.dump(None, stream=temp)
+        os.rename(temp.name, os.path.join(events_dir, filename))
+        if self.index is not None:
+            self.index.event(name, event_type, event_data)
+
+
+def run(root, zk, client, should_stop):
+    """Reconcile the instances of the host until stopped.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    """
+    import socket
+    hostname = socket.gethostname()
+    pace = loop.Loop('reconciler', should_stop)
+    index = state_api.StateIndex.from_env()
+    state_api.serve(index)
+    reconciler = Reconciler(zk, client, hostname, Actuator(zk, client, root, hostname, index),
+                            on_change=pace.notify, index=index).start()
+    controller = elasticity.ElasticityController.from_env(client, root)
+    try:
+        while True:
+            worked = 0
+            try:
+                worked = reconciler.tick()
+            except runtime.ContainerError as e:
+                logging.info(e)
+            try:
+                controller.sample(_elastic_limits(reconciler))
+            except Exception as e:
+                logging.info(e)
+            if pace.sleep(worked):
+                break
+    finally:
+        reconciler.stop()
+        controller.close()
+
+
+def _elastic_limits(reconciler):
+    limits = {}
+    with reconciler._lock:
+        for instance in reconciler.instances.values():
+            manifest_data = instance.manifest()
+            if (manifest_data is not None and instance.container is not None and
+                    instance.container.state == runtime.RUNNING):
+                instance_limits = elasticity.elastic_limits(manifest_data)
+                if instance_limits is not None:
+                    limits[instance.container.id] = instance_limits
+    return limits
+
+
+def _key(summary):
+    if summary is None:
+        return None
+    return (summary.id, summary.state, summary.exit_code)
+
+
+def _parse(data):
+    if not data:
+        return None
+    try:
+        return yaml.safe_load(data)
+    except yaml.YAMLError:
+        return None
+
+
+def _write(directory, name, data):
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.%s-' % name,
+                                     delete=False, mode='w') as temp:
+        yaml.dump(data, stream=temp)
+    os.rename(temp.name, os.path.join(directory, name))
+
+
+class Harness(object):
+    """Drive a reconciler over in memory Zookeeper and containers.
+
+    The changes are chosen by a seeded random generator, and the watches of
+    the fake Zookeeper are synchronous: a run is deterministic.
+    """
+
+    HOSTNAME = 'desktop'
+
+    def __init__(self, seed=0):
+        from gcp_wc.fake_zookeeper import FakeZooKeeper
+        self.rng = random.Random(seed)
+        self.root = tempfile.mkdtemp()
+        for directory in (RUNNING_DIR, APP_EVENTS_DIR):
+            os.makedirs(os.path.join(self.root, directory))
+        self.zk = FakeZooKeeper()
+        self.zk.start()
+        self.zk.ensure_path(RUNNING)
+        self.client = runtime.FakeRuntime()
+        self.index = state_api.StateIndex(history=10 ** 6)
+        self.reconciler = Reconciler(
+            self.zk, self.client, self.HOSTNAME,
+            Actuator(self.zk, self.client, self.root, self.HOSTNAME, self.index),
+            index=self.index,
+        ).start()
+        self.placed = 0
+
+    def close(self):
+        self.reconciler.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def place(self):
+        name = 'proid.app#%010d' % self.placed
+        self.placed += 1
+        manifest_data = {
+            'image': 'python', 'cpu': '10%', 'memory': '100M',
+            'services': [{'name': 'app', 'command': 'python app.py'}],
+            'endpoints': [{'port': 8000}],
+        }
+        self.zk.create(SCHEDULED + '/' + name,
+                       yaml.safe_dump(manifest_data).encode('utf-8'), makepath=True)
+        self.zk.create(PLACEMENT + '/' + self.HOSTNAME + '/' + name, b'expires: 0\n',
+                       makepath=True)
+
+    def unplace(self):
+        apps = self.zk.get_children(PLACEMENT + '/' + self.HOSTNAME)
+        if apps:
+            app = self.rng.choice(sorted(apps))
+            self.zk.delete(PLACEMENT + '/' + self.HOSTNAME + '/' + app)
+            self.zk.delete(SCHEDULED + '/' + app)
+
+    def exit(self):
+        running = [container_id for container_id, container in self.client.containers_by_id.items()
+                   if container['state'] == runtime.RUNNING]
+        if running:
+            self.client.exit(self.rng.choice(running), self.rng.choice((0, 1, 137)))
+
+    def step(self, changes):
+        """Make changes at random, then tick, returns the instances reconciled."""
+        for _ in range(changes):
+            self.rng.choice((self.place, self.place, self.unplace, self.exit))()
+        return self.reconciler.tick()
+
+    def check(self):
+        """Tick until quiet, raise AssertionError if the host diverged."""
+        while self.reconciler.tick():
+            pass
+        placed = set(self.zk.get_children(PLACEMENT + '/' + self.HOSTNAME))
+        containers = self.client.containers(all=True)
+        running = set(os.listdir(os.path.join(self.root, RUNNING_DIR)))
+        by_instance = {}
+        for summary in containers:
+            by_instance.setdefault(summary.labels[instance_index.LABEL_INSTANCE], []).append(summary)
+        assert set(by_instance) == placed, (set(by_instance) ^ placed)
+        assert all(len(summaries) == 1 and summaries[0].state == runtime.RUNNING
+                   for summaries in by_instance.values())
+        assert running == placed, running ^ placed
+        assert set(self.zk.get_children(RUNNING)) == placed
+        indexed = self.index.query(states=['running'], limit=len(placed) + 1)['instances']
+        assert set(instance['name'] for instance in indexed) == placed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconciler simulation')
+    parser.add_argument('--simulate', action='store_true', required=True)
+    parser.add_argument('--apps', type=int, default=500)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--changes', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    harness = Harness(args.seed)
+    try:
+        for _ in range(args.apps):
+            harness.place()
+        harness.check()
+        reconciled = 0
+        started = time.time()
+        for _ in range(args.steps):
+            reconciled += harness.step(args.changes)
+        elapsed = time.time() - started
+        harness.check()
+        print('instances       %d' % len(harness.reconciler.desired()))
+        print('reconciled/tick %.1f' % (reconciled / float(args.steps)))
+        print('ms/tick         %.2f' % (elapsed * 1000 / args.steps))
+        print('generation      %d' % harness.reconciler.generation)
+        print('consistent      yes')
+    finally:
+        harness.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
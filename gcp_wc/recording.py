@@ -0,0 +1,299 @@
+"""Recording.
+
+Trace of the traffic of the agent with Zookeeper and Docker, to replay the
+exact sequence of placements, exits and revocations of a desktop against
+the fakes (see benchmarks/bench_replay.py).
+
+With the "recordTraffic" setting at "1", the Zookeeper client and the
+container runtime of the process are wrapped: every request, its response
+or error, and every watch firing is appended to
+log/traffic.<time>.<pid>.trace, until the file reaches "recordMaxBytes".
+A trace is one JSON document per line. The first line is the header:
+
+    {"trace": 1, "start": <epoch seconds>, "hostname": "...", "pid": 42}
+
+then one array per call, in the order the calls ended:
+
+    [<ms since start>, <kind>, <operation>, <args>, <kwargs>, <result>,
+     <error>, <ms taken>]
+
+The kind is "zk", "docker" or "watch" (operation "data" or "children",
+args the path). Node data is text, undecodable bytes escaped as surrogates;
+stats and container summaries are lists of their fields; the error is the
+name of the exception class. The Zookeeper session of the broker is not
+recorded: its requests are the ones its clients record.
+"""
+import os
+import json
+import time
+import socket
+import atexit
+import logging
+import threading
+
+from gcp_wc import config
+from gcp_wc import logs
+from gcp_wc.fake_zookeeper import call_data_watch
+
+VERSION = 1
+
+ZOOKEEPER_OPERATIONS = (
+    'create',
+    'delete',
+    'ensure_path',
+    'exists',
+    'get',
+    'get_children',
+    'set',
+)
+
+RUNTIME_CALLS = (
+    'containers',
+    'create',
+    'kill',
+    'pause',
+    'remove',
+    'start',
+    'state',
+    'unpause',
+    'update',
+)
+
+# Seconds between two flushes of the trace.
+FLUSH_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_trace = None
+
+
+def encode(value):
+    """Returns value as JSON: text for bytes, lists for tuples."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'surrogateescape')
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((str(key), encode(item)) for key, item in value.items())
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def decode(text):
+    """Returns the bytes of encoded node data."""
+    return None if text is None else text.encode('utf-8', 'surrogateescape')
+
+
+class Trace(object):
+    """Trace file of a process."""
+
+    def __init__(self, path, max_bytes, hostname=None, clock=time.time):
+        """
+        path: file of the trace
+        max_bytes: size at which the recording stops
+        hostname: name of the host, recorded in the header
+        clock: returns the time in seconds
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.start = clock()
+        self.size = 0
+        self._flushed = self.start
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+        self._write({
+            'trace': VERSION,
+            'start': self.start,
+            'hostname': hostname or socket.gethostname(),
+            'pid': os.getpid(),
+        })
+
+    def record(self, kind, operation, args, kwargs, result, error, started):
+        """Append a call that started at started and ends now."""
+        now = self.clock()
+        self._write([
+            round((started - self.start) * 1000, 1),
+            kind,
+            operation,
+            encode(args),
+            encode(kwargs),
+            encode(result),
+            None if error is None else type(error).__name__,
+            round((now - started) * 1000, 1),
+        ], now)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def _write(self, document, now=None):
+        line = json.dumps(document, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file.closed:
+                return
+            if self.size + len(line) > self.max_bytes:
+                logging.warning('Trace %s is full, recording stopped', self.path)
+                self._file.close()
+                return
+            self._file.write(line)
+            self.size += len(line)
+            if now is not None and now - self._flushed >= FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = now
+
+
+def read(path):
+    """Returns the header of a trace and its calls."""
+    calls = []
+    with open(path) as f:
+        header = json.loads(f.readline())
+        for line in f:
+            try:
+                calls.append(json.loads(line))
+            except ValueError:
+                # Cut by a crash or the size limit.
+                break
+    return header, calls
+
+
+class RecordingZooKeeper(object):
+    """Zookeeper client recording its traffic, otherwise the client."""
+
+    def __init__(self, zk, trace):
+        self._zk = zk
+        self._trace = trace
+
+    def __getattr__(self, name):
+        attr = getattr(self._zk, name)
+        if name not in ZOOKEEPER_OPERATIONS:
+            return attr
+        request = _recorded(self._trace, 'zk', name, attr)
+        # Found in the instance from now on.
+        setattr(self, name, request)
+        return request
+
+    def transaction(self):
+        return _RecordingTransaction(self._zk.transaction(), self._trace)
+
+    def DataWatch(self, path, func=None, *args, **kwargs):
+        trace = self._trace
+
+        def register(func):
+            def watcher(data, stat, event=None):
+                started = trace.clock()
+                try:
+                    return call_data_watch(func, data, stat, event)
+                finally:
+                    trace.record('watch', 'data', [path], {}, [data, stat], None, started)
+            self._zk.DataWatch(path, watcher, *args, **kwargs)
+            return func
+        if func is None:
+            return register
+        return register(func)
+
+    def ChildrenWatch(self, path, func=None, *args, **kwargs):
+        trace = self._trace
+
+        def register(func):
+            def watcher(children, *event):
+                started = trace.clock()
+                try:
+                    return func(children, *event)
+                finally:
+                    trace.record('watch', 'children', [path], {}, children, None, started)
+            self._zk.ChildrenWatch(path, watcher, *args, **kwargs)
+            return func
+        if func is None:
+            return register
+        return register(func)
+
+
+class _RecordingTransaction(object):
+    """Transaction recorded as a whole when committed."""
+
+    def __init__(self, transaction, trace):
+        self._transaction = transaction
+        self._trace = trace
+        self._operations = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._transaction, name)
+
+        def operation(*args, **kwargs):
+            self._operations.append([name] + list(args))
+            return attr(*args, **kwargs)
+        return operation
+
+    def commit(self):
+        started = self._trace.clock()
+        try:
+            results = self._transaction.commit()
+        except Exception as e:
+            self._trace.record('zk', 'transaction', self._operations, {}, None, e, started)
+            raise
+        self._trace.record('zk', 'transaction', self._operations, {}, [
+            type(result).__name__ if isinstance(result, Exception) else result
+            for result in results
+        ], None, started)
+        return results
+
+
+class RecordingRuntime(object):
+    """Container runtime recording its calls, otherwise the runtime."""
+
+    def __init__(self, client, trace):
+        self._client = client
+        self._trace = trace
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in RUNTIME_CALLS:
+            return attr
+        request = _recorded(self._trace, 'docker', name, attr)
+        setattr(self, name, request)
+        return request
+
+
+def _recorded(trace, kind, name, request):
+    def recorded(*args, **kwargs):
+        started = trace.clock()
+        try:
+            result = request(*args, **kwargs)
+        except Exception as e:
+            trace.record(kind, name, args, kwargs, None, e, started)
+            raise
+        trace.record(kind, name, args, kwargs, result, None, started)
+        return result
+    return recorded
+
+
+def current():
+    """Returns the trace of the process, None unless "recordTraffic" is on."""
+    global _trace
+    settings = config.current()
+    if not settings.recordTraffic:
+        return None
+    with _lock:
+        if _trace is None:
+            directory = os.path.join(settings.workDirectory, logs.LOG_DIR)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            _trace = Trace(os.path.join(directory, 'traffic.%s.%d.trace' % (
+                time.strftime('%Y%m%d-%H%M%S'), os.getpid())), settings.recordMaxBytes)
+            atexit.register(_trace.close)
+            logging.info('Recording the traffic to %s', _trace.path)
+        return _trace
+
+
+def zookeeper(zk):
+    """Returns zk recording its traffic to the trace of the process, if on."""
+    trace = current()
+    return zk if trace is None else RecordingZooKeeper(zk, trace)
+
+
+def runtime(client):
+    """Returns client recording its calls to the trace of the process, if on."""
+    trace = current()
+    return client if trace is None else RecordingRuntime(client, trace)
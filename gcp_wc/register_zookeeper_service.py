@@ -3,25 +3,26 @@
 When the screen is locked, register zookeeper.
 """
 import os
-import docker
 import socket
 import collections
 import functools
-import logging.config
-from kazoo.client import KazooClient
+import logging
+
+from gcp_wc import config
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import node_data
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import runtime
+from gcp_wc import screen_state
+from gcp_wc import zk_broker
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'registerZookeeperSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
-
 SERVERS = '/servers'
 SERVER_PRESENCE = '/server.presence'
 BLACKEDOUT_SERVERS = '/blackedout.servers'
@@ -41,7 +42,7 @@ class RegisterZookeeperSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -49,41 +50,75 @@ class RegisterZookeeperSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('registerZookeeperSVC.txt')
+        config.watch()
+        loop.install(loop.EventActivity('registerZookeeper', self.hWaitStop))
+        metrics.serve('registerZookeeper', self.root)
+        profiler.control('registerZookeeper', self.root)
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts = master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            client = docker.from_env()
-            screen_state = "Unlock"
-            while True:
-                if os.path.exists(os.path.join(self.root, screen_state_file)):
-                    f = open(os.path.join(self.root, screen_state_file), 'r')
-                    screen_state = f.read()
-                if screen_state == 'Lock':
-                #if True:
-                    create_workDirectory(self.root)
-                    node_data = zk.get(path.server('node'))
-                    # For desktop, we add a 'windows' label, in order to schedule better later.
-                    desktop_data = node_data[0].decode().replace('~', 'windows', 1)
-                    if not zk.exists(path.server(_HOSTNAME)):
-                        zk.create(path.server(_HOSTNAME), desktop_data.encode('utf-8'))
-                        logging.info("Create servers node: %s", _HOSTNAME)
-                    if zk.exists(path.blackedout_server(_HOSTNAME)):
-                        if zk.exists(path.server_presence(_HOSTNAME)):
-                            zk.delete(path.server_presence(_HOSTNAME))
-                    elif not zk.exists(path.server_presence(_HOSTNAME)):
-                        zk.create(path.server_presence(_HOSTNAME), desktop_data.encode('utf-8'), ephemeral=True)
-                        logging.info("Create server.presence node: %s", _HOSTNAME)
-                else:
-                    pass
-                    # if zk.exists(path.server_presence(_HOSTNAME)):
-                    #     zk.delete(path.server_presence(_HOSTNAME))
-                    #     logging.info("Delete server.presence node: %s", _HOSTNAME)
-                if win32event.WaitForSingleObject(self.hWaitStop, 100) == win32event.WAIT_OBJECT_0:
-                    break
+            client = runtime.DockerRuntime.from_env()
+            run(self.root, zk, client,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
+def run(root, zk, client, should_stop, hostname=None):
+    """Register the desktop in Zookeeper while the screen is locked.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    :param hostname:
+        Name the desktop registers as, the name of the machine by default.
+    """
+    hostname = hostname or _HOSTNAME
+    # Advertise the desktop once the lock settled and is worth it.
+    screen = screen_state.ScreenState.from_env(root)
+    pace = loop.Loop('registerZookeeper', should_stop)
+    while True:
+        worked = False
+        if screen.advertise():
+        #if True:
+            create_workDirectory(root)
+            worked = register(zk, hostname)
+        else:
+            pass
+            # if zk.exists(path.server_presence(_HOSTNAME)):
+            #     zk.delete(path.server_presence(_HOSTNAME))
+            #     logging.info("Delete server.presence node: %s", _HOSTNAME)
+        if pace.sleep(worked):
+            break
+
+def register(zk, hostname):
+    """Create the server node and the presence node of the desktop.
+
+    The presence node is deleted instead while the desktop is blacked out.
+
+    :returns ``bool``:
+        Whether a node was created or deleted.
+    """
+    worked = False
+    if not zk.exists(path.server(hostname)):
+        zk.create(path.server(hostname), desktop_data(zk))
+        logging.info("Create servers node: %s", hostname)
+        worked = True
+    if zk.exists(path.blackedout_server(hostname)):
+        if zk.exists(path.server_presence(hostname)):
+            zk.delete(path.server_presence(hostname))
+            worked = True
+    elif not zk.exists(path.server_presence(hostname)):
+        zk.create(path.server_presence(hostname), desktop_data(zk), ephemeral=True)
+        logging.info("Create server.presence node: %s", hostname)
+        worked = True
+    return worked
+
+def desktop_data(zk):
+    """Returns the serialized desktop node data built from the server template."""
+    return node_data.from_template(zk.get(path.server('node'))[0]).serialize()
+
 def create_workDirectory(root):
     if not os.path.exists(os.path.join(root, 'appevents')):
         os.makedirs(os.path.join(root, 'appevents'))
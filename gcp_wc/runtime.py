@@ -0,0 +1,363 @@
+"""Container Runtime.
+
+The container operations of the agent, behind ContainerRuntime.
+
+DockerRuntime talks to the Docker Engine through the low level APIClient: one
+pooled keep-alive connection per process, explicit timeouts, and listings
+that return the container summaries of the list call itself rather than
+inspecting every container. FakeRuntime keeps containers in memory, to run
+the agent without dockerd.
+"""
+import os
+import re
+import abc
+import json
+import time
+import uuid
+import threading
+import collections
+
+from gcp_wc import config
+from gcp_wc import metrics
+from gcp_wc import recording
+
+# Seconds for a request to the engine.
+DEFAULT_TIMEOUT = 60
+# Connection pools kept alive.
+DEFAULT_NUM_POOLS = 4
+
+CREATED = 'created'
+RUNNING = 'running'
+PAUSED = 'paused'
+EXITED = 'exited'
+
+ContainerSummary = collections.namedtuple('ContainerSummary', """
+    id
+    state
+    status
+    labels
+    exit_code
+    """)
+
+_EXIT_CODE = re.compile(r'^Exited \((-?\d+)\)')
+
+_SECONDS = metrics.histogram(
+    'gcp_wc_docker_request_seconds', 'Docker API calls by call.', ('call',))
+_ERRORS = metrics.counter(
+    'gcp_wc_docker_errors_total', 'Docker API calls failed, by call.', ('call',))
+
+
+class ContainerError(Exception):
+    """A request to the container runtime failed."""
+    pass
+
+
+class NotFound(ContainerError):
+    """No such container."""
+    pass
+
+
+class ContainerRuntime(object, metaclass=abc.ABCMeta):
+    """Interface to the container engine."""
+
+    @abc.abstractmethod
+    def containers(self, all=False, filters=None):
+        """Returns the ContainerSummary of the containers.
+
+        :param ``dict`` filters:
+            Docker list filters: status, exited, label, id.
+        """
+        pass
+
+    @abc.abstractmethod
+    def create(self, image, command=None, ports=None, labels=None, **options):
+        """Create a container, returns its id.
+
+        :param ``dict`` ports:
+            Container port ('80/tcp') to host port.
+        :param options:
+            Host options: mem_limit, cpu_percent, cpu_shares, cpuset_cpus...
+        """
+        pass
+
+    @abc.abstractmethod
+    def start(self, container_id):
+        pass
+
+    @abc.abstractmethod
+    def kill(self, container_id):
+        pass
+
+    @abc.abstractmethod
+    def remove(self, container_id, force=False):
+        pass
+
+    @abc.abstractmethod
+    def pause(self, container_id):
+        pass
+
+    @abc.abstractmethod
+    def unpause(self, container_id):
+        pass
+
+    @abc.abstractmethod
+    def update(self, container_id, **options):
+        """Update the resource limits of a container."""
+        pass
+
+    @abc.abstractmethod
+    def state(self, container_id):
+        """Returns the state of a container, raises NotFound."""
+        pass
+
+    @abc.abstractmethod
+    def stats(self, container_id, stream=True):
+        """Returns the stats frame of a container, or its raw stream."""
+        pass
+
+    def close(self):
+        """Free resources."""
+        pass
+
+
+class DockerRuntime(ContainerRuntime):
+    """Docker Engine through the low level API client."""
+
+    def __init__(self, api):
+        """
+        api: docker.APIClient
+        """
+        import docker.errors
+        import requests.exceptions
+        self.api = api
+        self._not_found = docker.errors.NotFound
+        self._errors = (docker.errors.DockerException, requests.exceptions.RequestException)
+
+    @classmethod
+    def from_env(cls):
+        """Returns the DockerRuntime of the environment, as docker.from_env."""
+        import docker
+        from docker.utils import kwargs_from_env
+        settings = config.current()
+        return recording.runtime(cls(docker.APIClient(
+            timeout=settings.dockerTimeout / 1000.0,
+            num_pools=settings.dockerPools,
+            **kwargs_from_env()
+        )))
+
+    def containers(self, all=False, filters=None):
+        return [summary(container)
+                for container in self._call(self.api.containers, all=all, filters=filters)]
+
+    def create(self, image, command=None, ports=None, labels=None, **options):
+        host_config = self.api.create_host_config(port_bindings=ports or None, **options)
+        container = self._call(
+            self.api.create_container, image, command=command, labels=labels,
+            ports=[tuple(port.split('/', 1)) for port in (ports or {})] or None,
+            host_config=host_config
+        )
+        return container['Id']
+
+    def start(self, container_id):
+        self._call(self.api.start, container_id)
+
+    def kill(self, container_id):
+        self._call(self.api.kill, container_id)
+
+    def remove(self, container_id, force=False):
+        self._call(self.api.remove_container, container_id, force=force)
+
+    def pause(self, container_id):
+        self._call(self.api.pause, container_id)
+
+    def unpause(self, container_id):
+        self._call(self.api.unpause, container_id)
+
+    def update(self, container_id, **options):
+        self._call(self.api.update_container, container_id, **options)
+
+    def state(self, container_id):
+        return self._call(self.api.inspect_container, container_id)['State']['Status']
+
+    def stats(self, container_id, stream=True):
+        return self._call(self.api.stats, container_id, decode=False, stream=stream)
+
+    def close(self):
+        self.api.close()
+
+    def _call(self, request, *args, **kwargs):
+        name = request.__name__
+        started = time.time()
+        try:
+            return request(*args, **kwargs)
+        except self._not_found as e:
+            raise NotFound(str(e))
+        except self._errors as e:
+            _ERRORS.labels(name).inc()
+            raise ContainerError(str(e))
+        finally:
+            _SECONDS.labels(name).observe(time.time() - started)
+
+
+def summary(container):
+    """Returns the ContainerSummary of an entry of the list call."""
+    status = container.get('Status') or ''
+    match = _EXIT_CODE.match(status)
+    return ContainerSummary(
+        id=container['Id'],
+        state=container.get('State'),
+        status=status,
+        labels=container.get('Labels') or {},
+        exit_code=int(match.group(1)) if match else None,
+    )
+
+
+class FakeRuntime(ContainerRuntime):
+    """In memory containers.
+
+    Containers run until `exit` is called on them, and record the requests
+    made to them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.containers_by_id = collections.OrderedDict()
+        self.calls = []
+
+    def exit(self, container_id, exit_code=0):
+        """Make a running container exit."""
+        with self._lock:
+            container = self._get(container_id)
+            container['state'] = EXITED
+            container['exit_code'] = exit_code
+
+    def containers(self, all=False, filters=None):
+        with self._lock:
+            self.calls.append(('containers', all, filters))
+            result = []
+            for container_id, container in self.containers_by_id.items():
+                if not all and container['state'] != RUNNING:
+                    continue
+                if _matches(container_id, container, filters or {}):
+                    result.append(ContainerSummary(
+                        id=container_id,
+                        state=container['state'],
+                        status=_status(container),
+                        labels=dict(container['labels']),
+                        exit_code=container['exit_code'],
+                    ))
+            return result
+
+    def create(self, image, command=None, ports=None, labels=None, **options):
+        container_id = uuid.uuid4().hex * 2
+        with self._lock:
+            self.calls.append(('create', image))
+            self.containers_by_id[container_id] = {
+                'image': image,
+                'command': command,
+                'ports': ports,
+                'labels': labels or {},
+                'options': options,
+                'state': CREATED,
+                'exit_code': None,
+                'started': None,
+            }
+        return container_id
+
+    def start(self, container_id):
+        self._transition('start', container_id, (CREATED, EXITED), RUNNING)
+
+    def kill(self, container_id):
+        self._transition('kill', container_id, (RUNNING, PAUSED), EXITED, exit_code=137)
+
+    def remove(self, container_id, force=False):
+        with self._lock:
+            self.calls.append(('remove', container_id))
+            container = self._get(container_id)
+            if container['state'] in (RUNNING, PAUSED) and not force:
+                raise ContainerError('container %s is running' % container_id)
+            del self.containers_by_id[container_id]
+
+    def pause(self, container_id):
+        self._transition('pause', container_id, (RUNNING,), PAUSED)
+
+    def unpause(self, container_id):
+        self._transition('unpause', container_id, (PAUSED,), RUNNING)
+
+    def update(self, container_id, **options):
+        with self._lock:
+            self.calls.append(('update', container_id))
+            self._get(container_id)['options'].update(options)
+
+    def state(self, container_id):
+        with self._lock:
+            return self._get(container_id)['state']
+
+    def stats(self, container_id, stream=True):
+        with self._lock:
+            container = self._get(container_id)
+            running = time.time() - container['started'] if container['started'] else 0
+        frame = {
+            'cpu_stats': {
+                'cpu_usage': {'total_usage': int(running * 1e9)},
+                'system_cpu_usage': int(time.time() * 1e9),
+                'online_cpus': os.cpu_count() or 1,
+            },
+            'memory_stats': {'usage': 64 * 1024 * 1024},
+        }
+        if stream:
+            return iter([json.dumps(frame).encode('utf-8')])
+        return frame
+
+    def _get(self, container_id):
+        container = self.containers_by_id.get(container_id)
+        if container is None:
+            raise NotFound('No such container: %s' % container_id)
+        return container
+
+    def _transition(self, request, container_id, states, state, exit_code=None):
+        with self._lock:
+            self.calls.append((request, container_id))
+            container = self._get(container_id)
+            if container['state'] not in states:
+                raise ContainerError('cannot %s container %s in state %s' % (
+                    request, container_id, container['state']))
+            container['state'] = state
+            if state == RUNNING and request == 'start':
+                container['started'] = time.time()
+                container['exit_code'] = None
+            if exit_code is not None:
+                container['exit_code'] = exit_code
+
+
+def _status(container):
+    if container['state'] == EXITED:
+        return 'Exited (%d) 1 second ago' % container['exit_code']
+    if container['state'] == RUNNING:
+        return 'Up 1 second'
+    return container['state'].capitalize()
+
+
+def _matches(container_id, container, filters):
+    """Docker filter semantics: any of the values of a filter, all labels."""
+    for name, values in filters.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        if name == 'label':
+            for value in values:
+                key, _sep, expected = value.partition('=')
+                if key not in container['labels']:
+                    return False
+                if expected and container['labels'][key] != expected:
+                    return False
+        elif name == 'status':
+            if container['state'] not in values:
+                return False
+        elif name == 'exited':
+            if (container['state'] != EXITED or
+                    str(container['exit_code']) not in [str(value) for value in values]):
+                return False
+        elif name == 'id':
+            if not any(container_id.startswith(value) for value in values):
+                return False
+    return True
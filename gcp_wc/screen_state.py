@@ -0,0 +1,279 @@
+"""Screen State.
+
+Debounced view of the screen state written by the ScreenMonitorService.
+
+A raw Lock or Unlock only takes effect once it has settled, i.e. it was not
+reverted within the settle time of that state. The lock durations of the
+desktop are recorded, and the desktop is advertised only when the lock is
+predicted to last long enough to be worth a schedule/configure/start/revoke
+cycle.
+
+Usage:
+    python -m gcp_wc.screen_state <trace> [--lock-settle S] [--unlock-settle S] [--min-lock S]
+
+replays a recorded lock trace (one "timestamp,Lock|Unlock" per line) and
+reports how the debounced state would have behaved.
+"""
+import os
+import sys
+import time
+import bisect
+import logging
+import argparse
+import collections
+
+from gcp_wc import config
+
+LOCK = 'Lock'
+UNLOCK = 'Unlock'
+
+screen_state_file = 'screen_state.txt'
+lock_stats_file = 'lock_stats.txt'
+screen_trace_file = 'screen_trace.txt'
+
+# Seconds a raw state must hold before it takes effect.
+DEFAULT_LOCK_SETTLE = 30
+DEFAULT_UNLOCK_SETTLE = 0
+# Seconds a lock must be expected to last for the desktop to be advertised.
+DEFAULT_MIN_LOCK = 60
+# Number of lock durations kept, and needed before predicting.
+DEFAULT_HISTORY = 200
+MIN_SAMPLES = 5
+
+
+class Debouncer(object):
+    """Settle raw screen state changes."""
+
+    def __init__(self, lock_settle=DEFAULT_LOCK_SETTLE,
+                 unlock_settle=DEFAULT_UNLOCK_SETTLE):
+        self.settle = {LOCK: lock_settle, UNLOCK: unlock_settle}
+        self.state = UNLOCK
+        self.since = None
+
+    def update(self, raw, changed_at, now):
+        """Returns the settled state given the raw state and when it changed."""
+        if raw in self.settle and raw != self.state:
+            if now - changed_at >= self.settle[raw]:
+                self.state = raw
+                self.since = changed_at
+        return self.state
+
+
+class LockStatistics(object):
+    """Lock durations of the desktop, to predict how long a lock lasts."""
+
+    def __init__(self, path=None, history=DEFAULT_HISTORY):
+        """
+        path: file the durations are appended to, None to keep them in memory
+        history: number of durations kept
+        """
+        self.path = path
+        self.durations = collections.deque(maxlen=history)
+        self._sorted = None
+        self._mtime = None
+
+    def record(self, duration):
+        """Record the duration of a lock in seconds."""
+        self.durations.append(duration)
+        self._sorted = None
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write('%.1f\n' % duration)
+
+    def reload(self):
+        """Reload the durations if the file changed."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        self.durations.clear()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self.durations.append(float(line))
+                except ValueError:
+                    pass
+        self._sorted = None
+        if len(self.durations) == self.durations.maxlen:
+            # Trim the file to the kept history.
+            with open(self.path, 'w') as f:
+                f.writelines('%.1f\n' % duration for duration in self.durations)
+            self._mtime = os.path.getmtime(self.path)
+
+    def predict_remaining(self, age):
+        """Returns the median remaining duration of a lock that lasted age.
+
+        None if there are not enough samples to tell.
+        """
+        if len(self.durations) < MIN_SAMPLES:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.durations)
+        longer = self._sorted[bisect.bisect_right(self._sorted, age):]
+        if not longer:
+            return 0
+        return longer[len(longer) // 2] - age
+
+
+class ScreenState(object):
+    """Debounced screen state of the work directory."""
+
+    def __init__(self, root, lock_settle=DEFAULT_LOCK_SETTLE,
+                 unlock_settle=DEFAULT_UNLOCK_SETTLE, min_lock=DEFAULT_MIN_LOCK,
+                 history=DEFAULT_HISTORY):
+        self.root = root
+        self.debouncer = Debouncer(lock_settle, unlock_settle)
+        self.stats = LockStatistics(os.path.join(root, lock_stats_file), history)
+        self.min_lock = min_lock
+
+    @classmethod
+    def from_env(cls, root):
+        """Returns the ScreenState of the agent configuration."""
+        settings = config.current()
+        return cls(
+            root,
+            lock_settle=settings.screenLockSettle / 1000.0,
+            unlock_settle=settings.screenUnlockSettle / 1000.0,
+            min_lock=settings.minLockDuration / 1000.0,
+            history=settings.screenHistory,
+        )
+
+    def read(self, now=None):
+        """Returns the settled state, Lock or Unlock."""
+        now = now or time.time()
+        state_file = os.path.join(self.root, screen_state_file)
+        try:
+            with open(state_file) as f:
+                raw = f.read()
+            changed_at = os.path.getmtime(state_file)
+        except (IOError, OSError):
+            return self.debouncer.state
+        return self.debouncer.update(raw, changed_at, now)
+
+    def advertise(self, now=None):
+        """Returns True if the desktop should be advertised to the scheduler."""
+        now = now or time.time()
+        if self.read(now) != LOCK:
+            return False
+        self.stats.reload()
+        return worth_advertising(self.stats, now - self.debouncer.since, self.min_lock)
+
+
+def worth_advertising(stats, age, min_lock):
+    """Returns True if a lock that lasted age is expected to last min_lock more."""
+    remaining = stats.predict_remaining(age)
+    return remaining is None or remaining >= min_lock
+
+
+def record_event(root, state, lock_time, now=None):
+    """Record a raw screen event, returns the new lock time.
+
+    Writes the raw state, appends the event to the trace of the log directory
+    and records the duration of the lock that ends.
+    """
+    now = now or time.time()
+    with open(os.path.join(root, screen_state_file), 'w') as f:
+        f.write(state)
+    with open(os.path.join(os.path.join(root, 'log'), screen_trace_file), 'a') as f:
+        f.write('%.1f,%s\n' % (now, state))
+    if state == LOCK:
+        return now
+    if lock_time is not None:
+        LockStatistics(os.path.join(root, lock_stats_file)).record(now - lock_time)
+    return None
+
+
+def load_trace(path):
+    """Returns the (timestamp, state) events of a recorded trace."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            timestamp, state = line.split(',', 1)
+            events.append((float(timestamp), state))
+    events.sort()
+    return events
+
+
+def simulate(events, lock_settle=DEFAULT_LOCK_SETTLE,
+             unlock_settle=DEFAULT_UNLOCK_SETTLE, min_lock=DEFAULT_MIN_LOCK,
+             step=1.0, predict=True):
+    """Replay a lock trace through the debounced state.
+
+    Lock durations are learnt while replaying, as on the desktop. With
+    predict False every settled lock is advertised.
+
+    :returns ``dict``:
+        raw_locks: number of raw locks
+        advertised: number of times the desktop was advertised
+        wasted: advertised locks that lasted less than min_lock
+        advertised_time: seconds the desktop was advertised
+        unlock_delay: total seconds between a raw unlock and its effect
+    """
+    report = dict.fromkeys(
+        ('raw_locks', 'advertised', 'wasted', 'advertised_time', 'unlock_delay'), 0
+    )
+    if not events:
+        return report
+    debouncer = Debouncer(lock_settle, unlock_settle)
+    stats = LockStatistics()
+    raw, changed_at, lock_time = UNLOCK, events[0][0], None
+    advertised_at = None
+    pending = collections.deque(events)
+    now = events[0][0]
+    end = events[-1][0] + max(lock_settle, unlock_settle) + step
+    while now <= end:
+        while pending and pending[0][0] <= now:
+            timestamp, state = pending.popleft()
+            if state == raw:
+                continue
+            raw, changed_at = state, timestamp
+            if state == LOCK:
+                report['raw_locks'] += 1
+                lock_time = timestamp
+            elif lock_time is not None:
+                stats.record(timestamp - lock_time)
+                lock_time = None
+        state = debouncer.update(raw, changed_at, now)
+        advertise = (state == LOCK and
+                     (not predict or worth_advertising(stats, now - debouncer.since, min_lock)))
+        if advertise and advertised_at is None:
+            advertised_at = now
+            report['advertised'] += 1
+        elif not advertise and advertised_at is not None:
+            if state == UNLOCK:
+                report['unlock_delay'] += now - changed_at
+            if now - advertised_at < min_lock:
+                report['wasted'] += 1
+            report['advertised_time'] += now - advertised_at
+            advertised_at = None
+        now += step
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded lock trace.')
+    parser.add_argument('trace')
+    parser.add_argument('--lock-settle', type=float, default=DEFAULT_LOCK_SETTLE)
+    parser.add_argument('--unlock-settle', type=float, default=DEFAULT_UNLOCK_SETTLE)
+    parser.add_argument('--min-lock', type=float, default=DEFAULT_MIN_LOCK)
+    parser.add_argument('--step', type=float, default=1.0)
+    args = parser.parse_args()
+
+    events = load_trace(args.trace)
+    baseline = simulate(events, 0, 0, args.min_lock, args.step, predict=False)
+    debounced = simulate(events, args.lock_settle, args.unlock_settle,
+                         args.min_lock, args.step)
+    for name in sorted(baseline):
+        print('{name:<16} {baseline:>12.1f} {debounced:>12.1f}'.format(
+            name=name, baseline=baseline[name], debounced=debounced[name]))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
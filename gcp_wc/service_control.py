@@ -0,0 +1,261 @@
+"""Service Control.
+
+Control the agent's Windows services as a group: the services are enumerated
+and opened once, the status of the whole group is fetched with a single query
+and start/stop requests are issued concurrently.
+
+The OS calls sit behind ServiceControlManager, FakeServiceControlManager
+stands in for the Service Control Manager off Windows.
+"""
+import os
+import abc
+import time
+import signal
+import logging
+import threading
+import concurrent.futures
+
+STOPPED = 'STOPPED'
+STARTING = 'STARTING'
+STOPPING = 'STOPPING'
+RUNNING = 'RUNNING'
+
+
+class ServiceControlManager(object, metaclass=abc.ABCMeta):
+    """Interface to the Service Control Manager."""
+
+    # Exceptions of the Service Control Manager, the status is then unknown.
+    errors = ()
+
+    @abc.abstractmethod
+    def statuses(self, names):
+        """Returns {name: status} of the services, None if not installed."""
+        pass
+
+    @abc.abstractmethod
+    def start(self, name):
+        """Request the service to start."""
+        pass
+
+    @abc.abstractmethod
+    def stop(self, name):
+        """Request the service to stop."""
+        pass
+
+    @abc.abstractmethod
+    def kill(self, name):
+        """Terminate the process of the service."""
+        pass
+
+    def pid(self, name):
+        """Returns the process id of the service, None if unknown."""
+        return None
+
+    def close(self):
+        """Free resources."""
+        pass
+
+
+class Win32ServiceControlManager(ServiceControlManager):
+    """Service Control Manager of the local machine."""
+
+    def __init__(self, names):
+        """
+        names: names of the services to control
+        """
+        import win32service
+        self._win32service = win32service
+        self.errors = (win32service.error,)
+        self._states = {
+            win32service.SERVICE_STOPPED: STOPPED,
+            win32service.SERVICE_START_PENDING: STARTING,
+            win32service.SERVICE_STOP_PENDING: STOPPING,
+            win32service.SERVICE_RUNNING: RUNNING,
+        }
+        self._lock = threading.Lock()
+        self._pids = {}
+        self.scm = win32service.OpenSCManager(None, None, win32service.SC_MANAGER_ALL_ACCESS)
+        # Enumerate once, and keep the handles of the installed services.
+        installed = {
+            short_name for (short_name, _desc, _status) in win32service.EnumServicesStatus(
+                self.scm, win32service.SERVICE_WIN32, win32service.SERVICE_STATE_ALL)
+        }
+        self.handles = {}
+        for name in names:
+            if name not in installed:
+                logging.info('service %s is not installed.', name)
+                continue
+            try:
+                self.handles[name] = win32service.OpenService(
+                    self.scm, name, win32service.SC_MANAGER_ALL_ACCESS)
+            except Exception as e:
+                logging.info(e)
+
+    def statuses(self, names):
+        win32service = self._win32service
+        result = dict.fromkeys(names)
+        services = win32service.EnumServicesStatusEx(
+            self.scm, win32service.SERVICE_WIN32, win32service.SERVICE_STATE_ALL,
+            win32service.SC_ENUM_PROCESS_INFO, None)
+        with self._lock:
+            for service in services:
+                name = service['ServiceName']
+                if name in result and name in self.handles:
+                    result[name] = self._states.get(service['CurrentState'])
+                    self._pids[name] = service['ProcessId']
+        return result
+
+    def start(self, name):
+        self._win32service.StartService(self.handles[name], None)
+
+    def stop(self, name):
+        self._win32service.ControlService(self.handles[name], self._win32service.SERVICE_CONTROL_STOP)
+
+    def pid(self, name):
+        with self._lock:
+            return self._pids.get(name)
+
+    def kill(self, name):
+        pid = self.pid(name)
+        if pid:
+            os.kill(pid, signal.SIGTERM)
+        else:
+            os.system('TASKKILL /F /FI "services eq {name}"'.format(name=name))
+
+    def close(self):
+        try:
+            for handle in self.handles.values():
+                self._win32service.CloseServiceHandle(handle)
+            self._win32service.CloseServiceHandle(self.scm)
+        except Exception as e:
+            logging.info(e)
+
+
+class FakeServiceControlManager(ServiceControlManager):
+    """In memory Service Control Manager.
+
+    Started services go through STARTING for `start_ticks` status queries
+    before they are RUNNING.
+    """
+
+    def __init__(self, installed, start_ticks=0):
+        self._lock = threading.Lock()
+        self.states = {name: STOPPED for name in installed}
+        self.start_ticks = start_ticks
+        self._pending = {}
+        self.calls = []
+
+    def statuses(self, names):
+        with self._lock:
+            self.calls.append(('statuses', tuple(names)))
+            for name in list(self._pending):
+                self._pending[name] -= 1
+                if self._pending[name] <= 0:
+                    del self._pending[name]
+                    self.states[name] = RUNNING
+            return {name: self.states.get(name) for name in names}
+
+    def start(self, name):
+        with self._lock:
+            self.calls.append(('start', name))
+            if self.states[name] != STOPPED:
+                raise RuntimeError('service %s is already running' % name)
+            if self.start_ticks:
+                self.states[name] = STARTING
+                self._pending[name] = self.start_ticks
+            else:
+                self.states[name] = RUNNING
+
+    def stop(self, name):
+        with self._lock:
+            self.calls.append(('stop', name))
+            self._pending.pop(name, None)
+            self.states[name] = STOPPED
+
+    def kill(self, name):
+        with self._lock:
+            self.calls.append(('kill', name))
+            self._pending.pop(name, None)
+            self.states[name] = STOPPED
+
+
+class ServiceGroup(object):
+    """A group of services controlled together."""
+
+    def __init__(self, manager, names, wait_time=0.5, delay_time=10, workers=8):
+        """
+        manager: ServiceControlManager
+        names: names of the services of the group
+        wait_time: seconds between status queries while waiting
+        delay_time: seconds to wait for services to start
+        workers: number of concurrent start/stop requests
+        """
+        self.manager = manager
+        self.names = list(names)
+        self.wait_time = wait_time
+        self.delay_time = delay_time
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.status = {}
+
+    def refresh(self):
+        """Fetch the status of all the services in a single query."""
+        try:
+            self.status = self.manager.statuses(self.names)
+        except self.manager.errors as e:
+            logging.info(e)
+            self.status = dict.fromkeys(self.names)
+        return self.status
+
+    def stopped(self, names=None):
+        """Returns the services of the last refresh that are stopped."""
+        return [name for name in (names or self.names) if self.status.get(name) == STOPPED]
+
+    def running(self, names=None):
+        """Returns the services of the last refresh that are running."""
+        return [name for name in (names or self.names) if self.status.get(name) == RUNNING]
+
+    def pids(self, names=None):
+        """Returns the known process ids of the running services."""
+        return [pid for pid in (self.manager.pid(name) for name in self.running(names)) if pid]
+
+    def start(self, names):
+        """Start the services concurrently and wait for them to run.
+
+        :returns ``list``:
+            The services that are not running after delay_time.
+        """
+        names = list(names)
+        self._each(self.manager.start, names)
+        deadline = time.time() + self.delay_time
+        waiting = names
+        while waiting:
+            self.refresh()
+            for name in waiting:
+                if self.status.get(name) == RUNNING:
+                    logging.info('Start %s successfully.', name)
+            waiting = [name for name in waiting if self.status.get(name) == STARTING]
+            if not waiting or time.time() > deadline:
+                break
+            time.sleep(self.wait_time)
+        failed = [name for name in names if self.status.get(name) != RUNNING]
+        for name in failed:
+            logging.info('Start %s fail.', name)
+        return failed
+
+    def kill(self, names):
+        """Terminate the services concurrently."""
+        self._each(self.manager.kill, names)
+
+    def close(self):
+        """Free resources."""
+        self._executor.shutdown(wait=False)
+        self.manager.close()
+
+    def _each(self, request, names):
+        """Issue the request for all the services concurrently."""
+        futures = {name: self._executor.submit(request, name) for name in names}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.info('%s %s: %s', request.__name__, name, e)
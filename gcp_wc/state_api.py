@@ -0,0 +1,252 @@
+"""State API.
+
+Read-only view of the instances of the desktop, served as JSON on the
+metrics endpoint of the agent host (localhost only):
+
+    GET /instances?state=running&image=nginx&limit=100&after=<name>
+    GET /instance?name=<name>
+
+The view is an in-memory index kept by the reconciler as it changes the
+instances: nothing is read from the disk or asked of Docker to answer. An
+instance has one of the STATES, its container, a summary of its manifest,
+the time it was first seen and the time it entered its state, and its last
+app event. The instances are listed by name, a page at a time: "next" is
+the "after" of the next page. The removed instances are kept, the
+"instanceHistory" last ones, to tell how a short-lived instance ended.
+"""
+import json
+import time
+import bisect
+import threading
+import collections
+
+from gcp_wc import config
+from gcp_wc import metrics
+
+PLACED = 'placed'
+REMOVED = 'removed'
+
+# Lifecycle of an instance: placed, then the state of its container, then
+# removed.
+STATES = (PLACED, 'created', 'running', 'paused', 'exited', REMOVED)
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+JSON_TYPE = 'application/json'
+
+
+class InstanceState(object):
+    """Entry of the index."""
+
+    __slots__ = (
+        'name',
+        'state',
+        'container_id',
+        'manifest',
+        'created',
+        'since',
+        'event',
+    )
+
+    def __init__(self, name, now):
+        self.name = name
+        self.state = None
+        self.container_id = None
+        # Image, cpu, memory and service of the manifest.
+        self.manifest = None
+        self.created = now
+        self.since = now
+        # (type, data, time) of the last app event.
+        self.event = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'container_id': self.container_id,
+            'manifest': self.manifest,
+            'created': self.created,
+            'since': self.since,
+            'last_event': None if self.event is None else dict(
+                zip(('type', 'data', 'time'), self.event)),
+        }
+
+
+def summary(manifest_data):
+    """Returns the summary of a manifest kept in the index."""
+    services = manifest_data.get('services') or [{}]
+    return {
+        'image': manifest_data.get('image'),
+        'cpu': manifest_data.get('cpu'),
+        'memory': manifest_data.get('memory'),
+        'service': services[0].get('name'),
+    }
+
+
+class StateIndex(object):
+    """Instances by name, with their names by state and by image."""
+
+    def __init__(self, history=1000, clock=time.time):
+        """
+        history: removed instances kept
+        clock: returns the time in seconds
+        """
+        self.history = history
+        self.clock = clock
+        self._instances = {}
+        # Names in order, to page through.
+        self._names = []
+        self._by_state = collections.defaultdict(set)
+        self._by_image = collections.defaultdict(set)
+        self._removed = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(history=config.current().instanceHistory)
+
+    def update(self, name, manifest_data, container):
+        """Record the desired manifest and the container of an instance.
+
+        :param ``dict`` manifest_data:
+            Manifest to run, None if the instance is not desired.
+        :param ``ContainerSummary`` container:
+            Its container, None if none.
+        """
+        if container is not None:
+            state = container.state
+        elif manifest_data is not None:
+            state = PLACED
+        else:
+            state = REMOVED
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None:
+                if state == REMOVED:
+                    return
+                instance = self._add(name)
+            if manifest_data is not None:
+                self._set_manifest(instance, summary(manifest_data))
+            if container is not None:
+                instance.container_id = container.id
+            self._set_state(instance, state)
+
+    def event(self, name, event_type, event_data):
+        """Record an app event of an instance."""
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None:
+                instance = self._add(name)
+                self._set_state(instance, PLACED)
+            instance.event = (event_type, event_data, self.clock())
+            if event_type == 'configured':
+                instance.container_id = event_data
+
+    def get(self, name):
+        """Returns the dict of an instance, None if not indexed."""
+        with self._lock:
+            instance = self._instances.get(name)
+            return None if instance is None else instance.to_dict()
+
+    def query(self, states=(), image=None, after=None, limit=DEFAULT_LIMIT):
+        """Returns a page of the instances, in the order of their names.
+
+        :param ``list`` states:
+            States of the instances listed, all if empty.
+        :param ``str`` after:
+            Name after which the page starts.
+        :returns ``dict``:
+            The instances of the page, the number of instances matching and
+            the name to list the next page after, None on the last page.
+        """
+        with self._lock:
+            names = None
+            if states:
+                names = set()
+                for state in states:
+                    names |= self._by_state.get(state, set())
+            if image is not None:
+                by_image = self._by_image.get(image, set())
+                names = by_image if names is None else names & by_image
+            candidates = self._names if names is None else sorted(names)
+            start = 0 if after is None else bisect.bisect_right(candidates, after)
+            selected = candidates[start:start + limit]
+            page = [self._instances[name].to_dict() for name in selected]
+        return {
+            'instances': page,
+            'total': len(candidates),
+            'next': selected[-1] if start + limit < len(candidates) else None,
+        }
+
+    def counts(self):
+        """Returns the number of instances by state."""
+        with self._lock:
+            return dict((state, len(names)) for state, names in self._by_state.items() if names)
+
+    def _add(self, name):
+        instance = self._instances[name] = InstanceState(name, self.clock())
+        bisect.insort(self._names, name)
+        return instance
+
+    def _set_manifest(self, instance, manifest):
+        if instance.manifest is not None:
+            self._by_image[instance.manifest['image']].discard(instance.name)
+        instance.manifest = manifest
+        self._by_image[manifest['image']].add(instance.name)
+
+    def _set_state(self, instance, state):
+        if instance.state == state:
+            return
+        if instance.state is not None:
+            self._by_state[instance.state].discard(instance.name)
+        if instance.state == REMOVED:
+            del self._removed[instance.name]
+        instance.state = state
+        instance.since = self.clock()
+        self._by_state[state].add(instance.name)
+        if state == REMOVED:
+            self._removed[instance.name] = None
+            while len(self._removed) > self.history:
+                self._drop(self._removed.popitem(last=False)[0])
+
+    def _drop(self, name):
+        instance = self._instances.pop(name)
+        del self._names[bisect.bisect_left(self._names, name)]
+        self._by_state[instance.state].discard(name)
+        if instance.manifest is not None:
+            self._by_image[instance.manifest['image']].discard(name)
+
+
+def serve(index):
+    """Serve the index on the metrics endpoint of the process."""
+
+    def instances(query):
+        try:
+            limit = min(int(query.get('limit', [DEFAULT_LIMIT])[0]), MAX_LIMIT)
+        except ValueError:
+            return 400, JSON_TYPE, json.dumps({'error': 'limit is not a number'})
+        unknown = set(query.get('state', [])) - set(STATES)
+        if unknown or limit < 1:
+            return 400, JSON_TYPE, json.dumps({'error': 'state is one of %s, limit above 0' % (
+                ', '.join(STATES))})
+        page = index.query(
+            states=query.get('state', []),
+            image=query.get('image', [None])[0],
+            after=query.get('after', [None])[0],
+            limit=limit,
+        )
+        return 200, JSON_TYPE, json.dumps(page)
+
+    def instance(query):
+        name = query.get('name', [None])[0]
+        found = index.get(name) if name else None
+        if found is None:
+            return 404, JSON_TYPE, json.dumps({'error': 'no instance %s' % name})
+        return 200, JSON_TYPE, json.dumps(found)
+
+    metrics.route('/instances', instances)
+    metrics.route('/instance', instance)
+    gauge = metrics.gauge('gcp_wc_instances', 'Instances of the desktop, by state.', ('state',))
+    for state in STATES:
+        gauge.set_function(lambda state=state: index.counts().get(state, 0), state)
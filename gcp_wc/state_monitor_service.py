@@ -6,28 +6,30 @@ import os
 import abc
 import enum
 import time
-import yaml
 import glob
-import docker
 import socket
 import shutil
 import tempfile
 import functools
 import collections
-import logging.config
-from kazoo.client import KazooClient
+import logging
+
+from gcp_wc import config
+from gcp_wc import elasticity
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import loop
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import runtime
+from gcp_wc import zk_broker
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'stateMonitorSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+yaml = lazy.module('yaml')
 
 SERVERS = '/servers'
 SERVER_PRESENCE = '/server.presence'
@@ -49,7 +51,7 @@ class StateMonitorSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -57,6 +59,11 @@ class StateMonitorSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('stateMonitorSVC.txt')
+        config.watch()
+        loop.install(loop.EventActivity('stateMonitor', self.hWaitStop))
+        metrics.serve('stateMonitor', self.root)
+        profiler.control('stateMonitor', self.root)
         """Monitor the state of running containers
 
         running containers: get ids from ../running
@@ -67,139 +74,163 @@ class StateMonitorSvc (win32serviceutil.ServiceFramework):
         if finished, docker rm container and state change to deleted.
         """
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts = master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            client = docker.from_env()
-            while True:
-                running_containers = {}
-                running_apps = {
-                    os.path.basename(manifest)
-                    for manifest in glob.glob(os.path.join(os.path.join(self.root, RUNNING_DIR), '*'))
-                }
-                cleanup_apps = {
-                    os.path.basename(manifest)
-                    for manifest in glob.glob(os.path.join(os.path.join(self.root, CLEANUP_DIR), '*'))
-                }
-                for app in running_apps-cleanup_apps:
-                    with open(os.path.join(os.path.join(self.root, RUNNING_DIR), app)) as f:
-                        manifest_data = yaml.load(stream=f)
-                    running_containers[manifest_data['container_id']] = app
-
-                exited_containers = set()
-                for exited_container in client.containers.list(all, filters={"status": "exited"}):
-                    exited_containers.add(exited_container.id)
-
-                finished_containers = set()
-                for finished_container in client.containers.list(all, filters={"exited": "0"}):
-                    finished_containers.add(finished_container.id)
-
-                killed_containers = set()
-                for killed_container in client.containers.list(all, filters={"exited": "137"}):
-                    killed_containers.add(killed_container.id)
-
-                aborted_containers = {}
-                for exited_code in range(1, 256):
-                    if (exited_code != 137):
-                        for container in client.containers.list(all, filters={"exited": str(exited_code)}):
-                            aborted_containers[container.id] = exited_code
-
-                for container_id in running_containers:
-                    if container_id in exited_containers:
-                        instance_name = running_containers.get(container_id)
-                        if (os.path.exists(os.path.join(os.path.join(self.root, RUNNING_DIR), instance_name))):
-                            with open(os.path.join(os.path.join(self.root, RUNNING_DIR), instance_name)) as f:
-                                manifest_data = yaml.load(stream=f)
-
-                            # if container is normally finished
-                            if container_id in finished_containers:
-                                #create exited node
-                                logging.info("exited: %s", running_containers.get(container_id))
-                                post(
-                                    os.path.join(self.root, APP_EVENTS_DIR),
-                                    ServiceExitedTraceEvent(
-                                        instanceid=instance_name,
-                                        uniqueid=container_id,
-                                        service=manifest_data['services'][0]['name'],
-                                        rc='0',
-                                        signal='0'
-                                    )
-                                )
-                                # create finished node
-                                logging.info("finished: %s", running_containers.get(container_id))
-                                post(
-                                    os.path.join(self.root, APP_EVENTS_DIR),
-                                    FinishedTraceEvent(
-                                        instanceid=instance_name,
-                                        rc='0',
-                                        signal='0',
-                                        payload=''
-                                    )
-                                )
-                                zk.delete(path.scheduled(instance_name))
-                                if os.path.exists(os.path.join(os.path.join(self.root, RUNNING_DIR), running_containers.get(container_id))):
-                                    shutil.copy(os.path.join(os.path.join(self.root, RUNNING_DIR), running_containers.get(container_id)),
-                                                os.path.join(self.root, CLEANUP_DIR))
-                            # if container is killed
-                            elif container_id in killed_containers:
-                                # create exited node
-                                logging.info("exited: %s", running_containers.get(container_id))
-                                post(
-                                    os.path.join(self.root, APP_EVENTS_DIR),
-                                    ServiceExitedTraceEvent(
-                                        instanceid=instance_name,
-                                        uniqueid=container_id,
-                                        service=manifest_data['services'][0]['name'],
-                                        rc='137',
-                                        signal='137'
-                                    )
-                                )
-                                # create killed node
-                                logging.info("killed: %s", running_containers.get(container_id))
-                                post(
-                                    os.path.join(self.root, APP_EVENTS_DIR),
-                                    KilledTraceEvent(
-                                        instanceid=instance_name,
-                                        # is_oom=bool(exitinfo.get('oom')),
-                                        is_oom=False,
-                                    )
-                                )
-                                if os.path.exists(os.path.join(os.path.join(self.root, RUNNING_DIR), running_containers.get(container_id))):
-                                    shutil.copy(os.path.join(os.path.join(self.root, RUNNING_DIR), running_containers.get(container_id)),
-                                                os.path.join(self.root, CLEANUP_DIR))
-                            # if container is aborted
-                            else:
-                                # create exited node
-                                logging.info("exited: %s", running_containers.get(container_id))
-                                post(
-                                    os.path.join(self.root, APP_EVENTS_DIR),
-                                    ServiceExitedTraceEvent(
-                                        instanceid=instance_name,
-                                        uniqueid=container_id,
-                                        service=manifest_data['services'][0]['name'],
-                                        rc=str(aborted_containers.get(container_id)),
-                                        signal=str(aborted_containers.get(container_id))
-                                    )
-                                )
-                                # create aborted node
-                                logging.info("aborted: %s", running_containers.get(container_id))
-                                post(
-                                    os.path.join(self.root, APP_EVENTS_DIR),
-                                    AbortedTraceEvent(
-                                        why=str(aborted_containers.get(container_id)),
-                                        instanceid=instance_name,
-                                        payload=None
-                                    )
-                                )
-                                if os.path.exists(os.path.join(os.path.join(self.root, RUNNING_DIR), running_containers.get(container_id))):
-                                    shutil.copy(os.path.join(os.path.join(self.root, RUNNING_DIR), running_containers.get(container_id)),
-                                                os.path.join(self.root, CLEANUP_DIR))
-
-                if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
-                    break
+            client = runtime.DockerRuntime.from_env()
+            run(self.root, zk, client,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
+def run(root, zk, client, should_stop):
+    """Post the events of the running containers that exited.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    """
+    controller = elasticity.ElasticityController.from_env(client, root)
+    pace = loop.Loop('stateMonitor', should_stop)
+    while True:
+        worked = 0
+        running_containers = {}
+        elastic_containers = {}
+        running_apps = {
+            os.path.basename(manifest)
+            for manifest in glob.glob(os.path.join(os.path.join(root, RUNNING_DIR), '*'))
+        }
+        cleanup_apps = {
+            os.path.basename(manifest)
+            for manifest in glob.glob(os.path.join(os.path.join(root, CLEANUP_DIR), '*'))
+        }
+        for app in running_apps-cleanup_apps:
+            with open(os.path.join(os.path.join(root, RUNNING_DIR), app)) as f:
+                manifest_data = yaml.load(stream=f)
+            running_containers[manifest_data['container_id']] = app
+            limits = elasticity.elastic_limits(manifest_data)
+            if limits is not None:
+                elastic_containers[manifest_data['container_id']] = limits
+
+        # A single sparse listing gives the exit code of every exited
+        # container.
+        exited_containers = set()
+        finished_containers = set()
+        killed_containers = set()
+        aborted_containers = {}
+        for exited_container in client.containers(all=True, filters={"status": "exited"}):
+            exited_containers.add(exited_container.id)
+            if exited_container.exit_code == 0:
+                finished_containers.add(exited_container.id)
+            elif exited_container.exit_code == 137:
+                killed_containers.add(exited_container.id)
+            else:
+                aborted_containers[exited_container.id] = exited_container.exit_code
+
+        for container_id in running_containers:
+            if container_id in exited_containers:
+                worked += 1
+                instance_name = running_containers.get(container_id)
+                if (os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), instance_name))):
+                    with open(os.path.join(os.path.join(root, RUNNING_DIR), instance_name)) as f:
+                        manifest_data = yaml.load(stream=f)
+
+                    # if container is normally finished
+                    if container_id in finished_containers:
+                        #create exited node
+                        logging.info("exited: %s", running_containers.get(container_id))
+                        post(
+                            os.path.join(root, APP_EVENTS_DIR),
+                            ServiceExitedTraceEvent(
+                                instanceid=instance_name,
+                                uniqueid=container_id,
+                                service=manifest_data['services'][0]['name'],
+                                rc='0',
+                                signal='0'
+                            )
+                        )
+                        # create finished node
+                        logging.info("finished: %s", running_containers.get(container_id))
+                        post(
+                            os.path.join(root, APP_EVENTS_DIR),
+                            FinishedTraceEvent(
+                                instanceid=instance_name,
+                                rc='0',
+                                signal='0',
+                                payload=''
+                            )
+                        )
+                        zk.delete(path.scheduled(instance_name))
+                        if os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), running_containers.get(container_id))):
+                            shutil.copy(os.path.join(os.path.join(root, RUNNING_DIR), running_containers.get(container_id)),
+                                        os.path.join(root, CLEANUP_DIR))
+                    # if container is killed
+                    elif container_id in killed_containers:
+                        # create exited node
+                        logging.info("exited: %s", running_containers.get(container_id))
+                        post(
+                            os.path.join(root, APP_EVENTS_DIR),
+                            ServiceExitedTraceEvent(
+                                instanceid=instance_name,
+                                uniqueid=container_id,
+                                service=manifest_data['services'][0]['name'],
+                                rc='137',
+                                signal='137'
+                            )
+                        )
+                        # create killed node
+                        logging.info("killed: %s", running_containers.get(container_id))
+                        post(
+                            os.path.join(root, APP_EVENTS_DIR),
+                            KilledTraceEvent(
+                                instanceid=instance_name,
+                                # is_oom=bool(exitinfo.get('oom')),
+                                is_oom=False,
+                            )
+                        )
+                        if os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), running_containers.get(container_id))):
+                            shutil.copy(os.path.join(os.path.join(root, RUNNING_DIR), running_containers.get(container_id)),
+                                        os.path.join(root, CLEANUP_DIR))
+                    # if container is aborted
+                    else:
+                        # create exited node
+                        logging.info("exited: %s", running_containers.get(container_id))
+                        post(
+                            os.path.join(root, APP_EVENTS_DIR),
+                            ServiceExitedTraceEvent(
+                                instanceid=instance_name,
+                                uniqueid=container_id,
+                                service=manifest_data['services'][0]['name'],
+                                rc=str(aborted_containers.get(container_id)),
+                                signal=str(aborted_containers.get(container_id))
+                            )
+                        )
+                        # create aborted node
+                        logging.info("aborted: %s", running_containers.get(container_id))
+                        post(
+                            os.path.join(root, APP_EVENTS_DIR),
+                            AbortedTraceEvent(
+                                why=str(aborted_containers.get(container_id)),
+                                instanceid=instance_name,
+                                payload=None
+                            )
+                        )
+                        if os.path.exists(os.path.join(os.path.join(root, RUNNING_DIR), running_containers.get(container_id))):
+                            shutil.copy(os.path.join(os.path.join(root, RUNNING_DIR), running_containers.get(container_id)),
+                                        os.path.join(root, CLEANUP_DIR))
+
+        try:
+            controller.sample({
+                container_id: limits for container_id, limits in elastic_containers.items()
+                if container_id not in exited_containers
+            })
+        except Exception as e:
+            logging.info(e)
+
+        if pace.sleep(worked):
+            controller.close()
+            break
+
 def join_zookeeper_path(root, *child):
     """"Returns zookeeper path joined by slash."""
     return '/'.join((root,) + child)
@@ -2,25 +2,27 @@
 
 Update the resources of desktop periodly.
 """
-import os
 import socket
-import psutil
 import collections
 import functools
-import logging.config
-from kazoo.client import KazooClient
+import logging
+
+from gcp_wc import config
+from gcp_wc import container_stats
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import metrics
+from gcp_wc import node_data
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import runtime
+from gcp_wc import zk_broker
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'updateResourcesSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+psutil = lazy.module('psutil')
 
 SERVERS = '/servers'
 SERVER_PRESENCE = '/server.presence'
@@ -36,7 +38,7 @@ class UpdateResourcesSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -44,30 +46,75 @@ class UpdateResourcesSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
+        logs.setup('updateResourcesSVC.txt')
+        config.watch()
+        metrics.serve('updateResources', self.root)
+        profiler.control('updateResources', self.root)
         try:
-            master_hosts = os.getenv("zookeeper")
-            zk = KazooClient(hosts = master_hosts)
+            priority.PriorityManager.from_env().lower()
+            master_hosts = config.current().zookeeper
+            zk = zk_broker.zookeeper(master_hosts)
             zk.start()
-            node_data = zk.get(path.server('node'))
-            # For desktop, we add a 'windows' label, in order to schedule better later.
-            desktop_data = node_data[0].decode().replace('~', 'windows', 1)
-            while True:
-                # update info
-                remain_cpu, remain_mem, remain_disk = monitorResources()
-                update_info = 'cpu: {cpuinfo}%\ndisk: {diskinfo}M\nlabel: windows\nmemory: {meminfo}M\n'.format(
-                    cpuinfo=remain_cpu, diskinfo=remain_disk, meminfo=remain_mem)
-                desktop_data = update_info + desktop_data[desktop_data.find('parent'):]
-                if zk.exists(path.server(_HOSTNAME)):
-                    zk.set(path.server(_HOSTNAME), desktop_data.encode('utf-8'))
-                    logging.info("Update resources infomation %s", _HOSTNAME)
-                if zk.exists(path.server_presence(_HOSTNAME)):
-                    zk.set(path.server_presence(_HOSTNAME), desktop_data.encode('utf-8'))
-                    logging.info("Update resources infomation %s", _HOSTNAME)
-                if win32event.WaitForSingleObject(self.hWaitStop, int(os.getenv("updateResourcesInterval"))) == win32event.WAIT_OBJECT_0:
-                    break
+            client = runtime.DockerRuntime.from_env()
+            run(self.root, zk, client,
+                lambda timeout: win32event.WaitForSingleObject(self.hWaitStop, timeout) == win32event.WAIT_OBJECT_0)
         except:
             pass
 
+def run(root, zk, client, should_stop, hostname=None):
+    """Update the resources of the desktop periodly.
+
+    :param should_stop:
+        Called with a timeout in ms between iterations, returns True to stop.
+    :param hostname:
+        Name the desktop registers as, the name of the machine by default.
+    """
+    hostname = hostname or _HOSTNAME
+    collector = container_stats.StatsCollector(
+        client, root,
+        max_streams=config.current().statsMaxStreams
+    )
+    template = node_data.from_template(zk.get(path.server('node'))[0])
+    writer = node_data.NodeDataWriter(zk)
+    try:
+        while True:
+            # update info
+            collector.refresh()
+            free_cpu, free_mem, remain_disk = monitorResources()
+            # Publish what the agent's containers use, and the capacity
+            # left once the unused part of their reservations is withheld.
+            agent_usage = collector.usage()
+            remain_cpu, remain_mem = collector.remaining(free_cpu, free_mem)
+            publish(writer, template, hostname, {
+                'agent_cpu': agent_usage.cpu,
+                'agent_memory': agent_usage.memory,
+                'cpu': remain_cpu,
+                'disk': remain_disk,
+                'memory': remain_mem,
+            })
+            if should_stop(config.current().updateResourcesInterval):
+                break
+    finally:
+        collector.close()
+
+def publish(writer, template, hostname, resources):
+    """Write the template with the resources merged in to the server node
+    and the presence node of the desktop.
+
+    :param writer:
+        NodeDataWriter of the service
+    :param template:
+        NodeData of the server template
+    :param ``dict`` resources:
+        Resource name to amount
+    """
+    # The desktop is always labelled, whatever the template's label.
+    desktop_data = template.merge(resources=resources, label=node_data.DESKTOP_LABEL)
+    if writer.write(path.server(hostname), desktop_data):
+        logging.info("Update resources infomation %s", hostname)
+    if writer.write(path.server_presence(hostname), desktop_data):
+        logging.info("Update resources infomation %s", hostname)
+
 def monitorResources(interval=1.0):
     """Monitor windows desktop's resources useage
 
@@ -3,147 +3,29 @@
 Watch the state of service and the state of connection with zookeeper.
 """
 import os
-import time
 import glob
 import socket
-import datetime
-import logging.config
-from kazoo.client import KazooClient
+import logging
+
+from gcp_wc import config
+from gcp_wc import freeze
+from gcp_wc import lazy
+from gcp_wc import logs
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import recording
+from gcp_wc import runtime
+from gcp_wc.screen_state import ScreenState
+from gcp_wc import evacuation
+from gcp_wc import service_control
+from gcp_wc import zk_cache
 
 import win32serviceutil
 import win32service
 import win32event
 
-#logging
-logging.basicConfig(filename = os.path.join(os.path.join(os.getenv("workDirectory"),'log'), 'WatchdogSVC.txt'), filemode="w", level=logging.INFO)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('# %(asctime)s - %(name)s:%(lineno)d %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
-
-class ServiceManager(object):
-    """Manage Windows service"""
-
-    def __init__(self, name):
-        """
-        name: service name
-        """
-        self.name = name
-
-        self.wait_time = 0.5
-        self.delay_time = 10
-        self.scm = win32service.OpenSCManager(None, None, win32service.SC_MANAGER_ALL_ACCESS)
-
-        if self.is_exists():
-            try:
-                self.handle = win32service.OpenService(self.scm, self.name, win32service.SC_MANAGER_ALL_ACCESS)
-            except Exception as e:
-                logging.info(e)
-        else:
-            logging.info('service %s is not installed.', self.name)
-
-    def is_stop(self):
-        """Check service whether stop"""
-        flag = False
-        try:
-            if self.handle:
-                ret = win32service.QueryServiceStatus(self.handle)
-                flag = ret[1] != win32service.SERVICE_RUNNING
-        except Exception as e:
-            logging.info(e)
-        return flag
-
-    def start(self):
-        """Start service"""
-        try:
-            if self.handle:
-                win32service.StartService(self.handle, None)
-        except Exception as e:
-            logging.info(e)
-        status_info = win32service.QueryServiceStatus(self.handle)
-
-        if status_info[1] == win32service.SERVICE_RUNNING:
-            logging.info('Start %s successfully.', self.name)
-            return 'Start %s successfully.'% (self.name)
-        elif status_info[1] == win32service.SERVICE_START_PENDING:
-            start_time = datetime.datetime.now()
-            while True:
-                if (datetime.datetime.now() - start_time).seconds > self.delay_time:
-                    logging.info('Start %s too much time.', self.name)
-                    return 'Start %s too much time.' % (self.name)
-
-                time.sleep(self.wait_time)
-                if win32service.QueryServiceStatus(self.handle)[1] == win32service.SERVICE_RUNNING:
-                    logging.info('Start %s successfully.', self.name)
-                    return 'Start %s successfully.' % (self.name)
-        else:
-            logging.info('Start %s fail.', self.name)
-            return 'Start %s fail.' % (self.name)
-
-    def stop(self):
-        """Stop service"""
-        try:
-            status_info = win32service.ControlService(self.handle, win32service.SERVICE_CONTROL_STOP)
-        except Exception as e:
-            logging.info(e)
-        if status_info[1] == win32service.SERVICE_STOPPED:
-            logging.info('Stop %s successfully.', self.name)
-            return 'Stop %s successfully.'% (self.name)
-        elif status_info[1] == win32service.SERVICE_STOP_PENDING:
-            start_time = datetime.datetime.now()
-            while True:
-                if (datetime.datetime.now() - start_time).seconds > self.delay_time:
-                    logging.info('Stop %s too much time.', self.name)
-                    return 'Stop %s too much time.' % (self.name)
-
-                time.sleep(self.wait_time)
-                if win32service.QueryServiceStatus(self.handle)[1] == win32service.SERVICE_STOPPED:
-                    logging.info('Stop %s successfully.', self.name)
-                    return 'Stop %s successfully.' % (self.name)
-        else:
-            logging.info('Stop %s fail.', self.name)
-            return 'Stop %s fail.' % (self.name)
-
-    def restart(self):
-        """Restart service"""
-        if not self.is_stop():
-            self.stop()
-        self.start()
-        return win32service.QueryServiceStatus(self.handle)
-
-    def status(self):
-        """Get the state of service"""
-        try:
-            status_info = win32service.QueryServiceStatus(self.handle)
-            status = status_info[1]
-            if status == win32service.SERVICE_STOPPED:
-                return "STOPPED"
-            elif status == win32service.SERVICE_START_PENDING:
-                return "STARTING"
-            elif status == win32service.SERVICE_STOP_PENDING:
-                return "STOPPING"
-            elif status == win32service.SERVICE_RUNNING:
-                return "RUNNING"
-        except Exception as e:
-            logging.info(e)
-
-    def close(self):
-        """Free resources"""
-        try:
-            if self.scm:
-                win32service.CloseServiceHandle(self.handle)
-                win32service.CloseServiceHandle(self.scm)
-        except Exception as e:
-            logging.info(e)
-
-    def is_exists(self):
-        """Check service whether installed"""
-        statuses = win32service.EnumServicesStatus(self.scm, win32service.SERVICE_WIN32, win32service.SERVICE_STATE_ALL)
-        for (short_name, desc, status) in statuses:
-            if short_name == self.name:
-                return True
-        return False
+kazoo_client = lazy.module('kazoo.client')
 
 SERVER_PRESENCE = '/server.presence'
 PLACEMENT = '/placement'
@@ -159,6 +41,21 @@ _SCREENMONITOR = 'ScreenMonitorService'
 _REGISTERZOOKEEPER = 'RegisterZookeeperService'
 _STATEMONITOR = 'StateMonitorService'
 _UPDATERESOURCES = 'UpdateResourcesService'
+_AGENTHOST = 'AgentHostService'
+_ZKBROKER = 'ZkBrokerService'
+
+SERVICES = [
+    _APPCFGMGR,
+    _APPEVENTS,
+    _CLEANUP,
+    _EVENTDAEMON,
+    _REGISTERZOOKEEPER,
+    _STATEMONITOR,
+    _UPDATERESOURCES,
+    _SCREENMONITOR,
+]
+# Services left running when the others are stopped.
+_KEEP_RUNNING = (_SCREENMONITOR, _CLEANUP, _APPCFGMGR, _AGENTHOST, _ZKBROKER)
 
 RUNNING_DIR = 'running'
 CLEANUP_DIR = 'cleanup'
@@ -173,7 +70,7 @@ class WatchdogSvc (win32serviceutil.ServiceFramework):
     def __init__(self,args):
         win32serviceutil.ServiceFramework.__init__(self,args)
         self.hWaitStop = win32event.CreateEvent(None,0,0,None)
-        self.root = os.getenv("workDirectory")
+        self.root = config.current().workDirectory
         socket.setdefaulttimeout(60)
 
     def SvcStop(self):
@@ -181,35 +78,61 @@ class WatchdogSvc (win32serviceutil.ServiceFramework):
         win32event.SetEvent(self.hWaitStop)
 
     def SvcDoRun(self):
-        master_hosts = os.getenv("zookeeper")
-        zk = KazooClient(hosts=master_hosts)
+        logs.setup('WatchdogSVC.txt')
+        config.watch()
+        metrics.serve('watchdog', self.root)
+        profiler.control('watchdog', self.root)
+        master_hosts = config.current().zookeeper
+        zk = recording.zookeeper(metrics.zookeeper(kazoo_client.KazooClient(hosts=master_hosts)))
         zk.start()
-
-        services = []
-        app_cfg = ServiceManager(_APPCFGMGR)
-        services.append(app_cfg)
-        app_events = ServiceManager(_APPEVENTS)
-        services.append(app_events)
-        clean_up = ServiceManager(_CLEANUP)
-        services.append(clean_up)
-        event_daemon = ServiceManager(_EVENTDAEMON)
-        services.append(event_daemon)
-        register_zk = ServiceManager(_REGISTERZOOKEEPER)
-        services.append(register_zk)
-        state_monitor = ServiceManager(_STATEMONITOR)
-        services.append(state_monitor)
-        update_resources = ServiceManager(_UPDATERESOURCES)
-        services.append(update_resources)
-        screen_monitor = ServiceManager(_SCREENMONITOR)
-        services.append(screen_monitor)
-
+        # Serve the placement from memory, for the unlock to be quick.
+        zk = zk_cache.mirror(zk, _HOSTNAME, 'watchdog')
+        client = runtime.DockerRuntime.from_env()
+
+        settings = config.current()
+        names = agent_services()
+        services = service_control.ServiceGroup(
+            service_control.Win32ServiceControlManager(names), names,
+            workers=settings.serviceControlWorkers)
+        services.refresh()
         self._start(services)
+        # Opt-in: pause the containers on unlock rather than revoking them.
+        freezer = None
+        if settings.freezePolicy:
+            freezer = freeze.FreezeManager(
+                client, self.root,
+                grace_period=settings.freezeGracePeriod,
+                workers=settings.freezeWorkers,
+            )
+        serving = freeze.ServingTimer()
+        screen = ScreenState.from_env(self.root)
+        priorities = priority.PriorityManager.from_env(root=self.root)
+        previous_screen_state = None
+        evacuated = False
         previous_state = zk.state
         flag = True
         while True:
-            f = open(os.path.join(self.root, screen_state_file), 'r')
-            screen_state = f.read()
+            # Fetch the status of all the services once per tick.
+            services.refresh()
+            screen_state = screen.read()
+            # Throttle the agent as soon as the user is active, before the
+            # unlock fires.
+            level = priorities.target()
+            if level != priorities.level:
+                priorities.apply(level,
+                                 services.pids([name for name in names if name != _SCREENMONITOR]),
+                                 client, freeze.running_containers(self.root))
             if screen_state == 'Lock':
+                evacuated = False
+                if previous_screen_state != 'Lock':
+                    if freezer is not None and freezer.is_frozen():
+                        serving.locked('resume')
+                        freezer.thaw()
+                        serving.serving()
+                    else:
+                        serving.locked('reschedule')
+                elif serving.locked_at is not None and glob.glob(os.path.join(os.path.join(self.root, RUNNING_DIR), '*')):
+                    serving.serving()
                 try:
                     if zk.state == 'CONNECTED':
                         if flag:
@@ -233,56 +156,72 @@ class WatchdogSvc (win32serviceutil.ServiceFramework):
                             pass
                 except:
                     pass
+            elif (freezer is not None and not evacuated and not freezer.expired() and
+                  (freezer.is_frozen() or freezer.freeze(zk, _HOSTNAME))):
+                # Frozen within the grace period, the placements are kept.
+                flag = True
             else:
                 flag = True
-                apps = zk.get_children('/placement'+'/'+_HOSTNAME)
-                for app in apps:
-                    if zk.exists('/placement'+'/'+_HOSTNAME+'/'+app):
-                        try:
-                            zk.delete('/placement'+'/'+_HOSTNAME+'/'+app)
-                        except:
-                            pass
-                for i in range(2):
-                    if zk.exists(server_presence()):
-                        zk.delete(server_presence())
-                    time.sleep(2)
-                time.sleep(5)
-                self._stop(services)
+                if freezer is not None and freezer.is_frozen():
+                    # Grace period is over, resume the containers to revoke them.
+                    freezer.thaw()
+                try:
+                    evacuation.evacuate(
+                        zk, client, self.root, _HOSTNAME,
+                        stop_services=lambda: self._stop(services),
+                        deadline=config.current().evacuationDeadline / 1000.0,
+                        workers=config.current().evacuationWorkers,
+                    )
+                except Exception as e:
+                    logging.info('Evacuation failed: %s', e)
+                    self._stop(services)
+                evacuated = True
                 try:
                     zk.start()
                 except:
                     pass
 
+            previous_screen_state = screen_state
             previous_state = zk.state
-            if win32event.WaitForSingleObject(self.hWaitStop, 2000) == win32event.WAIT_OBJECT_0:
+            if win32event.WaitForSingleObject(self.hWaitStop, config.current().watchdogInterval) == win32event.WAIT_OBJECT_0:
+                services.close()
+                zk_cache.close(zk)
                 break
 
 
     def _start(self, services):
-        for service in services:
-            if service.status() == 'STOPPED':
-                service.start()
+        stopped = services.stopped()
+        if stopped:
+            services.start(stopped)
 
     def _stop(self, services):
-        for service in services:
-            if service.status() == 'RUNNING':
-                if service.name == 'ScreenMonitorService' or service.name == 'CleanupService' or service.name == 'AppCfgMgrService':
-                    #os.system('TASKKILL /F /FI "services eq ScreenMonitorService"')
-                    pass
-                else:
-                    os.system('TASKKILL /F /FI "services eq {name}"'.format(name=service.name))
+        services.kill([name for name in services.running() if name not in _KEEP_RUNNING])
 
     def _serviceStatus(self, services):
-        for service in services:
-            if service.status() == 'STOPPED':
-                if service.name == 'AppCfgMgrService':
-                    logging.info('failed service: ' + str(service.name))
-                    service.start()
-                else:
-                    logging.info('failed service: '+str(service.name))
-                    return False
+        stopped = services.stopped()
+        if _APPCFGMGR in stopped:
+            logging.info('failed service: ' + str(_APPCFGMGR))
+            services.start([_APPCFGMGR])
+        for name in stopped:
+            if name != _APPCFGMGR:
+                logging.info('failed service: '+str(name))
+                return False
         return True
 
+def agent_services():
+    """Returns the services supervised by the watchdog.
+
+    With "agentHost" set to "1" the agent services run as workers of the
+    AgentHostService. With "zkBroker" set to "1" they share the session of
+    the ZkBrokerService.
+    """
+    settings = config.current()
+    if settings.agentHost:
+        return [_AGENTHOST, _SCREENMONITOR]
+    if settings.zkBroker:
+        return [_ZKBROKER] + SERVICES
+    return SERVICES
+
 def server_presence():
     return SERVER_PRESENCE+'/'+_HOSTNAME
 
@@ -291,5 +230,4 @@ def server_placement():
 
 
 if __name__ == '__main__':
-    win32serviceutil.HandleCommandLine(WatchdogSvc)
-    #app = ServiceManager('AppeventService')
\ No newline at end of file
+    win32serviceutil.HandleCommandLine(WatchdogSvc)
\ No newline at end of file
@@ -0,0 +1,708 @@
+"""Zookeeper Broker Service.
+
+Own the single Zookeeper session of the desktop on behalf of the agent
+services, which talk to it over a local socket instead of each holding a
+session and a heartbeat stream of its own.
+
+The protocol is one JSON document per line. Requests carry an id, the broker
+answers each with the same id:
+
+    {"id": 1, "op": "get", "args": {"path": "/servers/node"}}
+    {"id": 1, "result": [<data>, <stat>]}
+    {"id": 2, "error": "NoNodeError", "message": "..."}
+
+Node data is base64 encoded, stats are dicts of the ZnodeStat fields.
+Watches are shared: one data or children watch per path on the session,
+fanned out to every subscriber, and the session state changes are passed
+through to all the connections:
+
+    {"event": "data", "watch": 3, "data": <data>, "stat": <stat>, "type": "CHANGED"}
+    {"event": "children", "watch": 4, "children": [...]}
+    {"event": "state", "state": "SUSPENDED"}
+
+Ephemeral nodes belong to the connection that created them, and are deleted
+when it closes.
+
+The services use the broker when the "zkBroker" setting is "1". BrokerClient has the KazooClient methods the agent uses.
+
+Usage:
+    python -m gcp_wc.zk_broker --fake [--port P]
+
+serves an in memory Zookeeper, to run the agent without an ensemble.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+from kazoo import exceptions
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+from gcp_wc import config
+from gcp_wc import lazy
+from gcp_wc import metrics
+from gcp_wc import recording
+from gcp_wc.fake_zookeeper import call_data_watch
+
+kazoo_client = lazy.module('kazoo.client')
+kazoo_threading = lazy.module('kazoo.handlers.threading')
+
+DEFAULT_PORT = 2182
+# Seconds for a request to be answered.
+DEFAULT_TIMEOUT = 30
+# Seconds between attempts to reach the broker.
+RECONNECT_DELAY = 1
+
+
+def zookeeper(hosts):
+    """Returns the Zookeeper client of a service, started by the caller.
+
+    The broker's when the "zkBroker" setting is "1".
+    """
+    settings = config.current()
+    if settings.zkBroker:
+        return recording.zookeeper(metrics.zookeeper(BrokerClient(port=settings.zkBrokerPort)))
+    return recording.zookeeper(metrics.zookeeper(kazoo_client.KazooClient(hosts=hosts)))
+
+
+def _encode_data(data):
+    if data is None:
+        return None
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode_data(data):
+    if data is None:
+        return None
+    return base64.b64decode(data)
+
+
+def _encode_stat(stat):
+    if stat is None:
+        return None
+    return dict(zip(ZnodeStat._fields, stat))
+
+
+def _decode_stat(stat):
+    if stat is None:
+        return None
+    return ZnodeStat(**stat)
+
+
+def _error(name, message=''):
+    """Returns the kazoo exception named name."""
+    cls = getattr(exceptions, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        cls = exceptions.KazooException
+    return cls(message)
+
+
+class _Subscription(object):
+    """A watch of the session, shared by its subscribers."""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.last = None
+
+
+class _Server(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    # On Windows the option lets another process bind the port.
+    allow_reuse_address = os.name != 'nt'
+
+
+class Broker(object):
+    """Serve the requests of the local connections on one session."""
+
+    def __init__(self, zk, host='127.0.0.1', port=DEFAULT_PORT):
+        """
+        zk: Zookeeper client, started
+        host, port: address to listen on
+        """
+        self.zk = zk
+        self._lock = threading.RLock()
+        self._watches = {}
+        self._connections = set()
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                connection = _Connection(broker, self.request)
+                broker._serve(connection, self.rfile)
+
+        self.server = _Server((host, port), Handler)
+        self.address = self.server.server_address
+        zk.add_listener(self._state_listener)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name='ZkBroker')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+
+    def _serve(self, connection, rfile):
+        with self._lock:
+            self._connections.add(connection)
+        connection.send({'event': 'state', 'state': self.zk.state})
+        try:
+            for line in rfile:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logging.info('Bad request: %r', line)
+                    continue
+                self._handle(connection, request)
+        except (IOError, OSError):
+            pass
+        finally:
+            self._disconnect(connection)
+
+    def _handle(self, connection, request):
+        response = {'id': request.get('id')}
+        try:
+            handler = getattr(self, '_op_' + request['op'])
+            response['result'] = handler(connection, **request.get('args', {}))
+        except exceptions.KazooException as e:
+            response['error'] = type(e).__name__
+            response['message'] = str(e)
+        except Exception as e:
+            logging.info('Request %r failed: %s', request, e)
+            response['error'] = 'KazooException'
+            response['message'] = str(e)
+        connection.send(response)
+
+    def _op_exists(self, connection, path):
+        return _encode_stat(self.zk.exists(path))
+
+    def _op_get(self, connection, path):
+        data, stat = self.zk.get(path)
+        return [_encode_data(data), _encode_stat(stat)]
+
+    def _op_get_children(self, connection, path):
+        return self.zk.get_children(path)
+
+    def _op_create(self, connection, path, value=None, ephemeral=False,
+                   sequence=False, makepath=False):
+        created = self.zk.create(path, _decode_data(value) or b'', ephemeral=ephemeral,
+                                 sequence=sequence, makepath=makepath)
+        if ephemeral:
+            connection.ephemerals.add(created)
+        return created
+
+    def _op_ensure_path(self, connection, path):
+        return self.zk.ensure_path(path)
+
+    def _op_set(self, connection, path, value, version=-1):
+        return _encode_stat(self.zk.set(path, _decode_data(value), version=version))
+
+    def _op_delete(self, connection, path, version=-1, recursive=False):
+        connection.ephemerals.discard(path)
+        return self.zk.delete(path, version=version, recursive=recursive)
+
+    def _op_transaction(self, connection, operations):
+        transaction = self.zk.transaction()
+        for operation, kwargs in operations:
+            if 'value' in kwargs:
+                kwargs['value'] = _decode_data(kwargs['value']) or b''
+            getattr(transaction, operation)(**kwargs)
+        results = []
+        for (operation, kwargs), result in zip(operations, transaction.commit()):
+            if isinstance(result, Exception):
+                results.append({'error': type(result).__name__, 'message': str(result)})
+                continue
+            if operation == 'create' and kwargs.get('ephemeral'):
+                connection.ephemerals.add(result)
+            elif operation == 'delete':
+                connection.ephemerals.discard(kwargs['path'])
+            if isinstance(result, tuple):
+                result = _encode_stat(result)
+            results.append({'result': result})
+        return results
+
+    def _op_watch(self, connection, kind, path, watch):
+        """Subscribe to the data or children of path."""
+        key = (kind, path)
+        with self._lock:
+            subscription = self._watches.get(key)
+            if subscription is None:
+                subscription = self._watches[key] = _Subscription()
+                subscription.subscribers.add((connection, watch))
+                if kind == 'data':
+                    self.zk.DataWatch(path)(self._data_watcher(key, subscription))
+                else:
+                    if not self.zk.exists(path):
+                        del self._watches[key]
+                        raise exceptions.NoNodeError(path)
+                    self.zk.ChildrenWatch(path)(self._children_watcher(key, subscription))
+                    # A children watch stops with its node, forget it then.
+                    self.zk.DataWatch(path)(self._deleted_watcher(key, subscription))
+            else:
+                subscription.subscribers.add((connection, watch))
+                if subscription.last is not None:
+                    connection.send(dict(subscription.last, watch=watch, type=None))
+        return watch
+
+    def _op_unwatch(self, connection, kind, path, watch):
+        with self._lock:
+            subscription = self._watches.get((kind, path))
+            if subscription is not None:
+                subscription.subscribers.discard((connection, watch))
+        return True
+
+    def _data_watcher(self, key, subscription):
+        def watcher(data, stat, event=None):
+            message = {
+                'event': 'data', 'data': _encode_data(data), 'stat': _encode_stat(stat),
+                'type': event.type if event is not None else None,
+            }
+            return self._fan_out(key, subscription, message)
+        return watcher
+
+    def _children_watcher(self, key, subscription):
+        def watcher(children):
+            return self._fan_out(key, subscription, {'event': 'children', 'children': children})
+        return watcher
+
+    def _deleted_watcher(self, key, subscription):
+        def watcher(data, stat):
+            with self._lock:
+                if self._watches.get(key) is not subscription:
+                    return False
+                if stat is None:
+                    del self._watches[key]
+                    return False
+            return None
+        return watcher
+
+    def _fan_out(self, key, subscription, event):
+        with self._lock:
+            if not subscription.subscribers:
+                # The last subscriber left, drop the watch of the session.
+                if self._watches.get(key) is subscription:
+                    del self._watches[key]
+                return False
+            subscription.last = event
+            subscribers = list(subscription.subscribers)
+        for connection, watch in subscribers:
+            connection.send(dict(event, watch=watch))
+        return None
+
+    def _state_listener(self, state):
+        logging.info('Zookeeper session %s', state)
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.send({'event': 'state', 'state': state})
+
+    def _disconnect(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+            for subscription in self._watches.values():
+                subscription.subscribers = {
+                    (owner, watch) for (owner, watch) in subscription.subscribers
+                    if owner is not connection
+                }
+        for path in connection.ephemerals:
+            try:
+                self.zk.delete(path)
+            except exceptions.NoNodeError:
+                pass
+            except Exception as e:
+                logging.info('Cannot delete %s: %s', path, e)
+        connection.close()
+
+
+class _Connection(object):
+    """A local connection to the broker."""
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.ephemerals = set()
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        line = (json.dumps(message) + '\n').encode('utf-8')
+        try:
+            with self._lock:
+                self.sock.sendall(line)
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+        except (IOError, OSError):
+            pass
+
+
+class BrokerClient(object):
+    """Zookeeper client talking to the broker, with a KazooClient interface.
+
+    The connection to the broker is reestablished in the background after it
+    is lost, the watches are then subscribed again.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.handler = kazoo_threading.SequentialThreadingHandler()
+        self.state = KazooState.LOST
+        self._sock = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._watches = {}
+        self._listeners = []
+        self._events = []
+        self._events_ready = threading.Condition()
+        self._state_known = threading.Event()
+        self._stopped = True
+
+    @property
+    def connected(self):
+        return self.state == KazooState.CONNECTED
+
+    def start(self, timeout=15):
+        """Connect to the broker, waiting up to timeout seconds."""
+        self._stopped = False
+        self._state_known.clear()
+        thread = threading.Thread(target=self._dispatch, name='BrokerEvents')
+        thread.daemon = True
+        thread.start()
+        deadline = time.time() + timeout
+        while not self._connect():
+            if time.time() > deadline:
+                self.stop()
+                raise exceptions.ConnectionLoss('Cannot reach the broker')
+            time.sleep(RECONNECT_DELAY / 2.0)
+        # The broker sends the session state first.
+        self._state_known.wait(max(deadline - time.time(), 0))
+
+    def stop(self):
+        self._stopped = True
+        self._close()
+        with self._events_ready:
+            self._events_ready.notify()
+
+    def close(self):
+        pass
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def exists(self, path, watch=None):
+        return _decode_stat(self._call('exists', path=path))
+
+    def get(self, path, watch=None):
+        data, stat = self._call('get', path=path)
+        return _decode_data(data), _decode_stat(stat)
+
+    def get_children(self, path, watch=None):
+        return self._call('get_children', path=path)
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        return self._call('create', path=path, value=_encode_data(value),
+                          ephemeral=ephemeral, sequence=sequence, makepath=makepath)
+
+    def ensure_path(self, path, acl=None):
+        return self._call('ensure_path', path=path)
+
+    def set(self, path, value, version=-1):
+        return _decode_stat(self._call('set', path=path, value=_encode_data(value),
+                                       version=version))
+
+    def delete(self, path, version=-1, recursive=False):
+        return self._call('delete', path=path, version=version, recursive=recursive)
+
+    def transaction(self):
+        return BrokerTransaction(self)
+
+    def DataWatch(self, path, func=None):
+        """Call func(data, stat[, event]) now and on each change of the node."""
+        return self._watch('data', path, func)
+
+    def ChildrenWatch(self, path, func=None):
+        """Call func(children) now and on each change of the children."""
+        return self._watch('children', path, func)
+
+    def _watch(self, kind, path, func):
+        def register(func):
+            with self._lock:
+                self._next_id += 1
+                watch = self._next_id
+                self._watches[watch] = (kind, path, func)
+            try:
+                self._call('watch', kind=kind, path=path, watch=watch)
+            except Exception:
+                with self._lock:
+                    self._watches.pop(watch, None)
+                raise
+            return func
+        if func is None:
+            return register
+        return register(func)
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+        except (IOError, OSError):
+            return False
+        sock.settimeout(None)
+        with self._lock:
+            self._sock = sock
+        thread = threading.Thread(target=self._read, args=(sock,), name='BrokerReader')
+        thread.daemon = True
+        thread.start()
+        with self._lock:
+            watches = list(self._watches.items())
+        for watch, (kind, path, _func) in watches:
+            try:
+                self._call('watch', kind=kind, path=path, watch=watch)
+            except Exception as e:
+                logging.info('Cannot watch %s: %s', path, e)
+        return True
+
+    def _close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except (IOError, OSError):
+                pass
+
+    def _call(self, op, **args):
+        with self._lock:
+            sock = self._sock
+            self._next_id += 1
+            request_id = self._next_id
+            waiter = self._pending[request_id] = [threading.Event(), None]
+        try:
+            if sock is None:
+                raise exceptions.ConnectionLoss('Not connected to the broker')
+            line = (json.dumps({'id': request_id, 'op': op, 'args': args}) + '\n').encode('utf-8')
+            try:
+                with self._send_lock:
+                    sock.sendall(line)
+            except (IOError, OSError) as e:
+                raise exceptions.ConnectionLoss(str(e))
+            if not waiter[0].wait(self.timeout):
+                raise exceptions.OperationTimeoutError(op)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+        response = waiter[1]
+        if response is None:
+            raise exceptions.ConnectionLoss('Connection to the broker lost')
+        if 'error' in response:
+            raise _error(response['error'], response.get('message', ''))
+        return response['result']
+
+    def _read(self, sock):
+        rfile = sock.makefile('rb')
+        try:
+            for line in rfile:
+                message = json.loads(line.decode('utf-8'))
+                if message.get('event') == 'state':
+                    self._set_state(message['state'])
+                    continue
+                if 'event' in message:
+                    self._queue(message)
+                    continue
+                with self._lock:
+                    waiter = self._pending.get(message.get('id'))
+                if waiter is not None:
+                    waiter[1] = message
+                    waiter[0].set()
+        except (IOError, OSError, ValueError):
+            pass
+        # Fail the pending requests, the broker deletes our ephemeral nodes.
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending = list(self._pending.values())
+        for waiter in pending:
+            waiter[0].set()
+        self._set_state(KazooState.LOST)
+        if not self._stopped:
+            thread = threading.Thread(target=self._reconnect, name='BrokerReconnect')
+            thread.daemon = True
+            thread.start()
+
+    def _reconnect(self):
+        while not self._stopped and not self._connect():
+            time.sleep(RECONNECT_DELAY)
+
+    def _set_state(self, state):
+        self._state_known.set()
+        if state == self.state:
+            return
+        self.state = state
+        self._queue({'event': 'state', 'state': state})
+
+    def _queue(self, event):
+        with self._events_ready:
+            self._events.append(event)
+            self._events_ready.notify()
+
+    def _dispatch(self):
+        """Call the listeners and watches, off the reader thread."""
+        while True:
+            with self._events_ready:
+                while not self._events and not self._stopped:
+                    self._events_ready.wait()
+                if self._stopped:
+                    return
+                event = self._events.pop(0)
+            try:
+                self._deliver(event)
+            except Exception:
+                logging.exception('Event %r failed', event)
+
+    def _deliver(self, event):
+        if event['event'] == 'state':
+            for listener in list(self._listeners):
+                listener(event['state'])
+            return
+        with self._lock:
+            kind, path, func = self._watches.get(event['watch'], (None, None, None))
+        if func is None:
+            return
+        if kind == 'data':
+            watched = None
+            if event.get('type') is not None:
+                watched = WatchedEvent(event['type'], self.state, path)
+            result = call_data_watch(func, _decode_data(event['data']),
+                                     _decode_stat(event['stat']), watched)
+        else:
+            result = func(event['children'])
+        if result is False:
+            with self._lock:
+                self._watches.pop(event['watch'], None)
+            try:
+                self._call('unwatch', kind=kind, path=path, watch=event['watch'])
+            except Exception as e:
+                logging.info('Cannot unwatch %s: %s', path, e)
+
+
+class BrokerTransaction(object):
+    """Operations committed atomically by the broker."""
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.committed = False
+
+    def create(self, path, value=b'', acl=None, ephemeral=False, sequence=False):
+        self.operations.append(('create', {
+            'path': path, 'value': _encode_data(value),
+            'ephemeral': ephemeral, 'sequence': sequence,
+        }))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', {'path': path, 'version': version}))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set_data', {
+            'path': path, 'value': _encode_data(value), 'version': version,
+        }))
+
+    def check(self, path, version):
+        self.operations.append(('check', {'path': path, 'version': version}))
+
+    def commit(self):
+        """Returns the results of the operations, exceptions if it failed."""
+        self.committed = True
+        results = []
+        for result in self.client._call('transaction', operations=self.operations):
+            if 'error' in result:
+                results.append(_error(result['error'], result.get('message', '')))
+            elif isinstance(result['result'], dict):
+                results.append(_decode_stat(result['result']))
+            else:
+                results.append(result['result'])
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not exc_type:
+            self.commit()
+
+
+def broker_session(hosts):
+    """Returns the session of the broker: retried, with timeouts."""
+    return metrics.zookeeper(kazoo_client.KazooClient(
+        hosts=hosts,
+        timeout=config.current().zkSessionTimeout / 1000.0,
+        connection_retry={'max_tries': -1, 'delay': 0.5, 'backoff': 2, 'max_delay': 30},
+        command_retry={'max_tries': 3, 'delay': 0.1, 'backoff': 2, 'max_delay': 5},
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zookeeper broker.')
+    parser.add_argument('--fake', action='store_true',
+                        help='serve an in memory Zookeeper')
+    settings = config.current()
+    parser.add_argument('--hosts', default=settings.zookeeper)
+    parser.add_argument('--port', type=int, default=settings.zkBrokerPort)
+    args = parser.parse_args()
+
+    if args.fake:
+        from gcp_wc.fake_zookeeper import FakeZooKeeper
+        zk = FakeZooKeeper()
+    else:
+        zk = broker_session(args.hosts)
+    zk.start()
+    broker = Broker(zk, port=args.port)
+    logging.info('Serving %s on %s:%s', 'fake' if args.fake else args.hosts, *broker.address)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        broker.shutdown()
+        zk.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
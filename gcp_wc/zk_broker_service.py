@@ -0,0 +1,55 @@
+"""Zookeeper Broker Service.
+
+Hold the Zookeeper session of the desktop for the agent services, see
+gcp_wc.zk_broker.
+"""
+import socket
+import logging
+
+from gcp_wc import config
+from gcp_wc import logs
+from gcp_wc import metrics
+from gcp_wc import priority
+from gcp_wc import profiler
+from gcp_wc import zk_broker
+
+import win32serviceutil
+import win32service
+import win32event
+
+class ZkBrokerSvc (win32serviceutil.ServiceFramework):
+    """Zookeeper Broker Service"""
+
+    _svc_name_ = "ZkBrokerService"
+    _svc_display_name_ = "ZkBrokerService"
+
+    def __init__(self,args):
+        win32serviceutil.ServiceFramework.__init__(self,args)
+        self.hWaitStop = win32event.CreateEvent(None,0,0,None)
+        socket.setdefaulttimeout(60)
+
+    def SvcStop(self):
+        self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+        win32event.SetEvent(self.hWaitStop)
+
+    def SvcDoRun(self):
+        logs.setup('zkBrokerSVC.txt')
+        config.watch()
+        metrics.serve('zkBroker', config.current().workDirectory)
+        profiler.control('zkBroker', config.current().workDirectory)
+        try:
+            priority.PriorityManager.from_env().lower()
+            settings = config.current()
+            zk = zk_broker.broker_session(settings.zookeeper)
+            zk.start()
+            broker = zk_broker.Broker(zk, port=settings.zkBrokerPort)
+            broker.start()
+            win32event.WaitForSingleObject(self.hWaitStop, win32event.INFINITE)
+            broker.shutdown()
+            zk.stop()
+        except:
+            pass
+
+
+if __name__ == '__main__':
+    win32serviceutil.HandleCommandLine(ZkBrokerSvc)
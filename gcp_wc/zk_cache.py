@@ -0,0 +1,237 @@
+"""Zookeeper Cache.
+
+Local mirror of the placement of the desktop (/placement/<hostname> and its
+children) and of the manifests of the placed apps (/scheduled/<app>), kept
+coherent by watches.
+
+ZkCache wraps a Zookeeper client: reads of the mirrored nodes (get,
+get_children, exists) are served from memory, reads of other nodes and all
+the writes go through to the client. The mirror keeps being served while the
+session is suspended or lost, `staleness()` then tells for how long it has
+not been updated, exported as the gcp_wc_zk_cache_staleness_seconds gauge. `close()` stops the mirror, its watches and listener, for
+the client to outlive it.
+
+The services mirror their placement unless the "zkCache" environment
+variable is "0".
+"""
+import time
+import logging
+import threading
+
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import KazooState
+
+from gcp_wc import config
+from gcp_wc import metrics
+
+PLACEMENT = '/placement'
+SCHEDULED = '/scheduled'
+
+_STALENESS = metrics.gauge(
+    'gcp_wc_zk_cache_staleness_seconds',
+    'Seconds since the Zookeeper mirrors were last updated, 0 if live.', ('mirror',))
+
+
+class ZkCache(object):
+    """Zookeeper client serving the placement of a host from memory."""
+
+    def __init__(self, zk, hostname, name='placement'):
+        """
+        zk: Zookeeper client
+        hostname: host whose placement is mirrored
+        name: label of the mirror in the metrics, e.g. its service
+        """
+        self.zk = zk
+        self.name = name
+        self.placement = PLACEMENT + '/' + hostname
+        self._lock = threading.RLock()
+        # path -> (data, stat), (None, None) for a node known to be missing
+        self._nodes = {}
+        self._children = None
+        # app -> token of its watches
+        self._apps = {}
+        # Token of the placement watches, None once closed.
+        self._token = None
+        self._watching_children = False
+        self.stale_since = None
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.zk, name)
+
+    def start(self):
+        """Start mirroring, the client must be started."""
+        self._token = token = object()
+        self.zk.add_listener(self._listener)
+        if self.zk.state != KazooState.CONNECTED:
+            self.stale_since = time.time()
+        self.zk.DataWatch(self.placement)(self._placement_watcher(token))
+        _STALENESS.set_function(self.staleness, self.name)
+        return self
+
+    def close(self):
+        """Stop mirroring: the watches stop at their next event, the reads
+        go through to the client.
+        """
+        self.zk.remove_listener(self._listener)
+        _STALENESS.set_function(None, self.name)
+        with self._lock:
+            self._token = None
+            self._apps = {}
+            self._nodes = {}
+            self._children = None
+            self._watching_children = False
+
+    def staleness(self):
+        """Returns the seconds since the mirror stopped being updated, 0 if live."""
+        if self.stale_since is None:
+            return 0
+        return time.time() - self.stale_since
+
+    def exists(self, path, watch=None):
+        if watch is None:
+            with self._lock:
+                entry = self._nodes.get(path)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[1]
+        self.misses += 1
+        return self.zk.exists(path, watch=watch)
+
+    def get(self, path, watch=None):
+        if watch is None:
+            with self._lock:
+                entry = self._nodes.get(path)
+                if entry is not None:
+                    self.hits += 1
+                    if entry[1] is None:
+                        raise NoNodeError(path)
+                    return entry
+        self.misses += 1
+        return self.zk.get(path, watch=watch)
+
+    def get_children(self, path, watch=None):
+        if watch is None and path == self.placement:
+            with self._lock:
+                if self._children is not None:
+                    self.hits += 1
+                    if self._nodes.get(path, (None, None))[1] is None:
+                        raise NoNodeError(path)
+                    return list(self._children)
+        self.misses += 1
+        return self.zk.get_children(path, watch=watch)
+
+    def create(self, path, value=b'', **kwargs):
+        created = self.zk.create(path, value, **kwargs)
+        with self._lock:
+            if self._children is not None and _parent(created) == self.placement:
+                name = created.rsplit('/', 1)[1]
+                if name not in self._children:
+                    self._children.append(name)
+            self._nodes.pop(created, None)
+        return created
+
+    def set(self, path, value, version=-1):
+        with self._lock:
+            self._nodes.pop(path, None)
+        return self.zk.set(path, value, version=version)
+
+    def delete(self, path, version=-1, recursive=False):
+        try:
+            result = self.zk.delete(path, version=version, recursive=recursive)
+        except NoNodeError:
+            self._deleted(path)
+            raise
+        self._deleted(path)
+        return result
+
+    def _deleted(self, path):
+        """Drop a deleted node, without waiting for its watch."""
+        with self._lock:
+            if path in self._nodes:
+                self._nodes[path] = (None, None)
+            if self._children is not None and _parent(path) == self.placement:
+                name = path.rsplit('/', 1)[1]
+                if name in self._children:
+                    self._children.remove(name)
+
+    def _listener(self, state):
+        if state == KazooState.CONNECTED:
+            self.stale_since = None
+        elif self.stale_since is None:
+            logging.info('Zookeeper cache is stale: %s', state)
+            self.stale_since = time.time()
+
+    def _placement_watcher(self, token):
+        def watcher(data, stat):
+            register = False
+            with self._lock:
+                if self._token is not token:
+                    return False
+                self._nodes[self.placement] = (data, stat)
+                if stat is None:
+                    # The children watch stops with the node.
+                    self._watching_children = False
+                    self._set_apps([])
+                elif not self._watching_children:
+                    self._watching_children = register = True
+            if register:
+                self.zk.ChildrenWatch(self.placement)(self._children_watcher(token))
+            return None
+        return watcher
+
+    def _children_watcher(self, token):
+        def watcher(children):
+            with self._lock:
+                if self._token is not token:
+                    return False
+                added = self._set_apps(children)
+            for app, app_token in added:
+                for path in (self.placement + '/' + app, SCHEDULED + '/' + app):
+                    self.zk.DataWatch(path)(self._node_watcher(app, app_token, path))
+            return None
+        return watcher
+
+    def _set_apps(self, children):
+        """Set the placed apps, returns the (app, token) of the new ones."""
+        children = set(children)
+        for app in set(self._apps) - children:
+            del self._apps[app]
+            self._nodes.pop(self.placement + '/' + app, None)
+            self._nodes.pop(SCHEDULED + '/' + app, None)
+        added = []
+        for app in children - set(self._apps):
+            # The watches of an app placed again replace the former ones.
+            self._apps[app] = token = object()
+            added.append((app, token))
+        self._children = sorted(children)
+        return added
+
+    def _node_watcher(self, app, token, path):
+        def watcher(data, stat):
+            with self._lock:
+                if self._apps.get(app) is not token:
+                    if app not in self._apps:
+                        self._nodes.pop(path, None)
+                    return False
+                self._nodes[path] = (data, stat)
+            return None
+        return watcher
+
+
+def mirror(zk, hostname, name):
+    """Returns zk wrapped in a started ZkCache named name, unless disabled."""
+    if not config.current().zkCache:
+        return zk
+    return ZkCache(zk, hostname, name).start()
+
+
+def close(zk):
+    """Stop the mirror returned by mirror(), if any."""
+    if isinstance(zk, ZkCache):
+        zk.close()
+
+
+def _parent(path):
+    return path.rsplit('/', 1)[0]
@@ -64,9 +64,9 @@ def main():
 
     #install windows services
     services = ['app_config_manager_service', 'app_event_service', 'cleanup_service', 'event_daemon_service', 'monitor_screen_service'
-                , 'register_zookeeper_service', 'state_monitor_service', 'update_resource_service', 'watchdog_service']
+                , 'register_zookeeper_service', 'state_monitor_service', 'update_resource_service', 'watchdog_service', 'agent_host', 'zk_broker_service']
     service_names = ['AppCfgMgrService', 'AppeventService', 'CleanupService', 'EventDaemonService', 'ScreenMonitorService',
-                     'RegisterZookeeperService', 'StateMonitorService', 'UpdateResourcesService', 'WatchdogService']
+                     'RegisterZookeeperService', 'StateMonitorService', 'UpdateResourcesService', 'WatchdogService', 'AgentHostService', 'ZkBrokerService']
     dictionary = dict(zip(services, service_names))
     for service in services:
         os.system('python -m gcp_wc.{service_name} install'.format(service_name=service))
@@ -46,10 +46,10 @@ def main():
         #uninstall windows services
         services = ['watchdog_service', 'app_config_manager_service', 'app_event_service', 'cleanup_service',
                     'event_daemon_service', 'monitor_screen_service', 'register_zookeeper_service', 'state_monitor_service',
-                    'update_resource_service']
+                    'update_resource_service', 'agent_host', 'zk_broker_service']
         service_names = ['AppCfgMgrService', 'AppeventService', 'CleanupService', 'EventDaemonService',
                          'ScreenMonitorService',
-                         'RegisterZookeeperService', 'StateMonitorService', 'UpdateResourcesService', 'WatchdogService']
+                         'RegisterZookeeperService', 'StateMonitorService', 'UpdateResourcesService', 'WatchdogService', 'AgentHostService', 'ZkBrokerService']
         dictionary = dict(zip(services, service_names))
         for service in services:
             if service == 'monitor_screen_service':